@@ -6,9 +6,26 @@ FILES_STRUCTURE = {
     "Core Bot Files": {
         "bot.py": "Simple production-safe implementation with all 3 features (memory, agent, voice)",
         "bot_advanced.py": "Advanced modular implementation using separate config/memory/voice modules",
+        "supervisor.py": "Multi-process runtime: routes updates to bot_advanced workers by chat id",
         "config.py": "Configuration management with validation (in-memory or Redis backend)",
         "memory.py": "Memory management layer - supports both InMemory and Redis backends",
         "voice.py": "Voice processing - STT (Google Speech Rec) and TTS (gTTS) utilities",
+        "streaming.py": "Streams AI replies into Telegram via throttled message edits",
+        "coalesce.py": "Per-chat debounce that answers quick follow-up messages with one reply",
+        "scheduler.py": "Priority admission queue with request/token budgets for every OpenAI call",
+        "ratelimit.py": "Per-user sliding-window rate limit checked before any handler runs",
+        "prompts.py": "Registry of byte-stable system prompts, ordered for provider prefix caching",
+        "router.py": "Picks model and max_tokens per request from message features and model latency",
+        "metrics.py": "Handler/LLM histograms, counters and gauges on a local /metrics endpoint",
+        "llm.py": "Shared, pre-warmed OpenAI client with deadlines, jittered retries, hedging and a circuit breaker",
+        "response_cache.py": "Optional cache of AI replies for repeated prompts (exact / embedding match)",
+    },
+    
+    "Tooling": {
+        "benchmark.py": "Memory backend benchmarks (message size, per-turn latency, full ops/latency suite)",
+        "resp_server.py": "Minimal in-process Redis stand-in for benchmarks and local runs",
+        "tests/": "pytest suite, one test_<module>*.py per module; Redis tests run against resp_server.py",
+        "loadtest.py": "End-to-end load test against fake Telegram and OpenAI servers (throughput, latency, saturation)",
     },
     
     "Configuration Files": {
@@ -66,7 +83,7 @@ FEATURE_1_MEMORY = """
    ```
    save_memory(chat_id, "user", user_text)
    messages = [system_context] + get_memory(chat_id)
-   response = openai_client.chat.completions.create(model="gpt-4o-mini", messages=messages)
+   response = await llm.create(model="gpt-4o-mini", messages=messages)
    save_memory(chat_id, "assistant", reply)
    ```
 """
@@ -102,8 +119,8 @@ FEATURE_3_VOICE = """
    Goal: User sends voice → bot replies with voice
    
    Implementation Pipeline:
-   1. Download voice file (OGG format from Telegram)
-   2. Convert OGG → WAV (FFmpeg)
+   1. Download voice note into memory (OGG format from Telegram)
+   2. Convert OGG → 16 kHz mono WAV (async FFmpeg over pipes, capped and timed out)
    3. Speech-to-Text: WAV → transcribed text (Google Speech Rec)
    4. Send text to AI (same as text handler)
    5. Get AI response
@@ -113,7 +130,7 @@ FEATURE_3_VOICE = """
    Key Classes:
    - GoogleSTT: Speech Recognition wrapper
    - GoogleTTS: gTTS wrapper
-   - AudioProcessor: OGG↔WAV conversion
+   - AudioProcessor: OGG → WAV conversion without temp files
    - VoiceManager: Orchestrates full pipeline
    
    Error Handling:
@@ -232,7 +249,7 @@ FILE_DESCRIPTIONS = {
         "lines": 250,
         "purpose": "Voice processing pipeline",
         "classes": ["STTBackend", "TTSBackend", "GoogleSTT", "GoogleTTS", "AudioProcessor", "VoiceManager"],
-        "usage": "voice_mgr = get_voice_manager(); text = await voice_mgr.voice_to_text(filepath)",
+        "usage": "voice_mgr = get_voice_manager(); text = await voice_mgr.voice_to_text(ogg_bytes)",
     },
 }
 
@@ -0,0 +1,314 @@
+"""
+Benchmarks for the memory layer
+
+Usage:
+    python benchmark.py message-size [--count 100000]
+    python benchmark.py backends [--chats 1000] [--turns 5] [--redis-url URL]
+    python benchmark.py suite [--backends memory,redis,sqlite] [--chats 1000,100000]
+                              [--history 6,20] [--concurrency 1,32] [--ops 20000]
+                              [--redis-url URL] [--output results.json]
+
+Redis runs against the in-process stand-in from resp_server.py unless
+--redis-url points at a real server. Results are printed as JSON so runs from
+different releases can be diffed.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import json
+import tempfile
+import tracemalloc
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from memory import (
+    HAS_REDIS, Message, MemoryBackend, MemoryManager,
+    InMemoryBackend, RedisBackend, SQLiteBackend,
+)
+from resp_server import RespServer
+
+OPERATIONS = ("add_message", "get_history", "build_messages", "get_metadata", "set_metadata")
+
+
+def _measure(build: Callable[[int], List], count: int) -> float:
+    """Bytes allocated per item built, including the list slot."""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    items = build(count)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del items
+    return used / count
+
+
+def bench_message_size(count: int) -> Dict:
+    """Per-message overhead of the legacy dict layout versus Message."""
+    # One shared content string, so only the record overhead is measured
+    content = "How much does the premium plan cost per month?"
+
+    def legacy(n: int) -> List:
+        return [
+            {"role": "user", "content": content, "timestamp": datetime.now().isoformat()}
+            for _ in range(n)
+        ]
+
+    def compact(n: int) -> List:
+        return [Message("user", content) for _ in range(n)]
+
+    legacy_bytes = _measure(legacy, count)
+    compact_bytes = _measure(compact, count)
+    return {
+        "benchmark": "message-size",
+        "messages": count,
+        "dict_iso_bytes_per_message": round(legacy_bytes, 1),
+        "message_slots_bytes_per_message": round(compact_bytes, 1),
+        "reduction": round(1 - compact_bytes / legacy_bytes, 3),
+        "redis_entry_bytes": {
+            "dict_iso": len(json.dumps(legacy(1)[0])),
+            "message": len(compact(1)[0].encode()),
+        },
+    }
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def _run_turns(backend: MemoryBackend, chats: int, turns: int) -> Dict:
+    """Drive start_turn + commit for every chat; returns per-turn latency."""
+    manager = MemoryManager(backend)
+    latencies = []
+    started = time.perf_counter()
+    for turn in range(turns):
+        for chat_id in range(chats):
+            t0 = time.perf_counter()
+            current = await manager.start_turn(chat_id, f"question {turn} from {chat_id}")
+            current.build_messages()
+            await current.commit(f"answer {turn} for {chat_id}")
+            latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return {
+        "turns_per_sec": round(len(latencies) / elapsed, 1),
+        "turn_p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "turn_p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def _measure_restart(factory: Callable[[], MemoryBackend], chat_id: int) -> Dict:
+    """Time from constructing a backend to serving its first history read."""
+    t0 = time.perf_counter()
+    backend = factory()
+    history = await backend.get_history(chat_id)
+    restart = time.perf_counter() - t0
+    await backend.close()
+    return {"restart_ms": round(restart * 1000, 3), "history_retained": bool(history)}
+
+
+async def bench_backends(chats: int, turns: int, redis_url: Optional[str]) -> Dict:
+    """Per-turn latency and restart time for each memory backend."""
+    results = {}
+    max_history = turns * 2
+
+    backend = InMemoryBackend(max_history)
+    results["memory"] = await _run_turns(backend, chats, turns)
+    await backend.close()
+    results["memory"].update(
+        await _measure_restart(lambda: InMemoryBackend(max_history), chats - 1)
+    )
+
+    workdir = tempfile.mkdtemp(prefix="bench-sqlite-")
+    try:
+        path = os.path.join(workdir, "memory.db")
+        backend = SQLiteBackend(path, max_history)
+        results["sqlite"] = await _run_turns(backend, chats, turns)
+        await backend.close()
+        results["sqlite"].update(
+            await _measure_restart(lambda: SQLiteBackend(path, max_history), chats - 1)
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if HAS_REDIS:
+        redis_url = redis_url or _start_standin()
+        backend = RedisBackend(redis_url, max_history)
+        for chat_id in range(chats):
+            await backend.clear_history(chat_id)
+        results["redis"] = await _run_turns(backend, chats, turns)
+        await backend.close()
+        results["redis"].update(
+            await _measure_restart(lambda: RedisBackend(redis_url, max_history), chats - 1)
+        )
+
+    return {"benchmark": "backends", "chats": chats, "turns": turns, "results": results}
+
+
+def _start_standin() -> str:
+    port = RespServer().start_in_thread()
+    return f"redis://127.0.0.1:{port}"
+
+
+def _make_backend(name: str, history: int, redis_url: Optional[str], workdir: str) -> MemoryBackend:
+    if name == "memory":
+        return InMemoryBackend(history)
+    if name == "sqlite":
+        return SQLiteBackend(os.path.join(workdir, f"suite-{time.time_ns()}.db"), history)
+    if name == "redis":
+        return RedisBackend(redis_url, history)
+    raise ValueError(f"Unknown backend: {name}")
+
+
+async def _populate(backend: MemoryBackend, chats: int, history: int) -> None:
+    """Fill ``chats`` chats with ``history`` messages and one metadata field."""
+    messages = [
+        ("user" if i % 2 == 0 else "assistant", f"benchmark message {i} " * 8)
+        for i in range(history)
+    ]
+    batch = 500
+    for start in range(0, chats, batch):
+        chat_ids = range(start, min(chats, start + batch))
+        await asyncio.gather(*(backend.add_messages(chat_id, messages) for chat_id in chat_ids))
+        await asyncio.gather(*(backend.set_metadata(chat_id, "lang", "en") for chat_id in chat_ids))
+
+
+async def _drive(operation: Callable[[int], Awaitable], chats: int,
+                 ops: int, concurrency: int) -> Dict:
+    """Run ``ops`` calls on random chats from ``concurrency`` tasks."""
+    latencies: List[float] = []
+
+    async def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        for _ in range(ops // concurrency):
+            chat_id = rng.randrange(chats)
+            t0 = time.perf_counter()
+            await operation(chat_id)
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 4),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 4),
+    }
+
+
+async def bench_suite(backends: List[str], chat_counts: List[int], histories: List[int],
+                      concurrencies: List[int], ops: int, redis_url: Optional[str]) -> Dict:
+    """Every backend × chat count × history length × concurrency × operation."""
+    redis_target = redis_url or "stand-in"
+    if "redis" in backends:
+        if not HAS_REDIS:
+            raise SystemExit("redis package not installed. Use: pip install redis")
+        redis_url = redis_url or _start_standin()
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench-suite-")
+    try:
+        for name in backends:
+            for chats in chat_counts:
+                for history in histories:
+                    backend = _make_backend(name, history, redis_url, workdir)
+                    if name == "redis":
+                        await (await backend._get_client()).flushall()
+                    t0 = time.perf_counter()
+                    await _populate(backend, chats, history)
+                    populate_s = time.perf_counter() - t0
+
+                    manager = MemoryManager(backend, token_budget=3000)
+                    operations = {
+                        "add_message": lambda c: backend.add_message(c, "user", "benchmark message"),
+                        "get_history": backend.get_history,
+                        "build_messages": manager.build_messages,
+                        "get_metadata": lambda c: backend.get_metadata(c, "lang"),
+                        "set_metadata": lambda c: backend.set_metadata(c, "lang", "en"),
+                    }
+                    for concurrency in concurrencies:
+                        for op in OPERATIONS:
+                            stats = await _drive(operations[op], chats, ops, concurrency)
+                            results.append({
+                                "backend": name,
+                                "chats": chats,
+                                "history": history,
+                                "concurrency": concurrency,
+                                "operation": op,
+                                **stats,
+                            })
+                            print(
+                                f"{name:>6} chats={chats} history={history} "
+                                f"concurrency={concurrency} {op}: {stats['ops_per_sec']} ops/s",
+                                file=sys.stderr,
+                            )
+                    results.append({
+                        "backend": name, "chats": chats, "history": history,
+                        "operation": "populate", "seconds": round(populate_s, 3),
+                    })
+                    await backend.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "suite",
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis": redis_target,
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        },
+        "ops_per_cell": ops,
+        "results": results,
+    }
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    size = sub.add_parser("message-size", help="Bytes per stored message")
+    size.add_argument("--count", type=int, default=100_000)
+
+    backends = sub.add_parser("backends", help="Per-turn latency and restart time")
+    backends.add_argument("--chats", type=int, default=1000)
+    backends.add_argument("--turns", type=int, default=5)
+    backends.add_argument("--redis-url", default=None, help="Real Redis instead of the stand-in")
+
+    suite = sub.add_parser("suite", help="Per-operation throughput and latency grid")
+    suite.add_argument("--backends", default="memory,redis,sqlite",
+                       type=lambda value: value.split(","))
+    suite.add_argument("--chats", default="1000,100000", type=_int_list,
+                       help="Chat counts, e.g. 1000,100000,1000000")
+    suite.add_argument("--history", default="6,20", type=_int_list)
+    suite.add_argument("--concurrency", default="1,32", type=_int_list)
+    suite.add_argument("--ops", type=int, default=20_000, help="Operations per cell")
+    suite.add_argument("--redis-url", default=None, help="Real Redis instead of the stand-in")
+    suite.add_argument("--output", default=None, help="Also write the JSON here")
+
+    args = parser.parse_args()
+    if args.benchmark == "message-size":
+        result = bench_message_size(args.count)
+    elif args.benchmark == "backends":
+        result = asyncio.run(bench_backends(args.chats, args.turns, args.redis_url))
+    elif args.benchmark == "suite":
+        result = asyncio.run(bench_suite(
+            args.backends, args.chats, args.history, args.concurrency, args.ops, args.redis_url
+        ))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
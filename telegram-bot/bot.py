@@ -4,6 +4,7 @@ Production-safe implementation with python-telegram-bot v20+
 """
 
 import os
+import time
 import logging
 import asyncio
 from datetime import datetime
@@ -26,12 +27,24 @@ from telegram.ext import (
     ConversationHandler,
 )
 from telegram.constants import ChatAction
-from openai import AsyncOpenAI
-from dashboard import DashboardManager
 
 # Load environment variables
 load_dotenv()
 
+# Import custom modules (config reads the environment on import, so every
+# module that reaches it, directly or not, comes after load_dotenv())
+from dashboard import DashboardManager
+from memory import Message, count_tokens, get_memory_backend, load_tokenizer
+from handover import AgentModeRegistry
+from streaming import iter_deltas, stream_reply
+from scheduler import Priority, SchedulerBusy, estimate_tokens, get_llm_scheduler
+from llm import LLMUnavailable, get_llm_client
+from prompts import CHAT, VOICE, system_message
+from router import get_model_router
+from metrics import REGISTRY, MetricsServer, instrument, record_error, stage
+from ratelimit import RateLimitGate, get_rate_limiter
+from voice import AudioConversionError, get_audio_processor, get_stt
+
 # Configure logging
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
@@ -41,22 +54,33 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # empty = https://api.telegram.org
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_IDS = set(map(int, os.getenv("ADMIN_IDS", "").split(","))) if os.getenv("ADMIN_IDS") else set()
 MAX_HISTORY = 6
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "True").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+OPENAI_WARM_CONNECTIONS = int(os.getenv("OPENAI_WARM_CONNECTIONS", "2"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 TEMP_AUDIO_DIR = os.getenv("TEMP_AUDIO_DIR", "./audio_temp")
 
 # Initialize clients
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-dashboard_manager = DashboardManager(openai_client)
+llm = get_llm_client()
+llm_scheduler = get_llm_scheduler()
+router = get_model_router(llm)
+dashboard_manager = DashboardManager(llm, llm_scheduler, router)
+rate_limiter = get_rate_limiter()
+audio_processor = get_audio_processor()
+metrics_server = MetricsServer(REGISTRY, METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
 
 # ===== 1️⃣ MEMORY MANAGEMENT =====
 
-user_memory: Dict[int, List[Dict]] = {}
+user_memory: Dict[int, List[Message]] = {}
 user_metadata: Dict[int, Dict] = {}
 
 
-def get_memory(chat_id: int) -> List[Dict]:
+def get_memory(chat_id: int) -> List[Message]:
     """Retrieve conversation history for a user."""
     return user_memory.get(chat_id, [])
 
@@ -66,11 +90,7 @@ def save_memory(chat_id: int, role: str, content: str) -> None:
     if chat_id not in user_memory:
         user_memory[chat_id] = []
     
-    user_memory[chat_id].append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.utcnow().isoformat()
-    })
+    user_memory[chat_id].append(Message(role, content))
     
     # Keep only last MAX_HISTORY messages
     user_memory[chat_id] = user_memory[chat_id][-MAX_HISTORY:]
@@ -88,15 +108,15 @@ def get_memory_summary(chat_id: int) -> str:
         return "No conversation history."
     
     return "\n".join([
-        f"[{msg['timestamp']}] {msg['role'].upper()}: {msg['content'][:100]}"
+        f"[{msg.iso_timestamp}] {msg.role.upper()}: {msg.content[:100]}"
         for msg in history
     ])
 
 
 # ===== 2️⃣ AGENT MODE (HUMAN HANDOVER) =====
 
-agent_mode: set = set()
-agent_info: Dict[int, Dict] = {}
+# Shared through the memory backend so every worker sees the same handover
+agent_registry = AgentModeRegistry(get_memory_backend())
 
 
 async def agent_on(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -106,12 +126,11 @@ async def agent_on(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     chat_id = update.effective_chat.id
-    agent_mode.add(chat_id)
-    agent_info[chat_id] = {
+    await agent_registry.enable(chat_id, {
         "admin_id": update.effective_user.id,
         "started_at": datetime.utcnow().isoformat(),
         "admin_name": update.effective_user.full_name
-    }
+    })
     
     logger.info(f"Agent mode ON for chat {chat_id} by {update.effective_user.full_name}")
     await update.message.reply_text(
@@ -128,9 +147,7 @@ async def agent_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     chat_id = update.effective_chat.id
-    was_active = chat_id in agent_mode
-    agent_mode.discard(chat_id)
-    agent_info.pop(chat_id, None)
+    was_active = await agent_registry.disable(chat_id)
     
     logger.info(f"Agent mode OFF for chat {chat_id} by {update.effective_user.full_name}")
     
@@ -147,7 +164,7 @@ async def agent_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show current status and conversation history."""
     chat_id = update.effective_chat.id
-    mode = "👨‍💼 AGENT MODE" if chat_id in agent_mode else "🤖 BOT MODE"
+    mode = "👨‍💼 AGENT MODE" if await agent_registry.is_active(chat_id) else "🤖 BOT MODE"
     
     status_text = f"{mode}\n\n📋 Conversation History:\n{get_memory_summary(chat_id)}"
     await update.message.reply_text(status_text)
@@ -168,6 +185,7 @@ async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ===== 3️⃣ TEXT HANDLER WITH AI & MEMORY =====
 
+@instrument("text")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages with AI and memory."""
     chat_id = update.effective_chat.id
@@ -175,7 +193,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     user_id = update.effective_user.id
     
     # Skip if agent mode is active
-    if chat_id in agent_mode:
+    if await agent_registry.is_active(chat_id):
         logger.debug(f"Agent mode active for {chat_id}, skipping AI reply")
         return
     
@@ -184,6 +202,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     try:
+        started = time.monotonic()
         # Show typing indicator
         await update.message.chat.send_action(ChatAction.TYPING)
         
@@ -191,39 +210,60 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         save_memory(chat_id, "user", user_text)
         
         # Build messages with system context
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful Telegram assistant. "
-                    "Be concise, friendly, and helpful. "
-                    "Keep responses under 2000 characters for Telegram."
-                )
-            }
-        ] + [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in get_memory(chat_id)
-        ]
+        messages = [system_message(CHAT)] + [msg.to_openai() for msg in get_memory(chat_id)]
         
-        # Call OpenAI API
+        # Call OpenAI API with the model and budget picked for this message
+        route = router.route(CHAT, user_text)
         logger.debug(f"Calling OpenAI for chat {chat_id}")
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1500
-        )
-        
-        ai_reply = response.choices[0].message.content
+        estimate = estimate_tokens(messages, route.max_tokens)
+        with stage("text", "llm"):
+            async with llm_scheduler.slot(Priority.INTERACTIVE, estimate) as ticket:
+                if STREAM_REPLIES:
+                    stream = await llm.create(
+                        kind=CHAT,
+                        model=route.model,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=route.max_tokens,
+                        stream=True
+                    )
+                    # Sends the first tokens right away and edits the reply as more arrive
+                    ai_reply = await stream_reply(
+                        update.message, iter_deltas(stream),
+                        started=started, edit_interval=STREAM_EDIT_INTERVAL
+                    )
+                    if not ai_reply.strip():
+                        raise RuntimeError("Empty streamed reply")
+                    if stream.usage is not None:
+                        ticket.charge(stream.usage.total_tokens)
+                    else:
+                        ticket.charge(estimate - route.max_tokens + count_tokens(ai_reply))
+                else:
+                    response = await llm.create(
+                        kind=CHAT,
+                        model=route.model,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=route.max_tokens
+                    )
+                    ticket.charge(response.usage.total_tokens)
+                    ai_reply = response.choices[0].message.content
+                    await update.message.reply_text(ai_reply)
         
         # Save AI response
         save_memory(chat_id, "assistant", ai_reply)
-        
-        # Send reply
-        await update.message.reply_text(ai_reply)
         logger.info(f"AI reply sent to chat {chat_id}")
         
+    except SchedulerBusy as e:
+        record_error("text", e)
+        logger.warning(f"LLM busy, not answering chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ I'm handling a lot of messages right now. Please try again in a moment.")
+    except LLMUnavailable as e:
+        record_error("text", e)
+        logger.warning(f"LLM unavailable, not answering chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ The AI service is temporarily unavailable. Please try again in a minute.")
     except Exception as e:
+        record_error("text", e)
         logger.error(f"Error in text_handler for chat {chat_id}: {e}")
         await update.message.reply_text(
             "❌ Sorry, I encountered an error. Please try again."
@@ -232,56 +272,56 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 # ===== 4️⃣ VOICE HANDLER WITH STT & TTS =====
 
+@instrument("voice")
 async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle voice messages: voice → STT → AI → TTS."""
     chat_id = update.effective_chat.id
     
     # Skip if agent mode is active
-    if chat_id in agent_mode:
+    if await agent_registry.is_active(chat_id):
         logger.debug(f"Agent mode active for {chat_id}, skipping AI reply")
         return
     
     try:
         await update.message.chat.send_action(ChatAction.RECORD_AUDIO)
         
-        # Create temp directory if needed
+        # Create temp directory if needed (for the reply audio)
         os.makedirs(TEMP_AUDIO_DIR, exist_ok=True)
         
-        # Download voice file
+        # Download voice note into memory
         voice_file = await update.message.voice.get_file()
-        voice_path = os.path.join(TEMP_AUDIO_DIR, f"{chat_id}_input.ogg")
-        await voice_file.download_to_drive(voice_path)
+        with stage("voice", "download"):
+            ogg = bytes(await voice_file.download_as_bytearray())
         
         logger.info(f"Voice file downloaded for chat {chat_id}")
         
-        # Convert OGG to WAV
-        wav_path = os.path.join(TEMP_AUDIO_DIR, f"{chat_id}_input.wav")
-        os.system(f"ffmpeg -y -i {voice_path} {wav_path} 2>/dev/null")
+        # Convert OGG to 16 kHz mono WAV (ffmpeg over pipes, off the event loop)
+        with stage("voice", "transcode"):
+            wav = await audio_processor.ogg_to_wav(ogg)
         
         # Speech recognition
         await update.message.chat.send_action(ChatAction.TYPING)
         
         try:
-            try:
-                import speech_recognition as sr  # type: ignore
-            except ImportError:
-                await update.message.reply_text(
-                    "❌ Voice support not installed. Install with: pip install SpeechRecognition"
-                )
-                return
-            
-            recognizer = sr.Recognizer()
-            
-            with sr.AudioFile(wav_path) as source:
-                audio = recognizer.record(source)
-                text = recognizer.recognize_google(audio)
-                logger.info(f"Voice transcribed for chat {chat_id}: {text[:50]}...")
-        except sr.UnknownValueError:
+            stt = get_stt()
+        except ImportError:
+            await update.message.reply_text(
+                "❌ Voice support not installed. Install with: pip install SpeechRecognition"
+            )
+            return
+        
+        try:
+            with stage("voice", "stt"):
+                text = await stt.transcribe(wav)
+            logger.info(f"Voice transcribed for chat {chat_id}: {text[:50]}...")
+        except ValueError:
+            # GoogleSTT: speech not understood
             await update.message.reply_text(
                 "❌ Could not understand your voice. Please try again."
             )
             return
-        except sr.RequestError:
+        except RuntimeError:
+            # GoogleSTT: recognition service error
             await update.message.reply_text(
                 "❌ Speech recognition service unavailable. Try text instead."
             )
@@ -291,27 +331,21 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         save_memory(chat_id, "user", f"[Voice] {text}")
         
         # Build messages for AI
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful voice assistant. "
-                    "Keep responses natural and concise for voice. "
-                    "Max 500 characters."
-                )
-            }
-        ] + [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in get_memory(chat_id)
-        ]
+        messages = [system_message(VOICE)] + [msg.to_openai() for msg in get_memory(chat_id)]
         
         # Get AI response
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=500
-        )
+        route = router.route(VOICE, text)
+        estimate = estimate_tokens(messages, route.max_tokens)
+        with stage("voice", "llm"):
+            async with llm_scheduler.slot(Priority.INTERACTIVE, estimate) as ticket:
+                response = await llm.create(
+                    kind=VOICE,
+                    model=route.model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=route.max_tokens
+                )
+                ticket.charge(response.usage.total_tokens)
         
         ai_reply = response.choices[0].message.content
         save_memory(chat_id, "assistant", ai_reply)
@@ -323,7 +357,8 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         
         mp3_path = os.path.join(TEMP_AUDIO_DIR, f"{chat_id}_reply.mp3")
         tts = gTTS(ai_reply, lang="en", slow=False)
-        tts.save(mp3_path)
+        with stage("voice", "tts"):
+            await asyncio.to_thread(tts.save, mp3_path)
         
         logger.info(f"Voice response generated for chat {chat_id}")
         
@@ -335,13 +370,24 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         
         # Cleanup
         try:
-            os.remove(voice_path)
-            os.remove(wav_path)
             os.remove(mp3_path)
         except:
             pass
         
+    except SchedulerBusy as e:
+        record_error("voice", e)
+        logger.warning(f"LLM busy, not answering voice in chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ I'm handling a lot of messages right now. Please try again in a moment.")
+    except LLMUnavailable as e:
+        record_error("voice", e)
+        logger.warning(f"LLM unavailable, not answering voice in chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ The AI service is temporarily unavailable. Please try again in a minute.")
+    except AudioConversionError as e:
+        record_error("voice", e)
+        logger.error(f"Voice transcoding failed for chat {chat_id}: {e}")
+        await update.message.reply_text("❌ Could not process that voice message. Please try text instead.")
     except Exception as e:
+        record_error("voice", e)
         logger.error(f"Error in voice_handler for chat {chat_id}: {e}")
         await update.message.reply_text(
             "❌ Sorry, voice processing failed. Please try text instead."
@@ -350,6 +396,7 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ===== 5️⃣ LIVE DASHBOARD AI SUMMARIES =====
 
+@instrument("thingspeak")
 async def thingspeak(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI summary of ThingSpeak IoT data."""
     try:
@@ -374,10 +421,12 @@ async def thingspeak(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text(summary, parse_mode="Markdown")
         
     except Exception as e:
+        record_error("thingspeak", e)
         logger.error(f"Error in thingspeak handler: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
 
+@instrument("weather")
 async def weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI summary of weather forecast."""
     try:
@@ -405,10 +454,12 @@ async def weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(summary, parse_mode="Markdown")
         
     except Exception as e:
+        record_error("weather", e)
         logger.error(f"Error in weather handler: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
 
+@instrument("analyze")
 async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI analysis of custom API data."""
     try:
@@ -433,6 +484,7 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(summary, parse_mode="Markdown")
         
     except Exception as e:
+        record_error("analyze", e)
         logger.error(f"Error in analyze handler: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
@@ -491,6 +543,31 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ===== 7️⃣ MAIN APPLICATION SETUP =====
 
+async def on_startup(app: Application) -> None:
+    """Load the tokenizer, open OpenAI connections and metrics before polling starts."""
+    # First load may download the BPE file; keep it off the loop and out of user turns
+    await asyncio.to_thread(load_tokenizer)
+    await llm.warm_up(OPENAI_WARM_CONNECTIONS)
+    if metrics_server is not None:
+        REGISTRY.gauge_function("bot_llm_queue_depth", "LLM calls waiting for admission",
+                                lambda: llm_scheduler.queue_depth)
+        REGISTRY.gauge_function("bot_llm_circuit_open", "1 while the OpenAI circuit breaker is open",
+                                lambda: int(llm.breaker.state == "open"))
+        REGISTRY.gauge_function("bot_ffmpeg_waiting", "Voice transcodes waiting for an ffmpeg slot",
+                                lambda: audio_processor.stats["waiting"])
+        await metrics_server.start()
+
+
+async def on_shutdown(app: Application) -> None:
+    """Release the shared state backend and OpenAI connections."""
+    await agent_registry.backend.close()
+    if rate_limiter is not None:
+        await rate_limiter.close()
+    await llm.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+
 def main() -> None:
     """Start the bot."""
     if not TELEGRAM_BOT_TOKEN:
@@ -505,7 +582,20 @@ def main() -> None:
         logger.warning("ADMIN_IDS not configured. Admin features disabled.")
     
     # Create application
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        # Self-hosted Bot API server, or the fake one in loadtest.py
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
+    
+    # Per-user rate limit, checked before any other handler does work
+    if rate_limiter is not None:
+        app.add_handler(RateLimitGate(rate_limiter, ADMIN_IDS).handler(), group=-1)
     
     # Register handlers
     app.add_handler(CommandHandler("start", start))
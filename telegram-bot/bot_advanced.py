@@ -7,9 +7,12 @@ Uses modular architecture with:
 """
 
 import os
+import time
 import logging
 import asyncio
 from pathlib import Path
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
 
 try:
     from dotenv import load_dotenv  # type: ignore
@@ -27,15 +30,24 @@ from telegram.ext import (
     filters,
 )
 from telegram.constants import ChatAction
-from openai import AsyncOpenAI
 
 # Load environment variables
 load_dotenv()
 
 # Import custom modules
 from config import config
-from memory import get_memory_backend, MemoryManager
+from memory import get_memory_backend, load_tokenizer, MemoryManager, Message, count_tokens
+from handover import AgentModeRegistry
 from voice import get_voice_manager
+from streaming import iter_deltas, stream_reply, stream_stats
+from response_cache import get_response_cache
+from coalesce import Batch, MessageCoalescer
+from scheduler import Priority, SchedulerBusy, estimate_tokens, get_llm_scheduler
+from llm import LLMUnavailable, get_llm_client
+from prompts import CHAT, SUMMARY, VOICE, summary_messages, system_prompt
+from router import get_model_router
+from metrics import REGISTRY, MetricsServer, instrument, record_error, stage
+from ratelimit import RateLimitGate, get_rate_limiter
 
 # Configure logging
 logging.basicConfig(
@@ -50,13 +62,42 @@ logger = logging.getLogger(__name__)
 
 # Initialize clients and managers
 config.validate()
-openai_client = AsyncOpenAI(api_key=config.openai_api_key)
+llm = get_llm_client()
+llm_scheduler = get_llm_scheduler()
+router = get_model_router(llm)
 memory_backend = get_memory_backend()
-memory_manager = MemoryManager(memory_backend)
+
+
+async def summarize_history(summary: Optional[str], messages: List[Message]) -> str:
+    """Fold evicted messages into the running conversation summary."""
+    transcript = "\n".join(f"{msg.role.upper()}: {msg.content}" for msg in messages)
+    # Deferrable: waits behind interactive replies and dashboards
+    tokens = count_tokens(transcript) + count_tokens(summary or "") + 400
+    async with llm_scheduler.slot(Priority.BACKGROUND, tokens) as ticket:
+        response = await llm.create(
+            kind=SUMMARY,
+            model=config.model,
+            messages=summary_messages(summary or "(none)", transcript),
+            temperature=0.3,
+            max_tokens=300
+        )
+        ticket.charge(response.usage.total_tokens)
+    return response.choices[0].message.content
+
+
+memory_manager = MemoryManager(
+    memory_backend,
+    token_budget=config.prompt_token_budget,
+    summarizer=summarize_history,
+    compact_threshold=config.compaction_threshold,
+    compact_keep=config.compaction_keep,
+)
 voice_manager = get_voice_manager()
 
-# Agent mode tracking
-agent_mode = set()
+# Agent mode tracking, shared by every worker through the memory backend
+agent_registry = AgentModeRegistry(memory_backend)
+response_cache = get_response_cache(llm, llm_scheduler)
+rate_limiter = get_rate_limiter()
 
 
 # ===== 1️⃣ ADMIN COMMANDS =====
@@ -68,7 +109,11 @@ async def agent_on(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     chat_id = update.effective_chat.id
-    agent_mode.add(chat_id)
+    await agent_registry.enable(chat_id, {
+        "admin_id": update.effective_user.id,
+        "started_at": datetime.utcnow().isoformat(),
+        "admin_name": update.effective_user.full_name
+    })
     
     logger.info(f"Agent mode activated for chat {chat_id}")
     await update.message.reply_text(
@@ -85,8 +130,7 @@ async def agent_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     chat_id = update.effective_chat.id
-    was_active = chat_id in agent_mode
-    agent_mode.discard(chat_id)
+    was_active = await agent_registry.disable(chat_id)
     
     logger.info(f"Bot mode resumed for chat {chat_id}")
     
@@ -114,10 +158,46 @@ async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show bot status and conversation history."""
     chat_id = update.effective_chat.id
-    mode = "👨‍💼 AGENT MODE" if chat_id in agent_mode else "🤖 BOT MODE"
+    mode = "👨‍💼 AGENT MODE" if await agent_registry.is_active(chat_id) else "🤖 BOT MODE"
     summary = await memory_manager.get_summary(chat_id)
     
     status_text = f"{mode}\n\n📋 Conversation:\n{summary}"
+    if update.effective_user.id in config.admin_ids and stream_stats.ttft:
+        stats = stream_stats.snapshot()
+        status_text += (
+            f"\n\n⚡ First visible token: p50 {stats['ttft_p50_s']}s, "
+            f"p95 {stats['ttft_p95_s']}s over {len(stream_stats.ttft)} replies"
+        )
+    if update.effective_user.id in config.admin_ids:
+        stats = llm_scheduler.metrics()
+        interactive = stats["wait"].get("interactive", {})
+        status_text += (
+            f"\n\n🚦 LLM queue: {stats['queue_depth']} waiting, {stats['in_flight']} running, "
+            f"reply wait p95 {interactive.get('p95_s', 0)}s, "
+            f"{stats['rejected_full'] + stats['timed_out']} turned away"
+        )
+        stats = llm.metrics()
+        status_text += (
+            f"\n\n🛡️ OpenAI: circuit {stats['circuit']}, {stats['retries']} retries, "
+            f"{stats['hedges']} hedged ({stats['hedge_wins']} won), {stats['failures']} failed calls"
+        )
+        stats = router.metrics()
+        status_text += (
+            f"\n\n🧭 Routes: {', '.join(f'{k} {v}' for k, v in sorted(stats['decisions'].items())) or 'none yet'}; "
+            f"p95 {', '.join(f'{m} {p}s' for m, p in stats['p95_s'].items())}"
+        )
+        for kind, usage in llm.usage.snapshot().items():
+            status_text += (
+                f"\n📦 {kind}: {usage['cached_ratio']:.0%} of {usage['prompt_tokens']} prompt tokens "
+                f"cached, p50 {usage['latency_p50_cached_s']}s cached / "
+                f"{usage['latency_p50_uncached_s']}s uncached"
+            )
+    if update.effective_user.id in config.admin_ids and response_cache is not None:
+        stats = response_cache.cache_stats()
+        status_text += (
+            f"\n\n💾 Reply cache: {stats['hit_rate']:.0%} hit rate over {stats['lookups']} "
+            f"lookups, {stats['saved_latency_s']}s of generation saved"
+        )
     await update.message.reply_text(status_text)
 
 
@@ -160,13 +240,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 # ===== 2️⃣ TEXT HANDLER =====
 
+@instrument("text")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages with AI and memory."""
     chat_id = update.effective_chat.id
     user_text = update.message.text
     
     # Skip if agent mode is active
-    if chat_id in agent_mode:
+    if await agent_registry.is_active(chat_id):
         return
     
     # Skip commands
@@ -178,92 +259,186 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text(f"❌ Message too long (max {config.max_message_length} chars)")
         return
     
+    await update.message.chat.send_action(ChatAction.TYPING)
+    if coalescer is not None:
+        # Answered together with any follow-ups sent in the next moments
+        coalescer.submit(chat_id, update.message)
+    else:
+        await answer_text(chat_id, update.message, user_text)
+
+
+async def answer_batch(batch: Batch) -> None:
+    """Answer coalesced messages with one reply to the latest."""
+    await answer_text(batch.chat_id, batch.last, batch.text, batch)
+
+
+async def _claim_on_first(deltas: AsyncIterator[str], batch: Batch) -> AsyncIterator[str]:
+    async for piece in deltas:
+        batch.claim()
+        yield piece
+
+
+@instrument("text_answer")
+async def answer_text(chat_id: int, message, user_text: str, batch: Optional[Batch] = None) -> None:
+    """Generate and send the AI reply to ``user_text``.
+    
+    With a ``batch`` this may be cancelled by a newer message until the
+    batch is claimed, which happens right before anything becomes visible;
+    nothing is saved to memory before that point.
+    """
+    claim = batch.claim if batch is not None else (lambda: None)
     try:
-        await update.message.chat.send_action(ChatAction.TYPING)
+        started = time.monotonic()
         
-        # Save user message
-        await memory_manager.add_user_message(chat_id, user_text)
+        # Read history once; both messages are saved together on commit
+        turn = await memory_manager.start_turn(chat_id, user_text)
+        messages = turn.build_messages()
+        route = router.route(CHAT, user_text)
         
-        # Build messages for API
-        messages = await memory_manager.build_messages(chat_id)
+        # Same prompt seen recently: answer without calling OpenAI
+        probe = None
+        if response_cache is not None:
+            try:
+                with stage("text_answer", "cache"):
+                    probe = await response_cache.lookup(messages, route.model)
+            except Exception as e:
+                # The cache is an optimization; without it, ask the model
+                logger.warning(f"Response cache lookup failed for chat {chat_id}: {e}")
+            if probe is not None and probe.reply is not None:
+                claim()
+                await message.reply_text(probe.reply)
+                await turn.commit(probe.reply)
+                logger.info(f"Cached reply ({probe.match} match) sent to chat {chat_id}")
+                return
         
-        # Call OpenAI
+        # Call OpenAI once admitted by the scheduler
         logger.debug(f"Calling OpenAI for chat {chat_id}")
-        response = await openai_client.chat.completions.create(
-            model=config.model,
-            messages=messages,
-            temperature=config.temperature,
-            max_tokens=config.max_tokens
-        )
-        
-        ai_reply = response.choices[0].message.content
-        
-        # Save assistant response
-        await memory_manager.add_assistant_message(chat_id, ai_reply)
+        estimate = estimate_tokens(messages, route.max_tokens)
+        with stage("text_answer", "llm"):
+            async with llm_scheduler.slot(Priority.INTERACTIVE, estimate) as ticket:
+                if config.stream_replies:
+                    stream = await llm.create(
+                        kind=CHAT,
+                        model=route.model,
+                        messages=messages,
+                        temperature=config.temperature,
+                        max_tokens=route.max_tokens,
+                        stream=True
+                    )
+                    deltas = iter_deltas(stream)
+                    if batch is not None:
+                        deltas = _claim_on_first(deltas, batch)
+                    # Sends the first tokens right away and edits the reply as more arrive
+                    ai_reply = await stream_reply(
+                        message, deltas,
+                        started=started, edit_interval=config.stream_edit_interval
+                    )
+                    if not ai_reply.strip():
+                        raise RuntimeError("Empty streamed reply")
+                    if stream.usage is not None:
+                        ticket.charge(stream.usage.total_tokens)
+                    else:
+                        ticket.charge(estimate - route.max_tokens + count_tokens(ai_reply))
+                else:
+                    response = await llm.create(
+                        kind=CHAT,
+                        model=route.model,
+                        messages=messages,
+                        temperature=config.temperature,
+                        max_tokens=route.max_tokens
+                    )
+                    ticket.charge(response.usage.total_tokens)
+                    ai_reply = response.choices[0].message.content
+                    claim()
+                    await message.reply_text(ai_reply)
+                    stream_stats.record_first_token(time.monotonic() - started)
         
-        # Send reply
-        await update.message.reply_text(ai_reply)
+        # Save user message and assistant response
+        await turn.commit(ai_reply)
+        if probe is not None:
+            try:
+                await response_cache.store(probe, ai_reply, time.monotonic() - started)
+            except Exception as e:
+                # The reply is already out; a lost cache entry is not an error for the user
+                logger.warning(f"Response cache store failed for chat {chat_id}: {e}")
         logger.info(f"Text reply sent to chat {chat_id}")
         
+    except SchedulerBusy as e:
+        record_error("text_answer", e)
+        logger.warning(f"LLM busy, not answering chat {chat_id}: {e}")
+        claim()
+        await message.reply_text("⏳ I'm handling a lot of messages right now. Please try again in a moment.")
+    except LLMUnavailable as e:
+        record_error("text_answer", e)
+        logger.warning(f"LLM unavailable, not answering chat {chat_id}: {e}")
+        claim()
+        await message.reply_text("⏳ The AI service is temporarily unavailable. Please try again in a minute.")
     except Exception as e:
+        record_error("text_answer", e)
         logger.error(f"Error in text_handler for chat {chat_id}: {e}")
-        await update.message.reply_text(
+        claim()
+        await message.reply_text(
             "❌ Sorry, I encountered an error. Please try again."
         )
 
 
 # ===== 3️⃣ VOICE HANDLER =====
 
+@instrument("voice")
 async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle voice messages: voice → STT → AI → TTS."""
     chat_id = update.effective_chat.id
     
     # Skip if agent mode is active
-    if chat_id in agent_mode:
+    if await agent_registry.is_active(chat_id):
         return
     
     try:
         # Create temp directory
         Path(config.temp_audio_dir).mkdir(exist_ok=True)
         
-        # Download voice file
+        # Download voice note into memory
         voice_file = await update.message.voice.get_file()
-        voice_path = os.path.join(config.temp_audio_dir, f"{chat_id}_input.ogg")
-        await voice_file.download_to_drive(voice_path)
+        with stage("voice", "download"):
+            ogg = bytes(await voice_file.download_as_bytearray())
         
         # Show processing status
         await update.message.chat.send_action(ChatAction.TYPING)
         
-        # Voice to text
+        # Voice to text: OGG → 16 kHz mono WAV (ffmpeg over pipes) → STT
         logger.info(f"Processing voice message for chat {chat_id}")
-        transcribed_text = await voice_manager.voice_to_text(voice_path)
+        with stage("voice", "transcode"):
+            wav = await voice_manager.audio_processor.ogg_to_wav(ogg)
+        with stage("voice", "stt"):
+            transcribed_text = await voice_manager.stt.transcribe(wav)
         logger.info(f"Transcribed: {transcribed_text[:50]}...")
         
-        # Save to memory
-        await memory_manager.add_user_message(chat_id, f"[Voice] {transcribed_text}")
-        
         # Get AI response
-        messages = await memory_manager.build_messages(chat_id)
-        messages[0]["content"] = (
-            "You are a helpful voice assistant. Keep responses natural and concise. "
-            "Max 500 characters."
-        )
+        turn = await memory_manager.start_turn(chat_id, f"[Voice] {transcribed_text}")
+        messages = turn.build_messages(system_prompt(VOICE))
+        route = router.route(VOICE, transcribed_text)
         
-        response = await openai_client.chat.completions.create(
-            model=config.model,
-            messages=messages,
-            temperature=config.temperature,
-            max_tokens=config.voice_max_tokens
-        )
+        estimate = estimate_tokens(messages, route.max_tokens)
+        with stage("voice", "llm"):
+            async with llm_scheduler.slot(Priority.INTERACTIVE, estimate) as ticket:
+                response = await llm.create(
+                    kind=VOICE,
+                    model=route.model,
+                    messages=messages,
+                    temperature=config.temperature,
+                    max_tokens=route.max_tokens
+                )
+                ticket.charge(response.usage.total_tokens)
         
         ai_reply = response.choices[0].message.content
-        await memory_manager.add_assistant_message(chat_id, ai_reply)
+        await turn.commit(ai_reply)
         
         # Text to voice
         await update.message.chat.send_action(ChatAction.RECORD_AUDIO)
         
         mp3_path = os.path.join(config.temp_audio_dir, f"{chat_id}_reply.mp3")
-        await voice_manager.text_to_voice(ai_reply, mp3_path)
+        with stage("voice", "tts"):
+            await voice_manager.text_to_voice(ai_reply, mp3_path)
         
         # Send voice reply
         with open(mp3_path, "rb") as audio_file:
@@ -272,19 +447,48 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.info(f"Voice reply sent to chat {chat_id}")
         
         # Cleanup
-        voice_manager.audio_processor.cleanup_temp_files(voice_path, mp3_path)
+        voice_manager.audio_processor.cleanup_temp_files(mp3_path)
         
+    except SchedulerBusy as e:
+        record_error("voice", e)
+        logger.warning(f"LLM busy, not answering voice in chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ I'm handling a lot of messages right now. Please try again in a moment.")
+    except LLMUnavailable as e:
+        record_error("voice", e)
+        logger.warning(f"LLM unavailable, not answering voice in chat {chat_id}: {e}")
+        await update.message.reply_text("⏳ The AI service is temporarily unavailable. Please try again in a minute.")
     except ValueError as e:
+        record_error("voice", e)
         logger.warning(f"Voice recognition error for chat {chat_id}: {e}")
         await update.message.reply_text("❌ Could not understand your voice. Please try text.")
     except RuntimeError as e:
+        record_error("voice", e)
         logger.error(f"Voice processing error for chat {chat_id}: {e}")
         await update.message.reply_text("❌ Voice processing failed. Please try text.")
     except Exception as e:
+        record_error("voice", e)
         logger.error(f"Unexpected error in voice_handler for chat {chat_id}: {e}")
         await update.message.reply_text("❌ Voice processing failed. Please try text.")
 
 
+# Buffers each chat's quick follow-up messages into one reply (None = off)
+coalescer = (
+    MessageCoalescer(answer_batch, config.coalesce_window, config.coalesce_max_wait)
+    if config.coalesce_window > 0 else None
+)
+
+
+def pending_answer(update: Update) -> Optional[asyncio.Future]:
+    """Future for a reply still being prepared after the handler returned.
+    
+    Text messages are only queued by :func:`text_handler` when coalescing
+    is on; the future resolves once the batch holding them is answered.
+    """
+    if coalescer is None or update.message is None or update.effective_chat is None:
+        return None
+    return coalescer.answered(update.effective_chat.id, update.message.message_id)
+
+
 # ===== 4️⃣ ERROR HANDLER =====
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -294,16 +498,73 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ===== 5️⃣ MAIN BOT SETUP =====
 
-def main() -> None:
-    """Start the bot."""
-    logger.info("🚀 Initializing Telegram Bot")
-    logger.info(f"Configuration: {config.to_dict()}")
+metrics_server = (
+    MetricsServer(REGISTRY, config.metrics_host, config.metrics_port)
+    if config.metrics_port else None
+)
+
+
+def register_stats_metrics() -> None:
+    """Expose point-in-time stats kept by other components at scrape time."""
+    REGISTRY.gauge_function("bot_llm_queue_depth", "LLM calls waiting for admission",
+                            lambda: llm_scheduler.queue_depth)
+    REGISTRY.gauge_function("bot_llm_in_flight", "LLM calls admitted and running",
+                            lambda: llm_scheduler.in_flight)
+    REGISTRY.gauge_function("bot_llm_circuit_open", "1 while the OpenAI circuit breaker is open",
+                            lambda: int(llm.breaker.state == "open"))
+    REGISTRY.gauge_function("bot_stream_ttft_p95_seconds", "p95 time to first visible reply token",
+                            lambda: stream_stats.snapshot()["ttft_p95_s"] if stream_stats.ttft else None)
+    REGISTRY.gauge_function("bot_ffmpeg_waiting", "Voice transcodes waiting for an ffmpeg slot",
+                            lambda: voice_manager.audio_processor.stats["waiting"])
+    if response_cache is not None:
+        REGISTRY.gauge_function("bot_response_cache_hit_ratio", "Share of reply-cache lookups that hit",
+                                lambda: response_cache.cache_stats()["hit_rate"])
+
+
+async def on_startup(app: Application) -> None:
+    """Load the tokenizer, open OpenAI connections and metrics before the first update."""
+    # First load may download the BPE file; keep it off the loop and out of user turns
+    await asyncio.to_thread(load_tokenizer)
+    await llm.warm_up(config.openai_warm_connections)
+    if metrics_server is not None:
+        register_stats_metrics()
+        await metrics_server.start()
+
+
+async def on_shutdown(app: Application) -> None:
+    """Answer buffered messages, then release backend, cache and OpenAI connections."""
+    if coalescer is not None:
+        await coalescer.flush()
+    await memory_backend.close()
+    if rate_limiter is not None:
+        await rate_limiter.close()
+    if response_cache is not None:
+        await response_cache.close()
+    await llm.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+
+def build_application(builder=None) -> Application:
+    """Create the application with every handler registered.
     
-    # Create application
-    app = Application.builder().token(config.telegram_token).build()
+    ``builder`` lets other runtimes (see supervisor.py) adjust the
+    builder, e.g. drop the updater, before handlers are attached.
+    """
+    if builder is None:
+        builder = Application.builder().token(config.telegram_token)
+    if config.telegram_api_url:
+        # Self-hosted Bot API server, or the fake one in loadtest.py
+        builder = builder.base_url(f"{config.telegram_api_url}/bot") \
+            .base_file_url(f"{config.telegram_api_url}/file/bot")
+    app = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
     
     # Register handlers (order matters!)
     
+    # Per-user rate limit, checked before any other handler does work
+    if rate_limiter is not None:
+        app.add_handler(RateLimitGate(rate_limiter, config.admin_ids).handler(), group=-1)
+    
     # Commands
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -319,6 +580,16 @@ def main() -> None:
     # Error handling
     app.add_error_handler(error_handler)
     
+    return app
+
+
+def main() -> None:
+    """Start the bot."""
+    logger.info("🚀 Initializing Telegram Bot")
+    logger.info(f"Configuration: {config.to_dict()}")
+    
+    app = build_application()
+    
     logger.info("✅ Bot initialized successfully")
     logger.info("🎬 Starting polling...")
     
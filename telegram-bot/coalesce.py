@@ -0,0 +1,170 @@
+"""
+Per-chat coalescing of rapid-fire messages
+
+Users often split one thought over several short messages. Instead of one
+LLM call (and one reply) per message, messages of a chat are buffered for a
+short quiet window and answered together. A message that arrives while the
+previous batch is still waiting for the model cancels that generation and is
+answered together with it. Once a reply starts to become visible the batch
+is *claimed* and can no longer be cancelled; later messages start the next
+batch instead. The same holds for a batch whose oldest message has waited
+``max_wait``, so a steady stream of messages still gets answers.
+
+Every submitted message gets a future that resolves once the batch
+containing it has been answered (or has failed and said so), so callers
+that acknowledge work, like the supervisor's workers, can wait for the
+reply rather than for the message to be queued.
+"""
+
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram import Message
+
+logger = logging.getLogger(__name__)
+
+
+class Batch:
+    """Messages answered by one generation."""
+
+    def __init__(self, chat_id: int, messages: List[Message], first_at: float):
+        self.chat_id = chat_id
+        self.messages = messages
+        self.first_at = first_at  # arrival of the oldest message, time.monotonic()
+        self.claimed = False
+
+    @property
+    def text(self) -> str:
+        return "\n".join(message.text for message in self.messages)
+
+    @property
+    def last(self) -> Message:
+        return self.messages[-1]
+
+    def claim(self) -> None:
+        """Mark the point of no return: the reply is about to be shown."""
+        self.claimed = True
+
+
+# Answers a batch; must be safe to cancel until it calls batch.claim()
+Responder = Callable[[Batch], Awaitable[None]]
+
+
+class _ChatQueue:
+    __slots__ = ("pending", "first_at", "timer", "inflight", "batch")
+
+    def __init__(self):
+        self.pending: List[Message] = []
+        self.first_at = 0.0
+        self.timer: Optional[asyncio.Task] = None
+        self.inflight: Optional[asyncio.Task] = None
+        self.batch: Optional[Batch] = None
+
+
+class MessageCoalescer:
+    """Debounces each chat's messages and answers them in one call.
+
+    Args:
+        respond: Coroutine that answers a :class:`Batch`.
+        window: Quiet seconds after the latest message before answering.
+        max_wait: Seconds after which a batch is answered and no longer
+            cancelled, however many messages keep arriving.
+    """
+
+    def __init__(self, respond: Responder, window: float = 1.0, max_wait: float = 5.0):
+        self.respond = respond
+        self.window = window
+        self.max_wait = max_wait
+        self._chats: Dict[int, _ChatQueue] = {}
+        # (chat id, message id) → resolved when that message has been answered
+        self._answered: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.stats = {"messages": 0, "batches": 0, "cancelled": 0}
+
+    def submit(self, chat_id: int, message: Message) -> asyncio.Future:
+        """Queue ``message``; returns a future resolved once it is answered."""
+        self.stats["messages"] += 1
+        answered = asyncio.get_running_loop().create_future()
+        self._answered[(chat_id, message.message_id)] = answered
+        queue = self._chats.setdefault(chat_id, _ChatQueue())
+
+        # Not visible yet: fold the running batch back in and answer everything
+        # together, unless it has already waited max_wait
+        if (queue.inflight is not None and not queue.batch.claimed
+                and time.monotonic() - queue.batch.first_at < self.max_wait):
+            queue.inflight.cancel()
+            queue.pending = queue.batch.messages
+            queue.first_at = queue.batch.first_at
+            queue.inflight = queue.batch = None
+            self.stats["cancelled"] += 1
+
+        if not queue.pending:
+            queue.first_at = time.monotonic()
+        queue.pending.append(message)
+
+        if queue.timer is not None:
+            queue.timer.cancel()
+        delay = min(self.window, max(0.0, queue.first_at + self.max_wait - time.monotonic()))
+        queue.timer = asyncio.create_task(self._fire_after(chat_id, queue, delay))
+        return answered
+
+    def answered(self, chat_id: int, message_id: int) -> Optional[asyncio.Future]:
+        """The future of a submitted message not answered yet, if any."""
+        return self._answered.get((chat_id, message_id))
+
+    async def _fire_after(self, chat_id: int, queue: _ChatQueue, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if queue.inflight is not None:
+            # Previous reply already claimed; answer these once it is done
+            await asyncio.wait([queue.inflight])
+        queue.timer = None
+        self._start(chat_id, queue)
+
+    def _start(self, chat_id: int, queue: _ChatQueue) -> None:
+        if not queue.pending:
+            return
+        batch = Batch(chat_id, queue.pending, queue.first_at)
+        queue.pending, queue.first_at = [], 0.0
+        queue.batch = batch
+        queue.inflight = asyncio.create_task(self._run(chat_id, queue, batch))
+        self.stats["batches"] += 1
+        if len(batch.messages) > 1:
+            logger.debug(f"Coalesced {len(batch.messages)} messages for chat {chat_id}")
+
+    async def _run(self, chat_id: int, queue: _ChatQueue, batch: Batch) -> None:
+        answered = False
+        try:
+            await self.respond(batch)
+            answered = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            answered = True  # failed for good, like a handler that raises
+            logger.error(f"Error answering batch for chat {chat_id}: {e}")
+        finally:
+            if queue.batch is batch:
+                queue.inflight = queue.batch = None
+            # A cancelled batch is either folded into the next one or dropped
+            # at shutdown; its messages are not answered
+            if answered:
+                for message in batch.messages:
+                    future = self._answered.pop((chat_id, message.message_id), None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+            if not queue.pending and queue.timer is None and queue.inflight is None:
+                self._chats.pop(chat_id, None)
+
+    async def flush(self) -> None:
+        """Answer everything still buffered and wait for running replies."""
+        for chat_id, queue in list(self._chats.items()):
+            if queue.timer is not None:
+                queue.timer.cancel()
+                queue.timer = None
+            if queue.inflight is not None:
+                await asyncio.wait([queue.inflight])
+            if queue.pending:
+                self._start(chat_id, queue)
+        running = [queue.inflight for queue in self._chats.values() if queue.inflight]
+        if running:
+            await asyncio.wait(running)
@@ -13,41 +13,88 @@ class BotConfig:
     
     # Core
     telegram_token: str = os.getenv("TELEGRAM_BOT_TOKEN", "")
+    telegram_api_url: str = os.getenv("TELEGRAM_API_URL", "")  # empty = https://api.telegram.org
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
+    openai_base_url: str = os.getenv("OPENAI_BASE_URL", "")  # empty = api.openai.com
+    openai_max_connections: int = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+    openai_max_keepalive: int = int(os.getenv("OPENAI_MAX_KEEPALIVE", "32"))
+    openai_keepalive_expiry: float = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "120"))  # seconds idle
+    openai_http2: bool = os.getenv("OPENAI_HTTP2", "False").lower() == "true"
+    openai_warm_connections: int = int(os.getenv("OPENAI_WARM_CONNECTIONS", "2"))  # 0 = no warm-up
     admin_ids: set = field(default_factory=lambda: {
         int(uid) for uid in (os.getenv("ADMIN_IDS", "").split(",") if os.getenv("ADMIN_IDS") else [])
     })
     
     # Memory
-    max_history: int = int(os.getenv("MAX_HISTORY", "6"))
+    max_history: int = int(os.getenv("MAX_HISTORY", "20"))
+    prompt_token_budget: int = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))  # 0 = no limit
+    compaction_threshold: int = int(os.getenv("COMPACTION_THRESHOLD", "16"))  # messages, 0 = off
+    compaction_keep: int = int(os.getenv("COMPACTION_KEEP", "6"))  # recent messages kept verbatim
+    memory_backend: str = os.getenv("MEMORY_BACKEND", "").lower()  # memory, redis or sqlite
     use_redis: bool = os.getenv("USE_REDIS", "False").lower() == "true"
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379")
+    memory_max_chats: int = int(os.getenv("MEMORY_MAX_CHATS", "50000"))  # in-memory backend, 0 = unbounded
+    memory_idle_ttl: int = int(os.getenv("MEMORY_IDLE_TTL", str(30 * 24 * 3600)))  # seconds, 0 = never
+    snapshot_path: str = os.getenv("SNAPSHOT_PATH", "")  # in-memory backend, empty = off
+    snapshot_interval: int = int(os.getenv("SNAPSHOT_INTERVAL", "60"))  # seconds
+    sqlite_path: str = os.getenv("SQLITE_PATH", "./bot_memory.db")
+    redis_cache_size: int = int(os.getenv("REDIS_CACHE_SIZE", "0"))  # chats, 0 = off
+    response_cache: str = os.getenv("RESPONSE_CACHE", "off").lower()  # off, memory or redis
+    response_cache_ttl: int = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # seconds
+    response_cache_size: int = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))  # entries
+    response_cache_similarity: float = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))  # 0 = exact only
     
     # AI Settings
-    model: str = "gpt-4o-mini"
+    model: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
     temperature: float = 0.7
     max_tokens: int = 1500
     voice_max_tokens: int = 500
+    router_enabled: bool = os.getenv("ROUTER_ENABLED", "True").lower() == "true"
+    router_fast_model: str = os.getenv("ROUTER_FAST_MODEL", "")  # empty = same as OPENAI_MODEL
+    router_short_chars: int = int(os.getenv("ROUTER_SHORT_CHARS", "200"))
+    router_short_max_tokens: int = int(os.getenv("ROUTER_SHORT_MAX_TOKENS", "400"))
+    router_latency_slo: float = float(os.getenv("ROUTER_LATENCY_SLO", "10"))  # p95 seconds, 0 = no fallback
+    llm_requests_per_minute: int = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))  # 0 = unlimited
+    llm_tokens_per_minute: int = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))  # 0 = unlimited
+    llm_max_concurrency: int = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+    llm_max_queue: int = int(os.getenv("LLM_MAX_QUEUE", "200"))
+    llm_queue_timeout: float = float(os.getenv("LLM_QUEUE_TIMEOUT", "20"))  # seconds
+    llm_deadline: float = float(os.getenv("LLM_DEADLINE", "30"))  # seconds per call, retries included
+    llm_max_attempts: int = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+    llm_hedge: bool = os.getenv("LLM_HEDGE", "False").lower() == "true"
+    llm_breaker_threshold: int = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))  # failures, 0 = off
+    llm_breaker_cooldown: float = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # seconds
+    stream_replies: bool = os.getenv("STREAM_REPLIES", "True").lower() == "true"
+    stream_edit_interval: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # seconds between edits
+    coalesce_window: float = float(os.getenv("COALESCE_WINDOW", "1.0"))  # seconds, 0 = answer each message
+    coalesce_max_wait: float = float(os.getenv("COALESCE_MAX_WAIT", "5.0"))  # seconds
     
     # Voice Processing
     temp_audio_dir: str = os.getenv("TEMP_AUDIO_DIR", "./audio_temp")
     enable_voice: bool = True
     speech_engine: str = "google"  # google, azure, or other
+    ffmpeg_max_concurrent: int = int(os.getenv("FFMPEG_MAX_CONCURRENT", str(os.cpu_count() or 2)))
+    ffmpeg_timeout: float = float(os.getenv("FFMPEG_TIMEOUT", "30"))  # seconds per transcode
     
     # Logging
     log_level: str = os.getenv("LOG_LEVEL", "INFO")
     log_file: Optional[str] = os.getenv("LOG_FILE", None)
+    metrics_port: int = int(os.getenv("METRICS_PORT", "0"))  # 0 = no metrics endpoint
+    metrics_host: str = os.getenv("METRICS_HOST", "127.0.0.1")
     
     # Safety limits
     max_message_length: int = 2000
     max_voice_duration: int = 120  # seconds
-    rate_limit_per_minute: int = 30
+    rate_limit_per_minute: int = int(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))  # per user, 0 = off
+    rate_limit_voice_weight: int = int(os.getenv("RATE_LIMIT_VOICE_WEIGHT", "5"))  # text message = 1
+    rate_limit_dashboard_weight: int = int(os.getenv("RATE_LIMIT_DASHBOARD_WEIGHT", "3"))
     
     # Deployment
     environment: str = os.getenv("FLASK_ENV", "production")
     webhook_enabled: bool = os.getenv("WEBHOOK_ENABLED", "False").lower() == "true"
     webhook_url: str = os.getenv("WEBHOOK_URL", "")
     webhook_port: int = int(os.getenv("WEBHOOK_PORT", "8443"))
+    workers: int = int(os.getenv("WORKERS", "0"))  # supervisor.py processes, 0 = one per core
     
     def validate(self) -> bool:
         """Validate configuration."""
@@ -55,6 +102,8 @@ class BotConfig:
             raise ValueError("TELEGRAM_BOT_TOKEN is required")
         if not self.openai_api_key:
             raise ValueError("OPENAI_API_KEY is required")
+        if self.compaction_threshold and self.compaction_threshold >= self.max_history:
+            raise ValueError("COMPACTION_THRESHOLD must be below MAX_HISTORY")
         return True
     
     def to_dict(self) -> dict:
@@ -64,6 +113,7 @@ class BotConfig:
             "openai_api_key": "***" if self.openai_api_key else "",
             "admin_ids": self.admin_ids,
             "max_history": self.max_history,
+            "memory_backend": self.memory_backend or ("redis" if self.use_redis else "memory"),
             "use_redis": self.use_redis,
             "model": self.model,
             "environment": self.environment,
@@ -8,16 +8,26 @@ import aiohttp
 import json
 from typing import Dict, Optional, Any
 from datetime import datetime
-from openai import AsyncOpenAI
+
+from scheduler import LLMScheduler, Priority, SchedulerBusy, estimate_tokens, get_llm_scheduler
+from llm import LLMClient, LLMUnavailable
+from prompts import DASHBOARD, analysis_messages
+from router import ModelRouter, get_model_router
 
 logger = logging.getLogger(__name__)
 
+# Completion budget of an analysis; the router may pick a smaller one
+ANALYSIS_MAX_TOKENS = 300
+
 
 class DashboardManager:
     """Manage live data fetching and AI analysis."""
     
-    def __init__(self, openai_client: AsyncOpenAI):
-        self.openai_client = openai_client
+    def __init__(self, llm: LLMClient, scheduler: Optional[LLMScheduler] = None,
+                 router: Optional[ModelRouter] = None):
+        self.llm = llm
+        self.scheduler = scheduler or get_llm_scheduler()
+        self.router = router or get_model_router(llm)
         self.data_sources: Dict[str, Dict[str, Any]] = {
             "thingspeak": {
                 "url": "https://api.thingspeak.com/channels/{channel_id}/feeds.json",
@@ -104,53 +114,33 @@ class DashboardManager:
             # Format data for AI consumption
             data_json = json.dumps(data, indent=2)[:2000]  # Limit to 2000 chars for token efficiency
             
-            prompts = {
-                "general": f"""Analyze this data and provide a brief, human-readable summary:
-
-{data_json}
-
-Give 2-3 key insights in bullet points. Be concise.""",
-                
-                "thingspeak": f"""Analyze these IoT sensor readings and identify patterns or anomalies:
-
-{data_json}
-
-Provide actionable insights. Focus on trends and any concerning values.""",
-                
-                "weather": f"""Summarize this weather forecast data for a user:
-
-{data_json}
-
-Include current conditions and any weather warnings or notable changes.""",
-                
-                "database": f"""Summarize these database metrics and highlight important statistics:
-
-{data_json}
-
-Focus on performance indicators and anomalies.""",
-            }
+            # Fixed instructions first, the data last
+            messages = analysis_messages(analysis_type, data_json)
             
-            prompt = prompts.get(analysis_type, prompts["general"])
+            # Model from the router like every other call; multi-line data routes as "long"
+            route = self.router.route(DASHBOARD, data_json)
+            max_tokens = min(route.max_tokens, ANALYSIS_MAX_TOKENS)
             
-            response = await self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a data analyst. Provide clear, concise insights from data. Keep responses under 500 characters."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=300
-            )
+            # Behind interactive replies in the LLM queue
+            async with self.scheduler.slot(Priority.DASHBOARD, tokens=estimate_tokens(messages, max_tokens)) as ticket:
+                response = await self.llm.create(
+                    kind=DASHBOARD,
+                    model=route.model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=max_tokens
+                )
+                ticket.charge(response.usage.total_tokens)
             
             summary = response.choices[0].message.content
             logger.info(f"✅ AI analysis complete")
             return summary
+        except SchedulerBusy as e:
+            logger.warning(f"⏳ AI analysis not admitted: {e}")
+            return "⏳ AI analysis is busy right now. Please try again in a minute."
+        except LLMUnavailable as e:
+            logger.warning(f"⏳ AI analysis unavailable: {e}")
+            return "⏳ AI analysis is temporarily unavailable. Please try again in a minute."
         except Exception as e:
             logger.error(f"❌ Error analyzing data with AI: {e}")
             return f"❌ Could not analyze data: {str(e)}"
@@ -0,0 +1,76 @@
+"""
+Human handover (agent mode) state shared across workers
+"""
+
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from memory import MemoryBackend, LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Metadata key holding the handover record for a chat
+AGENT_KEY = "agent"
+
+
+class AgentModeRegistry:
+    """Track which chats a human agent has taken over.
+    
+    The record lives in the memory backend as the ``agent`` metadata key, so
+    ``/agent`` sent to one worker silences the AI on every worker. Lookups
+    are answered from a local cache, including "not in agent mode", so the
+    check made for every incoming message is an in-memory lookup. Entries
+    are dropped when the backend reports another process changed the chat.
+    When it cannot guarantee that (SQLite, or Redis while the pub/sub feed
+    is down), entries expire after ``cache_ttl`` seconds instead.
+    """
+    
+    def __init__(self, backend: MemoryBackend, cache_ttl: float = 2.0, cache_size: int = 100_000):
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        # chat_id -> (record or None, fetched_at)
+        self._cache = LRUCache(cache_size)
+        # Bumped by invalidations and local writes; a read that raced with
+        # one must not be cached, it may be stale with no TTL to expire it
+        self._invalidations = 0
+        backend.add_invalidation_listener(self.invalidate)
+    
+    def invalidate(self, chat_id: Optional[int]) -> None:
+        """Forget one chat, or everything when ``chat_id`` is None."""
+        self._invalidations += 1
+        if chat_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(chat_id)
+    
+    async def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """Handover record for ``chat_id``, or None when the bot is in charge."""
+        cached = self._cache.get(chat_id)
+        if cached is not None:
+            record, fetched_at = cached
+            if self.backend.pushes_invalidations or time.monotonic() - fetched_at < self.cache_ttl:
+                return record
+        
+        generation = self._invalidations
+        record = await self.backend.get_metadata(chat_id, AGENT_KEY)
+        # Skip filling if an invalidation raced with the read
+        if generation == self._invalidations:
+            self._cache.put(chat_id, (record, time.monotonic()))
+        return record
+    
+    async def is_active(self, chat_id: int) -> bool:
+        return await self.get(chat_id) is not None
+    
+    async def enable(self, chat_id: int, info: Dict[str, Any]) -> None:
+        await self.backend.set_metadata(chat_id, AGENT_KEY, info)
+        self._invalidations += 1
+        self._cache.put(chat_id, (info, time.monotonic()))
+    
+    async def disable(self, chat_id: int) -> bool:
+        """Hand the chat back to the bot. Returns whether it was in agent mode."""
+        was_active = await self.is_active(chat_id)
+        await self.backend.set_metadata(chat_id, AGENT_KEY, None)
+        self._invalidations += 1
+        self._cache.put(chat_id, (None, time.monotonic()))
+        return was_active
@@ -0,0 +1,466 @@
+"""
+Resilient OpenAI call layer
+
+:class:`LLMClient` wraps ``chat.completions.create`` (and, through
+:meth:`LLMClient.embed`, ``embeddings.create``) with:
+
+- a per-call deadline covering every attempt (for ``stream=True`` calls it
+  bounds the wait for the response to start; the SDK read timeout still
+  guards stalls mid-stream),
+- bounded retries with full-jitter exponential backoff on retryable errors
+  (timeouts, connection errors, 408/409/429 and 5xx), honouring Retry-After,
+- optional hedging: when an attempt is slower than the observed p95, an
+  identical second request is sent and the first to answer wins,
+- a circuit breaker that fails fast for a cooldown after consecutive
+  provider failures, then lets a single probe through,
+- usage accounting per prompt kind (see prompts.py), including the prompt
+  tokens the provider served from its prefix cache; streamed calls ask for
+  a final usage chunk.
+
+The SDK's own retries are disabled so only this layer decides. Point
+OPENAI_BASE_URL at a local fake server to exercise all of it offline.
+
+The underlying HTTP client is built once per process from config with an
+explicit connection pool, keep-alive and optional HTTP/2, opened with
+:meth:`LLMClient.warm_up` before the bot takes updates and closed with
+:meth:`LLMClient.close` on shutdown.
+"""
+
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2)
+    HAS_H2 = True
+except ImportError:
+    HAS_H2 = False
+
+from config import config
+from metrics import LLM_ERRORS, LLM_SECONDS, LLM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429}
+CONNECT_TIMEOUT = 5.0  # seconds
+
+
+class LLMUnavailable(Exception):
+    """The provider could not produce an answer in time."""
+
+
+class CircuitOpen(LLMUnavailable):
+    """Failing fast while the provider is degraded."""
+
+
+class DeadlineExceeded(LLMUnavailable):
+    """No successful attempt within the call's deadline."""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, asyncio.TimeoutError)):
+        return True  # includes APITimeoutError
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures for ``cooldown`` seconds."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = "closed"  # closed, open or half_open
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed" or self.threshold <= 0:
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """Give back a half-open probe that ended without a verdict (cancelled),
+        so the next call can probe instead."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("LLM circuit closed")
+        self.state, self.failures, self._probing = "closed", 0, False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.threshold > 0 and (self.state == "half_open" or self.failures >= self.threshold):
+            if self.state != "open":
+                logger.warning(f"LLM circuit open for {self.cooldown:.0f}s after {self.failures} failures")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+def cached_tokens(usage: Any) -> int:
+    """Prompt tokens served from the provider's prefix cache."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):  # field unknown to older SDK models
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class UsageStats:
+    """Token usage per prompt kind, split by whether the prefix cache hit.
+
+    Latency is the time until the response (or the first streamed chunk)
+    arrived, which is what a cached prefix shortens.
+    """
+
+    def __init__(self):
+        self.kinds: Dict[str, Dict[str, int]] = {}
+        # (kind, prefix cache hit) → recent latencies
+        self._latencies: Dict[Tuple[str, bool], Deque[float]] = {}
+
+    def record(self, kind: str, usage: Any, latency: float) -> None:
+        if usage is None:
+            return
+        cached = cached_tokens(usage)
+        totals = self.kinds.setdefault(kind, {
+            "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+        })
+        totals["calls"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["cached_tokens"] += cached
+        # Embeddings report no completion tokens
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        totals["completion_tokens"] += completion
+        self._latencies.setdefault((kind, cached > 0), deque(maxlen=500)).append(latency)
+        logger.debug(
+            f"LLM usage ({kind}): {usage.prompt_tokens} prompt ({cached} cached), "
+            f"{completion} completion, {latency:.2f}s"
+        )
+
+    def _p50(self, kind: str, hit: bool) -> Optional[float]:
+        samples = sorted(self._latencies.get((kind, hit), ()))
+        return round(samples[len(samples) // 2], 3) if samples else None
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Totals, cached share of prompt tokens and p50 latency per kind."""
+        result = {}
+        for kind, totals in self.kinds.items():
+            prompt = totals["prompt_tokens"]
+            result[kind] = {
+                **totals,
+                "cached_ratio": round(totals["cached_tokens"] / prompt, 3) if prompt else 0.0,
+                "latency_p50_cached_s": self._p50(kind, True),
+                "latency_p50_uncached_s": self._p50(kind, False),
+            }
+        return result
+
+
+class MeteredStream:
+    """Passes a chat completion stream through and records its final usage."""
+
+    def __init__(self, stream: Any, on_usage: Callable[[Any], None]):
+        self._stream = stream
+        self._on_usage = on_usage
+        self.usage = None
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[Any]:
+        async for chunk in self._stream:
+            if getattr(chunk, "usage", None) is not None:
+                self.usage = chunk.usage
+                self._on_usage(chunk.usage)
+            yield chunk
+
+    async def close(self) -> None:
+        await self._stream.close()
+
+
+class LLMClient:
+    """``chat.completions.create`` with deadlines, retries, hedging and a breaker.
+
+    Args:
+        client: OpenAI client; a copy with SDK retries disabled is used.
+        deadline: Default seconds for a whole call, retries included.
+        max_attempts: Attempts per call, the first one included.
+        backoff_base / backoff_max: Exponential backoff bounds in seconds.
+        hedge: Send a second request once an attempt exceeds the p95 latency.
+        breaker: Circuit breaker shared by every call.
+    """
+
+    def __init__(self, client: AsyncOpenAI, deadline: float = 30.0, max_attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, hedge: bool = False,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.client = client.with_options(max_retries=0)
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self._latencies: Deque[float] = deque(maxlen=500)
+        self.usage = UsageStats()
+        self._latency_listeners: List[Callable[[str, float], None]] = []
+        self.stats = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "failures": 0,
+            "short_circuited": 0,
+        }
+
+    def add_latency_listener(self, listener: Callable[[str, float], None]) -> None:
+        """Call ``listener(model, seconds)`` after every call, failed ones included."""
+        self._latency_listeners.append(listener)
+
+    def _notify_latency(self, model: str, latency: float) -> None:
+        for listener in self._latency_listeners:
+            listener(model, latency)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Observed p95 attempt latency, once there are enough samples."""
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95)]
+
+    async def create(self, kind: str = "chat", deadline: Optional[float] = None,
+                     hedge: Optional[bool] = None, **kwargs: Any) -> Any:
+        """Drop-in for ``client.chat.completions.create(**kwargs)``.
+
+        ``kind`` labels the call in usage stats. Streams come back wrapped
+        in a :class:`MeteredStream` whose ``usage`` is set once consumed.
+        """
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        hedge = self.hedge if hedge is None else hedge
+        return await self._call(self.client.chat.completions.create, kind, deadline, hedge, kwargs)
+
+    async def embed(self, kind: str = "embedding", deadline: Optional[float] = None,
+                    **kwargs: Any) -> Any:
+        """Drop-in for ``client.embeddings.create(**kwargs)``, with the same
+        deadline, retries, circuit breaker and metrics as :meth:`create`."""
+        # Kept out of the completion latency samples used for hedging and routing
+        return await self._call(self.client.embeddings.create, kind, deadline, False, kwargs,
+                                observe=False)
+
+    async def _call(self, method: Callable[..., Awaitable[Any]], kind: str,
+                    deadline: Optional[float], hedge: bool, kwargs: Dict,
+                    observe: bool = True) -> Any:
+        self.stats["calls"] += 1
+        started = time.monotonic()
+        end = started + (deadline or self.deadline)
+        model = kwargs.get("model", "")
+        last_error: Optional[Exception] = None
+
+        for attempt in range(self.max_attempts):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow():
+                self.stats["short_circuited"] += 1
+                LLM_ERRORS.inc(kind=kind, error="CircuitOpen")
+                LLM_SECONDS.observe(time.monotonic() - started, kind=kind, model=model, outcome="rejected")
+                raise CircuitOpen("LLM provider marked unavailable") from last_error
+            probe = self.breaker.state == "half_open"
+            self.stats["attempts"] += 1
+            try:
+                result = await self._attempt(method, kwargs, remaining, hedge, observe)
+            except Exception as e:
+                LLM_ERRORS.inc(kind=kind, error=type(e).__name__)
+                if not is_retryable(e):
+                    # The request itself is wrong; the provider is fine
+                    self.breaker.record_success()
+                    LLM_SECONDS.observe(time.monotonic() - started, kind=kind, model=model, outcome="error")
+                    raise
+                self.breaker.record_failure()
+                last_error = e
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                delay = max(delay, _retry_after(e) or 0.0)
+                if (attempt + 1 >= self.max_attempts or time.monotonic() + delay >= end
+                        or self.breaker.state == "open"):
+                    break
+                self.stats["retries"] += 1
+                logger.warning(f"LLM attempt {attempt + 1} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled (superseded generation, lost hedge, shutdown):
+                # no verdict on the provider, but the probe must not stay taken
+                if probe:
+                    self.breaker.release()
+                raise
+            self.breaker.record_success()
+            latency = time.monotonic() - started
+            if observe:
+                self._notify_latency(model, latency)
+            LLM_SECONDS.observe(latency, kind=kind, model=model, outcome="ok")
+            if kwargs.get("stream"):
+                return MeteredStream(result, lambda usage: self._record_usage(kind, model, usage, latency))
+            self._record_usage(kind, model, getattr(result, "usage", None), latency)
+            return result
+
+        self.stats["failures"] += 1
+        if observe:
+            self._notify_latency(model, time.monotonic() - started)
+        LLM_SECONDS.observe(time.monotonic() - started, kind=kind, model=model, outcome="error")
+        if self.breaker.state == "open":
+            raise CircuitOpen("LLM provider marked unavailable") from last_error
+        if last_error is None or isinstance(last_error, asyncio.TimeoutError):
+            raise DeadlineExceeded(f"No LLM response within {deadline or self.deadline:.0f}s") from last_error
+        raise last_error
+
+    def _record_usage(self, kind: str, model: str, usage: Any, latency: float) -> None:
+        if usage is None:
+            return
+        self.usage.record(kind, usage, latency)
+        LLM_TOKENS.inc(usage.prompt_tokens, kind=kind, model=model, direction="prompt")
+        LLM_TOKENS.inc(cached_tokens(usage), kind=kind, model=model, direction="cached")
+        LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, kind=kind, model=model,
+                       direction="completion")
+
+    async def _attempt(self, method: Callable[..., Awaitable[Any]], kwargs: Dict,
+                       timeout: float, hedge: bool, observe: bool = True) -> Any:
+        started = time.monotonic()
+        delay = self.hedge_delay() if hedge else None
+        first = asyncio.create_task(method(**kwargs))
+        tasks = {first}
+        if delay is not None and delay < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.add(asyncio.create_task(method(**kwargs)))
+
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                remaining = started + timeout - time.monotonic()
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    result = winners[0].result()
+                    for extra in winners[1:]:
+                        await _discard(extra.result())
+                    if winners[0] is not first:
+                        self.stats["hedge_wins"] += 1
+                    if observe:
+                        self._latencies.append(time.monotonic() - started)
+                    return result
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def warm_up(self, connections: int = 2, timeout: float = 10.0) -> None:
+        """Open pooled connections (TCP + TLS) before the first real call.
+
+        Sends ``connections`` concurrent cheap requests; failures are only
+        logged, the bot starts either way.
+        """
+        if connections <= 0:
+            return
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self.client.models.list(), timeout) for _ in range(connections)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if len(errors) == len(results):
+            logger.warning(f"OpenAI warm-up failed: {type(errors[0]).__name__}: {errors[0]}")
+        else:
+            logger.info(
+                f"OpenAI connections warm ({len(results) - len(errors)}/{connections}) "
+                f"in {time.monotonic() - started:.2f}s"
+            )
+
+    async def close(self) -> None:
+        """Close pooled connections."""
+        await self.client.close()
+
+    def metrics(self) -> Dict:
+        delay = self.hedge_delay()
+        return {
+            **self.stats,
+            "circuit": self.breaker.state,
+            "p95_s": round(delay, 3) if delay is not None else None,
+        }
+
+
+async def _discard(result: Any) -> None:
+    """Close a losing hedged stream so its connection is released."""
+    close = getattr(result, "close", None)
+    if close is not None and asyncio.iscoroutinefunction(close):
+        await close()
+
+
+def build_http_client() -> httpx.AsyncClient:
+    """Connection pool for OpenAI calls, sized from config."""
+    http2 = config.openai_http2
+    if http2 and not HAS_H2:
+        logger.warning("OPENAI_HTTP2 needs the h2 package (pip install httpx[http2]); using HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=config.openai_max_connections,
+        max_keepalive_connections=config.openai_max_keepalive,
+        keepalive_expiry=config.openai_keepalive_expiry,
+    )
+    logger.info(
+        f"OpenAI HTTP pool: {config.openai_max_connections} connections, "
+        f"{config.openai_max_keepalive} kept alive for {config.openai_keepalive_expiry:.0f}s, "
+        f"{'HTTP/2' if http2 else 'HTTP/1.1'}"
+    )
+    # The deadline bounds the wait between bytes too (e.g. a stalled stream)
+    timeout = httpx.Timeout(config.llm_deadline, connect=CONNECT_TIMEOUT)
+    return DefaultAsyncHttpxClient(limits=limits, http2=http2, timeout=timeout)
+
+
+_llm_client: Optional[LLMClient] = None
+
+
+def get_llm_client() -> LLMClient:
+    """Process-wide resilient client built from config."""
+    global _llm_client
+    if _llm_client is None:
+        client = AsyncOpenAI(api_key=config.openai_api_key,
+                             base_url=config.openai_base_url or None,
+                             http_client=build_http_client())
+        _llm_client = LLMClient(
+            client,
+            deadline=config.llm_deadline,
+            max_attempts=config.llm_max_attempts,
+            hedge=config.llm_hedge,
+            breaker=CircuitBreaker(config.llm_breaker_threshold, config.llm_breaker_cooldown),
+        )
+    return _llm_client
@@ -0,0 +1,447 @@
+"""
+End-to-end load test against fake Telegram and OpenAI servers
+
+Usage:
+    python loadtest.py [--bot bot_advanced.py] [--rates 5,10,20,40] [--duration 30]
+                       [--llm-latency lognormal:0.8:0.5] [--tokens-per-second 50]
+                       [--reply-tokens 60] [--llm-error-rate 0] [--timeout 30]
+                       [--chats 2000] [--no-spawn] [--output results.json]
+
+Starts a fake Telegram Bot API (getUpdates long polling; sendMessage,
+editMessageText, sendVoice, sendChatAction and friends are accepted) and a
+fake OpenAI endpoint (chat completions, streamed or not, with latency drawn
+from a distribution), then runs the bot as a subprocess pointed at both via
+TELEGRAM_API_URL and OPENAI_BASE_URL. No real tokens or API calls are used.
+
+Synthetic users send text messages as a Poisson stream at each target rate
+in turn, one message in flight per chat. The end-to-end latency of a
+message runs from the moment the update is handed out by getUpdates to
+the first message the bot sends back to that chat, which is the first
+visible token for a streamed reply. Replies starting with ❌ count as
+errors and ⏳ as busy; unanswered messages time out. The first step whose
+throughput falls below 90% of the rate actually offered marks saturation.
+
+Latency specs: fixed:S, uniform:A:B, exp:MEAN, lognormal:MEDIAN:SIGMA (seconds).
+Voice traffic is not generated (it needs real audio and ffmpeg).
+Results are printed as JSON, like benchmark.py.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+TOKEN = "123456:loadtest"
+SATURATION_RATIO = 0.9
+
+MESSAGES = [
+    "hi",
+    "thanks!",
+    "what can you do?",
+    "How much does the premium plan cost per month?",
+    "Can you summarize the main differences between TCP and UDP for a beginner?",
+    "I'm planning a 3 day trip to Lisbon in October. What should I see, where should I "
+    "stay, and how do I get around without a car? I like food markets and old churches.",
+    "Here is my function:\n```\ndef f(x):\n    return x * 2\n```\nCan you add type hints?",
+]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Sampler for a latency spec such as ``lognormal:0.8:0.5``."""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+# ===== FAKE OPENAI =====
+
+class FakeOpenAI:
+    """Chat completions with configurable time to first token and token rate."""
+
+    def __init__(self, latency: Callable[[], float], tokens_per_second: float = 50.0,
+                 reply_tokens: int = 60, error_rate: float = 0.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.stats = {"requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_post("/v1/chat/completions", self.completions)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "fake", "object": "model"}]})
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        rng = random.Random(str(body.get("input")))
+        vector = [rng.uniform(-1, 1) for _ in range(8)]
+        return web.json_response({
+            "object": "list", "model": "fake",
+            "data": [{"object": "embedding", "index": 0, "embedding": vector}],
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        })
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        self.stats["in_flight"] += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        try:
+            await asyncio.sleep(self.latency())
+            if random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return web.json_response({"error": {"message": "injected failure"}}, status=500)
+            tokens = min(self.reply_tokens, body.get("max_tokens") or self.reply_tokens)
+            prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 4 for m in body["messages"])
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                     "total_tokens": prompt_tokens + tokens}
+            if body.get("stream"):
+                return await self._stream(request, body, tokens, usage)
+            await asyncio.sleep(tokens / self.tokens_per_second)
+            return web.json_response({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(["word"] * tokens)}}],
+                "usage": usage,
+            })
+        finally:
+            self.stats["in_flight"] -= 1
+
+    async def _stream(self, request: web.Request, body: Dict, tokens: int,
+                      usage: Dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body["model"]}
+        try:
+            for index in range(tokens):
+                if index:
+                    await asyncio.sleep(1 / self.tokens_per_second)
+                chunk = {**base, "choices": [{"index": 0, "delta": {"content": "word "}, "finish_reason": None}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk = {**base, "choices": [], "usage": usage}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionError:
+            pass  # the bot gave up on the stream
+        return response
+
+
+# ===== FAKE TELEGRAM =====
+
+class FakeTelegram:
+    """Bot API stand-in that hands out synthetic updates and times replies."""
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self._updates: List[Dict] = []
+        self._new_updates = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self.polling = asyncio.Event()
+        # chat id → (step, time the update was handed out or queued)
+        self.pending: Dict[int, List] = {}
+        self.results: Dict[int, Dict[str, list]] = {}
+        self.api_calls: Dict[str, int] = {}
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+    def _step(self, step: int) -> Dict[str, list]:
+        return self.results.setdefault(step, {"latencies": [], "ok": [], "error": [], "busy": [], "timeout": []})
+
+    def send_text(self, chat_id: int, text: str, step: int) -> None:
+        """Queue a user message for the bot."""
+        self._update_id += 1
+        self._message_id += 1
+        user = {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+        self._updates.append({
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+                "from": user,
+            },
+        })
+        self.pending[chat_id] = [step, time.monotonic(), False]
+        self._new_updates.set()
+
+    def expire(self) -> List[int]:
+        """Time out messages unanswered for too long; returns their chats."""
+        now = time.monotonic()
+        expired = [chat_id for chat_id, (_, sent, _) in self.pending.items() if now - sent > self.timeout]
+        for chat_id in expired:
+            step, _, _ = self.pending.pop(chat_id)
+            self._step(step)["timeout"].append(chat_id)
+        return expired
+
+    def _message(self, chat_id, text: str = "", message_id: Optional[int] = None) -> Dict:
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": int(chat_id), "type": "private"}}
+
+    def _reply_seen(self, chat_id: int, text: str) -> None:
+        entry = self.pending.pop(chat_id, None)
+        if entry is None:
+            return
+        step, sent, _ = entry
+        results = self._step(step)
+        results["latencies"].append(time.monotonic() - sent)
+        outcome = "error" if text.startswith("❌") else "busy" if text.startswith("⏳") else "ok"
+        results[outcome].append(chat_id)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.api_calls[method] = self.api_calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        if not params and request.query:
+            params = dict(request.query)
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_test_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in ("sendMessage", "sendVoice", "sendAudio", "sendPhoto", "sendDocument"):
+            chat_id = int(params.get("chat_id", 0))
+            text = str(params.get("text", ""))
+            self._reply_seen(chat_id, text)
+            result = self._message(chat_id, text)
+        elif method == "editMessageText":
+            result = self._message(params.get("chat_id", 0), str(params.get("text", "")),
+                                   int(params.get("message_id", 0)))
+        else:
+            # deleteWebhook, sendChatAction, setMyCommands, close, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params.get("timeout") or 0), 10))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        batch = self._updates[:limit]
+        now = time.monotonic()
+        for update in batch:
+            entry = self.pending.get(update["message"]["chat"]["id"])
+            if entry is not None and not entry[2]:
+                # Latency counts from delivery, not from when it was queued
+                entry[1], entry[2] = now, True
+        return batch
+
+
+# ===== LOAD GENERATION =====
+
+async def _run_step(telegram: FakeTelegram, step: int, rate: float, duration: float,
+                    chats: List[int], next_chat: List[int], max_chats: int) -> Dict:
+    """Poisson arrivals at ``rate``/s for ``duration`` seconds."""
+    sent = skipped = 0
+    started = time.monotonic()
+    deadline = started + duration
+    arrival = started
+    while True:
+        arrival += random.expovariate(rate)
+        if arrival >= deadline:
+            break
+        await asyncio.sleep(max(0.0, arrival - time.monotonic()))
+        for chat_id in telegram.expire():
+            chats.remove(chat_id)  # a late reply must not be credited to a new message
+        idle = [chat_id for chat_id in chats if chat_id not in telegram.pending]
+        if not idle and len(chats) < max_chats:
+            next_chat[0] += 1
+            chats.append(next_chat[0])
+            idle = [next_chat[0]]
+        if not idle:
+            skipped += 1  # every synthetic user is still waiting for a reply
+            continue
+        telegram.send_text(random.choice(idle), random.choice(MESSAGES), step)
+        sent += 1
+    return {"sent": sent, "skipped_all_chats_busy": skipped, "elapsed_s": time.monotonic() - started}
+
+
+def _summarize(rate: float, generated: Dict, results: Dict[str, list]) -> Dict:
+    latencies = results["latencies"]
+    answered = len(latencies)
+    sent = generated["sent"]
+    failed = len(results["error"]) + len(results["busy"]) + len(results["timeout"])
+    elapsed = generated["elapsed_s"]
+    throughput = len(results["ok"]) / elapsed if elapsed else 0.0
+    summary = {
+        "target_rate": rate,
+        "sent": sent,
+        "answered": answered,
+        "ok": len(results["ok"]),
+        "errors": len(results["error"]),
+        "busy": len(results["busy"]),
+        "timeouts": len(results["timeout"]),
+        "skipped_all_chats_busy": generated["skipped_all_chats_busy"],
+        "offered_per_s": round(sent / elapsed, 2) if elapsed else 0.0,
+        "throughput_per_s": round(throughput, 2),
+        "error_rate": round(failed / sent, 4) if sent else 0.0,
+    }
+    if latencies:
+        summary.update({
+            "latency_p50_s": round(_percentile(latencies, 0.50), 3),
+            "latency_p95_s": round(_percentile(latencies, 0.95), 3),
+            "latency_p99_s": round(_percentile(latencies, 0.99), 3),
+            "latency_max_s": round(max(latencies), 3),
+        })
+    return summary
+
+
+def _bot_env(telegram_url: str, openai_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "OPENAI_API_KEY": "sk-loadtest",
+        "TELEGRAM_API_URL": telegram_url,
+        "OPENAI_BASE_URL": openai_url,
+    })
+    # Synthetic users would otherwise trip the per-user limit; override to test it
+    env.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return env
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict:
+    telegram = FakeTelegram(timeout=args.timeout)
+    openai = FakeOpenAI(parse_latency(args.llm_latency), args.tokens_per_second,
+                        args.reply_tokens, args.llm_error_rate)
+    app = web.Application()
+    telegram.routes(app)
+    openai.routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    telegram_url = f"http://127.0.0.1:{args.port}"
+    openai_url = f"http://127.0.0.1:{args.port}/v1"
+
+    bot = None
+    log_path = args.bot_log or os.path.join(tempfile.gettempdir(), "loadtest_bot.log")
+    try:
+        if args.no_spawn:
+            print(f"Start the bot with TELEGRAM_API_URL={telegram_url} OPENAI_BASE_URL={openai_url} "
+                  f"TELEGRAM_BOT_TOKEN={TOKEN}", file=sys.stderr)
+        else:
+            log = open(log_path, "w")
+            bot = await asyncio.create_subprocess_exec(
+                sys.executable, args.bot, env=_bot_env(telegram_url, openai_url),
+                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=log, stderr=log,
+            )
+        await asyncio.wait_for(telegram.polling.wait(), args.startup_timeout)
+
+        chats: List[int] = []
+        next_chat = [100_000]
+        steps = []
+        for step, rate in enumerate(args.rates):
+            generated = await _run_step(telegram, step, rate, args.duration,
+                                        chats, next_chat, args.chats)
+            # Let this step's messages finish before the next one starts
+            while any(entry[0] == step for entry in telegram.pending.values()):
+                for chat_id in telegram.expire():
+                    chats.remove(chat_id)
+                await asyncio.sleep(0.1)
+            summary = _summarize(rate, generated, telegram._step(step))
+            steps.append(summary)
+            print(f"{rate}/s ({summary['offered_per_s']}/s offered) → {summary['throughput_per_s']}/s, "
+                  f"p95 {summary.get('latency_p95_s')}s, errors {summary['error_rate']:.1%}",
+                  file=sys.stderr)
+
+        # Let streamed replies finish before the bot is stopped
+        drain_deadline = time.monotonic() + args.timeout
+        while openai.stats["in_flight"] and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(1.0)
+
+        saturated = next((s["target_rate"] for s in steps
+                          if s["throughput_per_s"] < SATURATION_RATIO * s["offered_per_s"]), None)
+        return {
+            "bot": args.bot,
+            "llm_latency": args.llm_latency,
+            "tokens_per_second": args.tokens_per_second,
+            "reply_tokens": args.reply_tokens,
+            "llm_error_rate": args.llm_error_rate,
+            "duration_s": args.duration,
+            "steps": steps,
+            "saturation_rate": saturated,
+            "openai": openai.stats,
+            "telegram_calls": telegram.api_calls,
+            "bot_log": None if args.no_spawn else log_path,
+        }
+    finally:
+        if bot is not None and bot.returncode is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(bot.wait(), 30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        await runner.cleanup()
+
+
+def _float_list(value: str) -> List[float]:
+    return [float(item) for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bot", default="bot_advanced.py", help="Bot script to run (bot.py, supervisor.py, ...)")
+    parser.add_argument("--rates", default="5,10,20,40", type=_float_list, help="Messages per second, one step each")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per step")
+    parser.add_argument("--llm-latency", default="lognormal:0.8:0.5", help="Time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of calls answered with a 500")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds before a message counts as lost")
+    parser.add_argument("--chats", type=int, default=2000, help="Most synthetic chats at once")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--no-spawn", action="store_true", help="Use a bot started by hand")
+    parser.add_argument("--bot-log", default=None, help="Where the bot's output goes")
+    parser.add_argument("--output", default=None, help="Also write the JSON here")
+
+    args = parser.parse_args()
+    result = asyncio.run(run_load_test(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
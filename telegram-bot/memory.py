@@ -1,13 +1,28 @@
 """
-Memory management with support for in-memory and Redis backends
+Memory management with support for in-memory, Redis and SQLite backends
 """
 
+import os
+import sys
+import mmap
 import json
+import pickle
+import struct
+import time
+import uuid
+import queue
+import sqlite3
+import asyncio
 import logging
-from typing import List, Dict, Optional, Any
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import OrderedDict, deque
+from typing import List, Dict, Optional, Any, Sequence, Tuple, Callable, Awaitable, Set
+from datetime import datetime, timezone
 from abc import ABC, abstractmethod
 from config import config
+from prompts import CHAT, system_prompt
 
 logger = logging.getLogger(__name__)
 
@@ -18,22 +33,165 @@ try:
 except ImportError:
     HAS_REDIS = False
 
+# Optional tokenizer; falls back to a character-based estimate
+try:
+    import tiktoken  # type: ignore
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+# Conversations expire after 30 days without activity
+HISTORY_TTL_SECONDS = 30 * 24 * 3600
+
+# Pub/sub channel used to tell other workers a chat changed
+INVALIDATION_CHANNEL = "memory:invalidate"
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_MISSING = object()
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """tiktoken encoding for the model, or None to estimate.
+
+    Cached either way, so a failed load (the first one may download the BPE
+    file) is not retried on every message.
+    """
+    if not HAS_TIKTOKEN:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(config.model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+
+def load_tokenizer() -> None:
+    """Load the tokenizer now; blocking, so call it off the event loop at startup."""
+    _get_encoding()
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens ``text`` costs in a prompt."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+@lru_cache(maxsize=64)
+def _prompt_tokens(text: str) -> int:
+    """Cached count for system prompts, which repeat on every turn."""
+    return count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+class Message:
+    """One stored chat message.
+    
+    Uses ``__slots__`` and an epoch-float timestamp instead of a dict with an
+    ISO-8601 string, which roughly halves the per-message overhead. Converted
+    to the OpenAI ``{"role", "content"}`` shape only when a prompt is built.
+    The token count is computed once on creation and stored with the message.
+    """
+    
+    __slots__ = ("role", "content", "timestamp", "tokens")
+    
+    def __init__(self, role: str, content: str, timestamp: Optional[float] = None,
+                 tokens: Optional[int] = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.tokens = count_tokens(content) if tokens is None else tokens
+    
+    def to_openai(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+    
+    def same_as(self, other: "Message") -> bool:
+        """True if ``other`` is the same stored message (role, content and time)."""
+        return (self.timestamp == other.timestamp and self.role == other.role
+                and self.content == other.content)
+    
+    @property
+    def iso_timestamp(self) -> str:
+        return datetime.fromtimestamp(self.timestamp, timezone.utc).isoformat(timespec="seconds")
+    
+    def encode(self) -> str:
+        """Serialize as a compact JSON array."""
+        return json.dumps(
+            [self.role, self.content, self.timestamp, self.tokens], separators=(",", ":")
+        )
+    
+    @classmethod
+    def decode(cls, data: str) -> "Message":
+        return cls.from_json(json.loads(data))
+    
+    @classmethod
+    def from_json(cls, value: Any) -> "Message":
+        """Build from a decoded array, or a legacy ``{"role", "content", "timestamp"}`` dict."""
+        if isinstance(value, dict):
+            stamp = value.get("timestamp")
+            if isinstance(stamp, str):
+                stamp = datetime.fromisoformat(stamp).replace(tzinfo=timezone.utc).timestamp()
+            return cls(value["role"], value["content"], stamp)
+        return cls(*value)
+    
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content[:30]!r}, {self.timestamp})"
+
+
+def _find_boundary(history: Sequence[Message], through: Message) -> int:
+    """Index of the newest message in ``history`` that is ``through``, or -1."""
+    for index in range(len(history) - 1, -1, -1):
+        if history[index].same_as(through):
+            return index
+    return -1
+
 
 class MemoryBackend(ABC):
     """Abstract memory storage backend."""
     
     @abstractmethod
-    async def get_history(self, chat_id: int) -> List[Dict]:
+    async def get_history(self, chat_id: int) -> List[Message]:
         pass
     
     @abstractmethod
     async def add_message(self, chat_id: int, role: str, content: str) -> None:
         pass
     
+    async def add_messages(self, chat_id: int, messages: Sequence[Tuple[str, str]]) -> None:
+        """Append several ``(role, content)`` messages in one batched write.
+        
+        Backends with per-call overhead should override this; the default
+        simply appends one message at a time.
+        """
+        for role, content in messages:
+            await self.add_message(chat_id, role, content)
+    
     @abstractmethod
     async def clear_history(self, chat_id: int) -> None:
         pass
     
+    async def trim_history(self, chat_id: int, through: Message) -> None:
+        """Remove the oldest messages up to and including ``through``.
+        
+        Messages are matched by identity, not position: if appends have
+        already pushed ``through`` out of the history, nothing is removed.
+        The default rewrites the history; backends should override this with
+        something that cannot race with concurrent appends.
+        """
+        history = await self.get_history(chat_id)
+        index = _find_boundary(history, through)
+        if index < 0:
+            return
+        await self.clear_history(chat_id)
+        await self.add_messages(chat_id, [(msg.role, msg.content) for msg in history[index + 1:]])
+    
     @abstractmethod
     async def get_metadata(self, chat_id: int, key: str) -> Optional[Any]:
         pass
@@ -41,117 +199,1074 @@ class MemoryBackend(ABC):
     @abstractmethod
     async def set_metadata(self, chat_id: int, key: str, value: Any) -> None:
         pass
+    
+    @abstractmethod
+    async def get_all_metadata(self, chat_id: int) -> Dict[str, Any]:
+        """Every metadata field stored for ``chat_id``."""
+        pass
+    
+    async def get_metadata_many(self, chat_ids: Sequence[int], key: str) -> Dict[int, Any]:
+        """Read one metadata field for many chats. Missing values map to None.
+        
+        Backends should override this to fetch in batches; the default does
+        one read per chat.
+        """
+        return {chat_id: await self.get_metadata(chat_id, key) for chat_id in chat_ids}
+    
+    def add_invalidation_listener(self, callback: Callable[[Optional[int]], None]) -> None:
+        """Register ``callback(chat_id)`` for writes made by other processes.
+        
+        ``None`` means every chat may have changed. Single-process backends
+        never call it.
+        """
+        pass
+    
+    @property
+    def pushes_invalidations(self) -> bool:
+        """True while every outside write is guaranteed to reach the listeners."""
+        return True
+    
+    async def close(self) -> None:
+        """Release connections and background tasks."""
+        pass
+
+
+class LRUCache:
+    """Small bounded mapping that evicts the least recently used entry."""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+    
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+    
+    def put(self, key: Any, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key: Any) -> None:
+        self._data.pop(key, None)
+    
+    def clear(self) -> None:
+        self._data.clear()
+    
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _ChatState:
+    """Everything InMemoryBackend keeps for one chat."""
+    
+    __slots__ = ("history", "metadata", "last_seen", "size")
+    
+    def __init__(self, max_history: int):
+        self.history: deque = deque(maxlen=max_history)
+        self.metadata: Dict[str, Any] = {}
+        self.last_seen = time.time()
+        self.size = 0  # approximate bytes held by message contents
 
 
 class InMemoryBackend(MemoryBackend):
-    """In-memory storage backend (development/single-instance)."""
+    """In-memory storage backend (development/single-instance).
+    
+    Memory stays bounded however many chats have ever written. Each chat's
+    history is a fixed-size ring buffer, and at most ``max_chats`` chats are
+    kept, evicting the least recently used one. Chats idle for longer than
+    ``idle_ttl`` seconds are dropped by a background sweeper. Zero disables
+    either limit.
     
-    def __init__(self, max_history: int = 6):
-        self.history: Dict[int, List[Dict]] = {}
-        self.metadata: Dict[int, Dict[str, Any]] = {}
+    With a ``snapshot_path``, state is written every ``snapshot_interval``
+    seconds (and on close) to a compact binary file, via a temp file and an
+    atomic rename. On startup only the snapshot's index is read. The file is
+    memory-mapped and each chat is unpickled the first time it is touched, so
+    the bot serves traffic straight away however large the snapshot is.
+    """
+    
+    SNAPSHOT_MAGIC = b"TGMEMv1\0"
+    # Footer: index offset, index length, magic
+    SNAPSHOT_FOOTER = struct.Struct("<QQ8s")
+    
+    def __init__(self, max_history: int = 6, max_chats: int = 0,
+                 idle_ttl: int = 0, sweep_interval: int = 60,
+                 snapshot_path: Optional[str] = None, snapshot_interval: int = 60):
         self.max_history = max_history
-        logger.info("InMemoryBackend initialized")
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        # Ordered from least to most recently used
+        self._chats: "OrderedDict[int, _ChatState]" = OrderedDict()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._messages = 0
+        self._bytes = 0
+        self._evictions = 0
+        self._expirations = 0
+        
+        # Snapshot state: chats still sitting unparsed in the mapped file
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._lazy: Dict[int, Tuple[int, int]] = {}
+        self._snapshot_file = None
+        self._snapshot_map: Optional[mmap.mmap] = None
+        self._snapshotter: Optional[asyncio.Task] = None
+        self._snapshot_lock = asyncio.Lock()
+        self._dirty = False
+        if snapshot_path and os.path.exists(snapshot_path):
+            self._open_snapshot()
+        
+        logger.info(
+            f"InMemoryBackend initialized (max_chats={max_chats}, idle_ttl={idle_ttl}s, "
+            f"snapshot={snapshot_path or 'off'}, restorable_chats={len(self._lazy)})"
+        )
     
-    async def get_history(self, chat_id: int) -> List[Dict]:
-        return self.history.get(chat_id, [])
+    def _peek(self, chat_id: int) -> Optional[_ChatState]:
+        state = self._chats.get(chat_id)
+        if state is None and chat_id in self._lazy:
+            state = self._restore(chat_id)
+        return state
     
-    async def add_message(self, chat_id: int, role: str, content: str) -> None:
-        if chat_id not in self.history:
-            self.history[chat_id] = []
+    def _lookup(self, chat_id: int) -> Optional[_ChatState]:
+        state = self._peek(chat_id)
+        if state is not None:
+            state.last_seen = time.time()
+            self._chats.move_to_end(chat_id)
+        return state
+    
+    def _ensure(self, chat_id: int) -> _ChatState:
+        state = self._lookup(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState(self.max_history)
+            self._evict_overflow(chat_id)
+        if self.idle_ttl and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+        if self.snapshot_path and self._snapshotter is None:
+            self._snapshotter = asyncio.create_task(self._snapshot_loop())
+        self._dirty = True
+        return state
+    
+    def _evict_overflow(self, keep: int) -> None:
+        """Evict least recently used chats, never ``keep``, down to max_chats."""
+        while self.max_chats and len(self._chats) > self.max_chats:
+            victims = iter(self._chats)
+            victim = next(victims)
+            if victim == keep:
+                victim = next(victims)
+            self._drop(victim)
+            self._evictions += 1
+    
+    def _drop(self, chat_id: int) -> None:
+        self._lazy.pop(chat_id, None)
+        state = self._chats.pop(chat_id, None)
+        if state is not None:
+            self._messages -= len(state.history)
+            self._bytes -= state.size
+            self._dirty = True
+    
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.expire_idle()
+    
+    def expire_idle(self) -> int:
+        """Drop chats idle for longer than ``idle_ttl``. Returns the count."""
+        cutoff = time.time() - self.idle_ttl
+        expired = 0
+        # LRU order means expired chats are all at the front
+        while self._chats:
+            chat_id, state = next(iter(self._chats.items()))
+            if state.last_seen >= cutoff:
+                break
+            self._drop(chat_id)
+            expired += 1
+        self._expirations += expired
+        if expired:
+            logger.debug(f"Expired {expired} idle chats")
+        return expired
+    
+    def stats(self) -> Dict[str, int]:
+        """Current footprint and eviction counters."""
+        return {
+            "chats": len(self._chats),
+            "messages": self._messages,
+            "content_bytes": self._bytes,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+            "snapshot_pending": len(self._lazy),
+        }
+    
+    # ----- snapshots -----
+    
+    def _open_snapshot(self) -> None:
+        """Map the snapshot file and read its index; records stay unparsed."""
+        try:
+            self._snapshot_file = open(self.snapshot_path, "rb")
+            self._snapshot_map = mmap.mmap(self._snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self._snapshot_map
+            index_offset, index_length, magic = self.SNAPSHOT_FOOTER.unpack_from(
+                data, len(data) - self.SNAPSHOT_FOOTER.size
+            )
+            if magic != self.SNAPSHOT_MAGIC or data[:len(self.SNAPSHOT_MAGIC)] != self.SNAPSHOT_MAGIC:
+                raise ValueError("bad magic")
+            self._lazy = pickle.loads(data[index_offset:index_offset + index_length])
+        except Exception as e:
+            logger.error(f"Ignoring unreadable snapshot {self.snapshot_path}: {e}")
+            self._close_snapshot()
+            self._lazy = {}
+    
+    def _close_snapshot(self) -> None:
+        if self._snapshot_map is not None:
+            self._snapshot_map.close()
+            self._snapshot_map = None
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+            self._snapshot_file = None
+    
+    def _restore(self, chat_id: int) -> Optional[_ChatState]:
+        """Parse one chat out of the mapped snapshot."""
+        offset, length = self._lazy.pop(chat_id)
+        history, metadata, last_seen = pickle.loads(self._snapshot_map[offset:offset + length])
+        if self.idle_ttl and last_seen < time.time() - self.idle_ttl:
+            self._expirations += 1
+            return None
         
-        self.history[chat_id].append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        state = _ChatState(self.max_history)
+        state.history.extend(Message(*fields) for fields in history)
+        state.metadata = metadata
+        state.last_seen = last_seen
+        state.size = sum(sys.getsizeof(msg.content) for msg in state.history)
+        self._messages += len(state.history)
+        self._bytes += state.size
         
-        # Keep only last N messages
-        self.history[chat_id] = self.history[chat_id][-self.max_history:]
+        # Restored chats enter as least recent; a lookup moves them forward
+        self._chats[chat_id] = state
+        self._chats.move_to_end(chat_id, last=False)
+        self._evict_overflow(chat_id)
+        return state
+    
+    async def _snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                logger.error(f"Snapshot to {self.snapshot_path} failed: {e}")
+    
+    async def snapshot(self) -> None:
+        """Write all chats to ``snapshot_path`` without blocking the loop."""
+        async with self._snapshot_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            # Messages are never mutated, so shallow copies are a stable view
+            loaded = [
+                (chat_id, list(state.history), dict(state.metadata), state.last_seen)
+                for chat_id, state in self._chats.items()
+            ]
+            pending = dict(self._lazy)
+            
+            tmp_path = f"{self.snapshot_path}.tmp"
+            write = asyncio.ensure_future(
+                asyncio.to_thread(self._write_snapshot, tmp_path, loaded, pending)
+            )
+            try:
+                # The thread can't be interrupted and reads the mapped file, so
+                # even a cancelled snapshot waits for it before letting go
+                index = await asyncio.shield(write)
+            except BaseException:
+                await asyncio.wait([write])
+                self._dirty = True
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            
+            # Swap files, then point still-unparsed chats at the new copy
+            unparsed = [chat_id for chat_id in self._lazy if chat_id in index]
+            self._close_snapshot()
+            os.replace(tmp_path, self.snapshot_path)
+            self._open_snapshot()
+            if self._snapshot_map is not None:
+                self._lazy = {chat_id: index[chat_id] for chat_id in unparsed}
+            logger.debug(f"Snapshot written: {len(index)} chats")
+    
+    def _write_snapshot(self, path: str, loaded: List[tuple],
+                        pending: Dict[int, Tuple[int, int]]) -> Dict[int, Tuple[int, int]]:
+        index: Dict[int, Tuple[int, int]] = {}
+        with open(path, "wb") as f:
+            f.write(self.SNAPSHOT_MAGIC)
+            for chat_id, history, metadata, last_seen in loaded:
+                record = pickle.dumps((
+                    [(msg.role, msg.content, msg.timestamp, msg.tokens) for msg in history],
+                    metadata,
+                    last_seen,
+                ), protocol=pickle.HIGHEST_PROTOCOL)
+                index[chat_id] = (f.tell(), len(record))
+                f.write(record)
+            # Chats never touched since startup are copied over unparsed
+            for chat_id, (offset, length) in pending.items():
+                index[chat_id] = (f.tell(), length)
+                f.write(self._snapshot_map[offset:offset + length])
+            
+            index_data = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+            index_offset = f.tell()
+            f.write(index_data)
+            f.write(self.SNAPSHOT_FOOTER.pack(index_offset, len(index_data), self.SNAPSHOT_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        return index
+    
+    # ----- history -----
+    
+    async def get_history(self, chat_id: int) -> List[Message]:
+        state = self._lookup(chat_id)
+        return list(state.history) if state else []
+    
+    async def add_message(self, chat_id: int, role: str, content: str) -> None:
+        await self.add_messages(chat_id, [(role, content)])
+    
+    async def add_messages(self, chat_id: int, messages: Sequence[Tuple[str, str]]) -> None:
+        state = self._ensure(chat_id)
+        history = state.history
+        timestamp = time.time()
+        
+        before = state.size
+        for role, content in messages:
+            if len(history) == history.maxlen:
+                state.size -= sys.getsizeof(history[0].content)
+                self._messages -= 1
+            # The ring buffer drops the oldest message by itself
+            history.append(Message(role, content, timestamp))
+            state.size += sys.getsizeof(content)
+            self._messages += 1
+        self._bytes += state.size - before
     
     async def clear_history(self, chat_id: int) -> None:
-        self.history.pop(chat_id, None)
+        state = self._peek(chat_id)
+        if state is not None:
+            self._messages -= len(state.history)
+            self._bytes -= state.size
+            state.history.clear()
+            state.size = 0
+            self._dirty = True
+    
+    async def trim_history(self, chat_id: int, through: Message) -> None:
+        state = self._peek(chat_id)
+        if state is None:
+            return
+        for _ in range(_find_boundary(state.history, through) + 1):
+            msg = state.history.popleft()
+            state.size -= sys.getsizeof(msg.content)
+            self._bytes -= sys.getsizeof(msg.content)
+            self._messages -= 1
+        self._dirty = True
+    
+    # ----- metadata -----
     
     async def get_metadata(self, chat_id: int, key: str) -> Optional[Any]:
-        return self.metadata.get(chat_id, {}).get(key)
+        state = self._lookup(chat_id)
+        return state.metadata.get(key) if state else None
     
     async def set_metadata(self, chat_id: int, key: str, value: Any) -> None:
-        if chat_id not in self.metadata:
-            self.metadata[chat_id] = {}
-        self.metadata[chat_id][key] = value
+        self._ensure(chat_id).metadata[key] = value
+    
+    async def get_all_metadata(self, chat_id: int) -> Dict[str, Any]:
+        state = self._lookup(chat_id)
+        return dict(state.metadata) if state else {}
+    
+    async def get_metadata_many(self, chat_ids: Sequence[int], key: str) -> Dict[int, Any]:
+        # Bulk reads are for admin jobs; don't let them reorder the LRU
+        result = {}
+        for chat_id in chat_ids:
+            state = self._peek(chat_id)
+            result[chat_id] = state.metadata.get(key) if state else None
+        return result
+    
+    async def close(self) -> None:
+        tasks = [task for task in (self._sweeper, self._snapshotter) if task is not None]
+        for task in tasks:
+            task.cancel()
+        # A running snapshot finishes with the mapped file before it is closed
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sweeper = self._snapshotter = None
+        if self.snapshot_path:
+            await self.snapshot()
+        self._close_snapshot()
+
+
+def _is_wrong_type(error: Exception) -> bool:
+    """Whether a Redis error is WRONGTYPE, i.e. a key still in the legacy layout.
+
+    Pipelines prefix the server's message with the failing command.
+    """
+    return "WRONGTYPE" in str(error)
 
 
 class RedisBackend(MemoryBackend):
-    """Redis-backed storage backend (production/distributed)."""
+    """Redis-backed storage backend (production/distributed).
+    
+    History is stored as a Redis list with one JSON-encoded message per
+    element, so appending is an RPUSH rather than a read-modify-write of the
+    whole conversation. Append, trim and TTL refresh are sent as a single
+    MULTI/EXEC pipeline: one round trip, and concurrent writers for the same
+    chat can no longer overwrite each other.
+    
+    Older deployments stored ``history:{chat_id}`` as one JSON string. Such
+    keys are converted in place the first time they are touched, or all at
+    once with :meth:`migrate_legacy_history`.
     
-    def __init__(self, redis_url: str, max_history: int = 6):
+    With ``cache_size`` > 0 a process-local LRU of per-chat history and
+    metadata sits in front of Redis. Every write publishes the chat id on
+    :data:`INVALIDATION_CHANNEL` inside the same pipeline; other workers drop
+    their copy when they see it. While the subscription is down the cache is
+    bypassed, so a lost feed costs Redis reads, never stale answers. The
+    same feed drives any :meth:`add_invalidation_listener` callbacks.
+    """
+    
+    def __init__(self, redis_url: str, max_history: int = 6,
+                 ttl: int = HISTORY_TTL_SECONDS, cache_size: int = 0):
         if not HAS_REDIS:
             logger.error("redis package not installed. Use: pip install redis")
             raise ImportError("redis package not installed")
         self.max_history = max_history
+        self.ttl = ttl
         self.url = redis_url
         self._client = None
-        logger.info("RedisBackend configured")
+        
+        # Read-through cache state
+        self.cache_size = cache_size
+        self._history_cache = LRUCache(cache_size)
+        self._meta_cache = LRUCache(cache_size)
+        self._worker_id = uuid.uuid4().hex[:12]
+        self._listener: Optional[asyncio.Task] = None
+        self._listeners: List[Callable[[Optional[int]], None]] = []
+        self._cache_live = False
+        self._invalidations = 0
+        self.stats = {
+            "history_hits": 0,
+            "history_misses": 0,
+            "metadata_hits": 0,
+            "metadata_misses": 0,
+            "invalidations": 0,
+        }
+        logger.info(f"RedisBackend configured (cache_size={cache_size})")
     
     async def _get_client(self):
         """Get or create Redis client."""
         if self._client is None:
             self._client = redis.from_url(self.url, decode_responses=True)
+        if self._pubsub_enabled and self._listener is None:
+            self._listener = asyncio.create_task(self._listen_invalidations())
         return self._client
     
-    async def get_history(self, chat_id: int) -> List[Dict]:
+    @staticmethod
+    def _history_key(chat_id: int) -> str:
+        return f"history:{chat_id}"
+    
+    @staticmethod
+    def _meta_key(chat_id: int) -> str:
+        return f"meta:{chat_id}"
+    
+    # ----- read-through cache -----
+    
+    @property
+    def _cache_enabled(self) -> bool:
+        return self.cache_size > 0 and self._cache_live
+    
+    @property
+    def _pubsub_enabled(self) -> bool:
+        return self.cache_size > 0 or bool(self._listeners)
+    
+    @property
+    def pushes_invalidations(self) -> bool:
+        return self._cache_live
+    
+    def add_invalidation_listener(self, callback: Callable[[Optional[int]], None]) -> None:
+        self._listeners.append(callback)
+    
+    def _invalidate(self, chat_id: int) -> None:
+        self._invalidations += 1
+        self.stats["invalidations"] += 1
+        self._history_cache.pop(chat_id)
+        self._meta_cache.pop(chat_id)
+        for callback in self._listeners:
+            callback(chat_id)
+    
+    def _publish(self, pipe, chat_id: int) -> None:
+        """Queue an invalidation notice on a write pipeline."""
+        if self._pubsub_enabled:
+            pipe.publish(INVALIDATION_CHANNEL, f"{self._worker_id}:{chat_id}")
+    
+    async def _listen_invalidations(self) -> None:
+        """Drop cached chats that other workers have written to."""
+        while True:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                self._cache_live = True
+                async for message in pubsub.listen():
+                    worker_id, _, chat_id = message["data"].partition(":")
+                    if worker_id != self._worker_id:
+                        self._invalidate(int(chat_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation feed lost, bypassing cache: {e}")
+            finally:
+                self._cache_live = False
+                self._history_cache.clear()
+                self._meta_cache.clear()
+                for callback in self._listeners:
+                    callback(None)
+                await pubsub.aclose()
+            await asyncio.sleep(1)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the read-through cache."""
+        return {
+            **self.stats,
+            "live": self._cache_live,
+            "cached_chats": len(self._history_cache),
+        }
+    
+    # ----- history -----
+    
+    async def get_history(self, chat_id: int) -> List[Message]:
         client = await self._get_client()
-        key = f"history:{chat_id}"
-        data = await client.get(key)
-        return json.loads(data) if data else []
+        if self._cache_enabled:
+            cached = self._history_cache.get(chat_id)
+            if cached is not None:
+                self.stats["history_hits"] += 1
+                return list(cached)
+            self.stats["history_misses"] += 1
+        
+        generation = self._invalidations
+        key = self._history_key(chat_id)
+        try:
+            entries = await client.lrange(key, 0, -1)
+        except redis.ResponseError as e:
+            if not _is_wrong_type(e):
+                raise
+            # Legacy string layout: convert and read again
+            await self._migrate_key(client, key)
+            entries = await client.lrange(key, 0, -1)
+        history = [Message.decode(entry) for entry in entries]
+        
+        # Skip filling if an invalidation raced with the read
+        if self._cache_enabled and generation == self._invalidations:
+            self._history_cache.put(chat_id, history)
+        return list(history)
     
     async def add_message(self, chat_id: int, role: str, content: str) -> None:
+        await self.add_messages(chat_id, [(role, content)])
+    
+    async def add_messages(self, chat_id: int, messages: Sequence[Tuple[str, str]]) -> None:
         client = await self._get_client()
-        key = f"history:{chat_id}"
+        key = self._history_key(chat_id)
+        timestamp = time.time()
+        new = [Message(role, content, timestamp) for role, content in messages]
+        entries = [msg.encode() for msg in new]
         
-        history = await self.get_history(chat_id)
-        history.append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        try:
+            await self._append(client, chat_id, key, *entries)
+        except redis.ResponseError as e:
+            if not _is_wrong_type(e):
+                raise
+            await self._migrate_key(client, key)
+            await self._append(client, chat_id, key, *entries)
+        
+        # Write-through so the next turn on this worker is a cache hit
+        cached = self._history_cache.get(chat_id)
+        if cached is not None:
+            self._history_cache.put(chat_id, (cached + new)[-self.max_history:])
+    
+    async def _append(self, client, chat_id: int, key: str, *entries: str) -> None:
+        """RPUSH + LTRIM + EXPIRE in one atomic round trip."""
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *entries)
+            pipe.ltrim(key, -self.max_history, -1)
+            pipe.expire(key, self.ttl)
+            # Metadata lives exactly as long as the conversation
+            pipe.expire(self._meta_key(chat_id), self.ttl)
+            self._publish(pipe, chat_id)
+            await pipe.execute()
+    
+    async def _migrate_key(self, client, key: str) -> None:
+        """Convert a legacy JSON-string history key into a list."""
+        async def convert(pipe) -> None:
+            if await pipe.type(key) != "string":
+                return
+            legacy = json.loads(await pipe.get(key) or "[]")
+            ttl = await pipe.ttl(key)
+            pipe.multi()
+            pipe.delete(key)
+            if legacy:
+                pipe.rpush(key, *[
+                    Message.from_json(msg).encode() for msg in legacy[-self.max_history:]
+                ])
+                pipe.expire(key, ttl if ttl > 0 else self.ttl)
         
-        history = history[-self.max_history:]
-        await client.set(key, json.dumps(history))
-        await client.expire(key, 30 * 24 * 3600)  # 30 days
+        # WATCH guards against another worker migrating the same key
+        await client.transaction(convert, key)
+        logger.info(f"Migrated legacy history key {key} to list layout")
+    
+    async def migrate_legacy_history(self, batch_size: int = 500) -> int:
+        """Convert every legacy ``history:*`` string key. Returns the count."""
+        client = await self._get_client()
+        migrated = 0
+        async for key in client.scan_iter(match="history:*", count=batch_size, _type="string"):
+            await self._migrate_key(client, key)
+            migrated += 1
+        return migrated
     
     async def clear_history(self, chat_id: int) -> None:
         client = await self._get_client()
-        key = f"history:{chat_id}"
-        await client.delete(key)
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._history_key(chat_id))
+            self._publish(pipe, chat_id)
+            await pipe.execute()
+        self._history_cache.pop(chat_id)
+    
+    async def trim_history(self, chat_id: int, through: Message) -> None:
+        client = await self._get_client()
+        key = self._history_key(chat_id)
+        
+        async def trim(pipe) -> None:
+            entries = await pipe.lrange(key, 0, -1)
+            index = _find_boundary([Message.decode(entry) for entry in entries], through)
+            pipe.multi()
+            if index >= 0:
+                pipe.ltrim(key, index + 1, -1)
+            self._publish(pipe, chat_id)
+        
+        # WATCH retries the trim if an append lands between the read and LTRIM,
+        # so the boundary index always refers to the list being trimmed
+        await client.transaction(trim, key)
+        self._history_cache.pop(chat_id)
+    
+    # ----- metadata -----
+    #
+    # Each chat's metadata is one hash, ``meta:{chat_id}``, with a JSON value
+    # per field and the same TTL as its history. Fields written by older
+    # versions as ``meta:{chat_id}:{key}`` strings are still read, and are
+    # moved into the hash when found or by migrate_legacy_metadata().
     
     async def get_metadata(self, chat_id: int, key: str) -> Optional[Any]:
         client = await self._get_client()
-        meta_key = f"meta:{chat_id}:{key}"
-        data = await client.get(meta_key)
-        return json.loads(data) if data else None
+        if self._cache_enabled:
+            value = self._meta_cache.get(chat_id, {}).get(key, _MISSING)
+            if value is not _MISSING:
+                self.stats["metadata_hits"] += 1
+                return value
+            self.stats["metadata_misses"] += 1
+        
+        generation = self._invalidations
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.hget(self._meta_key(chat_id), key)
+            pipe.get(f"meta:{chat_id}:{key}")
+            data, legacy = await pipe.execute()
+        if data is None and legacy is not None:
+            data = legacy
+            await self._store_metadata(client, chat_id, {key: legacy})
+        value = json.loads(data) if data else None
+        
+        if self._cache_enabled and generation == self._invalidations:
+            fields = self._meta_cache.get(chat_id)
+            if fields is None:
+                fields = {}
+                self._meta_cache.put(chat_id, fields)
+            fields[key] = value
+        return value
     
     async def set_metadata(self, chat_id: int, key: str, value: Any) -> None:
         client = await self._get_client()
-        meta_key = f"meta:{chat_id}:{key}"
-        await client.set(meta_key, json.dumps(value))
+        await self._store_metadata(client, chat_id, {key: None if value is None else json.dumps(value)})
+        
+        fields = self._meta_cache.get(chat_id)
+        if fields is not None:
+            fields[key] = value
+    
+    async def _store_metadata(self, client, chat_id: int, fields: Dict[str, Optional[str]]) -> None:
+        """Write encoded fields (None deletes) and drop their legacy keys."""
+        meta_key = self._meta_key(chat_id)
+        async with client.pipeline(transaction=True) as pipe:
+            for key, data in fields.items():
+                if data is None:
+                    pipe.hdel(meta_key, key)
+                else:
+                    pipe.hset(meta_key, key, data)
+                pipe.delete(f"meta:{chat_id}:{key}")
+            pipe.expire(meta_key, self.ttl)
+            self._publish(pipe, chat_id)
+            await pipe.execute()
+    
+    async def get_all_metadata(self, chat_id: int) -> Dict[str, Any]:
+        client = await self._get_client()
+        fields = await client.hgetall(self._meta_key(chat_id))
+        return {key: json.loads(data) for key, data in fields.items()}
+    
+    async def get_metadata_many(self, chat_ids: Sequence[int], key: str,
+                                batch_size: int = 1000) -> Dict[int, Any]:
+        """One pipelined round trip per ``batch_size`` chats."""
+        client = await self._get_client()
+        result: Dict[int, Any] = {}
+        for start in range(0, len(chat_ids), batch_size):
+            batch = chat_ids[start:start + batch_size]
+            async with client.pipeline(transaction=False) as pipe:
+                for chat_id in batch:
+                    pipe.hget(self._meta_key(chat_id), key)
+                    pipe.get(f"meta:{chat_id}:{key}")
+                replies = await pipe.execute()
+            for i, chat_id in enumerate(batch):
+                data = replies[2 * i] or replies[2 * i + 1]
+                result[chat_id] = json.loads(data) if data else None
+        return result
+    
+    async def migrate_legacy_metadata(self, batch_size: int = 500) -> int:
+        """Move every legacy ``meta:{chat_id}:{key}`` string into its hash."""
+        client = await self._get_client()
+        migrated = 0
+        async for legacy_key in client.scan_iter(match="meta:*:*", count=batch_size, _type="string"):
+            _, chat_id, key = legacy_key.split(":", 2)
+            data = await client.get(legacy_key)
+            if data is not None:
+                await self._store_metadata(client, int(chat_id), {key: data})
+                migrated += 1
+        return migrated
+    
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class SQLiteBackend(MemoryBackend):
+    """Durable single-node backend on SQLite in WAL mode.
+    
+    Survives restarts without running Redis. There is nothing to load on
+    startup; reads are served straight from disk through an index on
+    ``(chat_id, id)``.
+    
+    All writes go through one dedicated writer thread. It drains whatever
+    has queued up, up to ``batch_size`` jobs, and commits them in a single
+    transaction, so a burst of turns costs one fsync. Each job runs in its
+    own savepoint so one failure does not take the batch down. Reads run
+    on a small thread pool with a connection per thread; WAL lets them
+    proceed while the writer commits.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            tokens INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, id);
+        CREATE TABLE IF NOT EXISTS metadata (
+            chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, path: str, max_history: int = 6, batch_size: int = 256,
+                 readers: int = 4):
+        self.path = path
+        self.max_history = max_history
+        self.batch_size = batch_size
+        
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        conn.close()
+        
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self._writer.start()
+        self._local = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []  # one per reader thread, closed on close()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-reader")
+        logger.info(f"SQLiteBackend initialized at {path}")
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+    
+    # ----- threading -----
+    
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._jobs.put(None)
+                    break
+                batch.append(job)
+            
+            results = []
+            conn.execute("BEGIN")
+            for fn, future, loop in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, loop, fn(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, loop, None, e))
+            try:
+                conn.execute("COMMIT")
+            except Exception as e:
+                conn.execute("ROLLBACK")
+                results = [(future, loop, None, e) for future, loop, _, _ in results]
+            
+            for future, loop, result, error in results:
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+        conn.close()
+    
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any, error: Optional[Exception]) -> None:
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    async def _write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run ``fn`` on the writer thread; resolves once it is committed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._jobs.put((fn, future, loop))
+        return await future
+    
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._reader_conns.append(conn)
+        return conn
+    
+    async def _read(self, sql: str, params: tuple) -> List[tuple]:
+        def run() -> List[tuple]:
+            return self._reader().execute(sql, params).fetchall()
+        return await asyncio.get_running_loop().run_in_executor(self._readers, run)
+    
+    # ----- history -----
+    
+    async def get_history(self, chat_id: int) -> List[Message]:
+        rows = await self._read(
+            "SELECT role, content, timestamp, tokens FROM messages "
+            "WHERE chat_id = ? ORDER BY id",
+            (chat_id,),
+        )
+        return [Message(*row) for row in rows]
+    
+    async def add_message(self, chat_id: int, role: str, content: str) -> None:
+        await self.add_messages(chat_id, [(role, content)])
+    
+    async def add_messages(self, chat_id: int, messages: Sequence[Tuple[str, str]]) -> None:
+        timestamp = time.time()
+        rows = [
+            (chat_id, msg.role, msg.content, msg.timestamp, msg.tokens)
+            for msg in (Message(role, content, timestamp) for role, content in messages)
+        ]
+        
+        def write(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                "INSERT INTO messages (chat_id, role, content, timestamp, tokens) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            # Keep only last N messages
+            conn.execute(
+                "DELETE FROM messages WHERE chat_id = ? AND id <= ("
+                "SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (chat_id, chat_id, self.max_history),
+            )
+        
+        await self._write(write)
+    
+    async def clear_history(self, chat_id: int) -> None:
+        await self._write(lambda conn: conn.execute(
+            "DELETE FROM messages WHERE chat_id = ?", (chat_id,)
+        ))
+    
+    async def trim_history(self, chat_id: int, through: Message) -> None:
+        # No match (already pruned by appends) compares against NULL: nothing deleted
+        await self._write(lambda conn: conn.execute(
+            "DELETE FROM messages WHERE chat_id = ? AND id <= ("
+            "SELECT id FROM messages WHERE chat_id = ? AND role = ? AND content = ? "
+            "AND timestamp = ? ORDER BY id DESC LIMIT 1)",
+            (chat_id, chat_id, through.role, through.content, through.timestamp),
+        ))
+    
+    # ----- metadata -----
+    
+    async def get_metadata(self, chat_id: int, key: str) -> Optional[Any]:
+        rows = await self._read(
+            "SELECT value FROM metadata WHERE chat_id = ? AND key = ?", (chat_id, key)
+        )
+        return json.loads(rows[0][0]) if rows else None
+    
+    async def set_metadata(self, chat_id: int, key: str, value: Any) -> None:
+        data = json.dumps(value)
+        await self._write(lambda conn: conn.execute(
+            "INSERT INTO metadata (chat_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, key) DO UPDATE SET value = excluded.value",
+            (chat_id, key, data),
+        ))
+    
+    async def get_all_metadata(self, chat_id: int) -> Dict[str, Any]:
+        rows = await self._read(
+            "SELECT key, value FROM metadata WHERE chat_id = ?", (chat_id,)
+        )
+        return {key: json.loads(value) for key, value in rows}
+    
+    async def get_metadata_many(self, chat_ids: Sequence[int], key: str,
+                                batch_size: int = 500) -> Dict[int, Any]:
+        result: Dict[int, Any] = dict.fromkeys(chat_ids)
+        for start in range(0, len(chat_ids), batch_size):
+            batch = list(chat_ids[start:start + batch_size])
+            placeholders = ",".join("?" * len(batch))
+            rows = await self._read(
+                f"SELECT chat_id, value FROM metadata WHERE key = ? AND chat_id IN ({placeholders})",
+                (key, *batch),
+            )
+            for chat_id, value in rows:
+                result[chat_id] = json.loads(value)
+        return result
+    
+    @property
+    def pushes_invalidations(self) -> bool:
+        # Other processes may share the database file without telling us
+        return False
+    
+    async def close(self) -> None:
+        self._jobs.put(None)
+        # Both joins wait for in-flight work; keep them off the event loop
+        await asyncio.to_thread(self._writer.join)
+        await asyncio.to_thread(self._readers.shutdown, wait=True)
+        for conn in self._reader_conns:
+            conn.close()
+        self._reader_conns.clear()
 
 
 # Initialize memory backend based on config
 def get_memory_backend() -> MemoryBackend:
     """Factory function to get appropriate memory backend."""
-    if config.use_redis:
-        return RedisBackend(config.redis_url, config.max_history)
-    else:
-        return InMemoryBackend(config.max_history)
+    backend = config.memory_backend or ("redis" if config.use_redis else "memory")
+    if backend == "redis":
+        return RedisBackend(config.redis_url, config.max_history,
+                            cache_size=config.redis_cache_size)
+    elif backend == "sqlite":
+        return SQLiteBackend(config.sqlite_path, config.max_history)
+    elif backend == "memory":
+        return InMemoryBackend(config.max_history, config.memory_max_chats,
+                               config.memory_idle_ttl,
+                               snapshot_path=config.snapshot_path or None,
+                               snapshot_interval=config.snapshot_interval)
+    raise ValueError(f"Unknown MEMORY_BACKEND: {backend}")
+
+
+# Folds (previous summary, messages to evict) into a new summary
+Summarizer = Callable[[Optional[str], List[Message]], Awaitable[str]]
+
+SUMMARY_KEY = "summary"
+
+
+class ConversationTurn:
+    """One user → assistant exchange, read once and written once.
+    
+    The history snapshot is taken when the turn starts and the prompt is
+    built from that in-memory copy. Nothing is persisted until
+    :meth:`commit`, which writes the user and assistant messages together
+    in one batched backend call, so a Redis-backed turn costs two round
+    trips in total instead of six.
+    """
+    
+    def __init__(self, manager: "MemoryManager", chat_id: int,
+                 history: List[Message], user_content: str,
+                 summary: Optional[str] = None):
+        self.manager = manager
+        self.chat_id = chat_id
+        self.history = history
+        self.user_content = user_content
+        self.summary = summary
+    
+    def build_messages(self, system_context: Optional[str] = None) -> List[Dict]:
+        """Build messages for OpenAI API, ending with this turn's user message."""
+        return self.manager.format_messages(
+            system_context or self.manager.get_system_context(),
+            self.history + [Message("user", self.user_content)],
+            self.summary,
+        )
+    
+    async def commit(self, assistant_content: str) -> None:
+        """Persist the user message and the assistant reply."""
+        await self.manager.backend.add_messages(self.chat_id, [
+            ("user", self.user_content),
+            ("assistant", assistant_content),
+        ])
+        self.manager.maybe_compact(self.chat_id, len(self.history) + 2)
 
 
 class MemoryManager:
-    """High-level memory management."""
+    """High-level memory management.
     
-    def __init__(self, backend: MemoryBackend):
+    Prompts are assembled against ``token_budget``: the newest messages are
+    kept for as long as they fit alongside the system prompt, and the most
+    recent one is always included. A budget of 0 sends the whole history.
+    
+    With a ``summarizer`` and a ``compact_threshold``, a chat whose history
+    reaches the threshold is compacted in a background task: everything but
+    the newest ``compact_keep`` messages is folded into a running summary
+    (stored as the ``summary`` metadata key) and then trimmed. Prompts carry
+    the summary plus the recent tail, so their size stays bounded however
+    long the conversation runs.
+    """
+    
+    def __init__(self, backend: MemoryBackend, token_budget: int = 0,
+                 summarizer: Optional[Summarizer] = None,
+                 compact_threshold: int = 0, compact_keep: int = 6):
         self.backend = backend
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.compact_threshold = compact_threshold
+        self.compact_keep = compact_keep
+        self._compacting: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
     
-    async def get_conversation(self, chat_id: int) -> List[Dict]:
+    async def get_conversation(self, chat_id: int) -> List[Message]:
         """Get full conversation history."""
         return await self.backend.get_history(chat_id)
     
@@ -163,29 +1278,92 @@ class MemoryManager:
         """Add assistant message."""
         await self.backend.add_message(chat_id, "assistant", content)
     
-    async def get_system_context(self) -> str:
-        """Get system context for AI."""
-        return (
-            "You are a helpful Telegram assistant. "
-            "Be concise, friendly, and helpful. "
-            "Keep responses under 2000 characters for Telegram."
+    async def start_turn(self, chat_id: int, user_content: str) -> ConversationTurn:
+        """Read history once and open a turn for ``user_content``."""
+        history, summary = await self._read_context(chat_id)
+        return ConversationTurn(self, chat_id, history, user_content, summary)
+    
+    async def _read_context(self, chat_id: int) -> Tuple[List[Message], Optional[str]]:
+        if not self.summarizer:
+            return await self.get_conversation(chat_id), None
+        history, summary = await asyncio.gather(
+            self.get_conversation(chat_id),
+            self.backend.get_metadata(chat_id, SUMMARY_KEY),
         )
+        return history, summary
     
-    async def build_messages(self, chat_id: int) -> List[Dict]:
-        """Build messages for OpenAI API."""
-        system_context = await self.get_system_context()
-        history = await self.get_conversation(chat_id)
+    # ----- compaction -----
+    
+    def maybe_compact(self, chat_id: int, history_length: int) -> None:
+        """Schedule compaction off the reply path once the threshold is hit."""
+        if (not self.summarizer or not self.compact_threshold
+                or history_length < self.compact_threshold
+                or chat_id in self._compacting):
+            return
+        self._compacting.add(chat_id)
+        task = asyncio.create_task(self.compact(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def compact(self, chat_id: int) -> None:
+        """Fold the oldest messages into the running summary, then evict them."""
+        try:
+            history, summary = await self._read_context(chat_id)
+            evict = history[:-self.compact_keep] if self.compact_keep else history
+            if len(history) < self.compact_threshold or not evict:
+                return
+            
+            summary = await self.summarizer(summary, evict)
+            await self.backend.set_metadata(chat_id, SUMMARY_KEY, summary)
+            # Appends may have pruned the head while summarizing; trim up to the
+            # last summarized message rather than a count, which could now
+            # reach messages the summary never saw
+            await self.backend.trim_history(chat_id, evict[-1])
+            logger.info(f"Compacted {len(evict)} messages for chat {chat_id}")
+        except Exception as e:
+            logger.error(f"Compaction failed for chat {chat_id}: {e}")
+        finally:
+            self._compacting.discard(chat_id)
+    
+    def get_system_context(self) -> str:
+        """Get system context for AI."""
+        return system_prompt(CHAT)
+    
+    def fit_to_budget(self, prefix: Sequence[str], history: List[Message]) -> List[Message]:
+        """Newest suffix of ``history`` that fits in the token budget."""
+        if not self.token_budget:
+            return history
         
+        remaining = self.token_budget - sum(_prompt_tokens(text) for text in prefix)
+        start = len(history)
+        while start > 0:
+            cost = history[start - 1].tokens + MESSAGE_OVERHEAD_TOKENS
+            if cost > remaining and start < len(history):
+                break
+            remaining -= cost
+            start -= 1
+        return history[start:]
+    
+    def format_messages(self, system_context: str, history: List[Message],
+                        summary: Optional[str] = None) -> List[Dict]:
+        """Convert stored history into the OpenAI messages shape."""
+        prefix = [system_context]
+        if summary:
+            prefix.append(f"Summary of the earlier conversation:\n{summary}")
         return [
-            {"role": "system", "content": system_context}
-        ] + [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in history
-        ]
+            {"role": "system", "content": text} for text in prefix
+        ] + [msg.to_openai() for msg in self.fit_to_budget(prefix, history)]
+    
+    async def build_messages(self, chat_id: int) -> List[Dict]:
+        """Build messages for OpenAI API."""
+        history, summary = await self._read_context(chat_id)
+        return self.format_messages(self.get_system_context(), history, summary)
     
     async def clear_conversation(self, chat_id: int) -> None:
         """Clear conversation history."""
         await self.backend.clear_history(chat_id)
+        if self.summarizer:
+            await self.backend.set_metadata(chat_id, SUMMARY_KEY, None)
     
     async def get_summary(self, chat_id: int) -> str:
         """Get formatted summary of conversation."""
@@ -194,6 +1372,6 @@ class MemoryManager:
             return "No conversation history."
         
         return "\n".join([
-            f"[{msg['timestamp']}] {msg['role'].upper()}: {msg['content'][:80]}"
+            f"[{msg.iso_timestamp}] {msg.role.upper()}: {msg.content[:80]}"
             for msg in history
         ])
@@ -0,0 +1,303 @@
+"""
+Request instrumentation and a Prometheus-style metrics endpoint
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text exposition format (version 0.0.4) by a tiny asyncio HTTP server, so
+nothing beyond the standard library is needed:
+
+    curl http://127.0.0.1:9108/metrics
+
+Handlers are wrapped with :func:`instrument` (latency, in-flight, errors
+that escape) and time their steps with :func:`stage`; errors a handler
+answers itself are counted with :func:`record_error`. Every OpenAI call is
+recorded by ``llm.LLMClient``. Stats kept elsewhere (scheduler, caches,
+streaming) are exposed through callback gauges read at scrape time.
+"""
+
+import time
+import asyncio
+import logging
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Base for a named metric family with fixed label names."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """(sample name, label names, label values, value) tuples."""
+        return iter(())
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labelnames, values, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield self.name, self.labelnames, values, value
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception as e:
+                logger.debug(f"Metric {self.name} callback failed: {e}")
+                return
+            if value is not None:
+                yield self.name, (), (), value
+            return
+        for values, value in self._values.items():
+            yield self.name, self.labelnames, values, value
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, plus sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values → (per-bucket counts, sum, count)
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts, totals = self._values.setdefault(key, ([0] * len(self.buckets), [0.0, 0]))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[1][1] if entry else 0
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        bucket_labels = self.labelnames + ("le",)
+        for values, (counts, (total, count)) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", bucket_labels, values + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labelnames, values, total
+            yield f"{self.name}_count", self.labelnames, values, count
+
+
+class Registry:
+    """Metric families rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def gauge_function(self, name: str, documentation: str,
+                       function: Callable[[], float]) -> Gauge:
+        """Register (or re-point) a gauge read from ``function`` at scrape time."""
+        existing = self._metrics.get(name)
+        if isinstance(existing, Gauge):
+            existing._function = function
+            return existing
+        return self.register(Gauge(name, documentation, function=function))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Time spent in a handler", ("handler",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "bot_stage_seconds", "Time spent in one step of a handler", ("handler", "stage")))
+HANDLER_IN_FLIGHT = REGISTRY.register(Gauge(
+    "bot_handler_in_flight", "Handler invocations currently running", ("handler",)))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Handler failures by exception type", ("handler", "error")))
+
+LLM_SECONDS = REGISTRY.register(Histogram(
+    "bot_llm_request_seconds", "OpenAI call time until the response (or first chunk), retries included",
+    ("kind", "model", "outcome")))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "bot_llm_tokens_total", "OpenAI tokens by direction (prompt, cached, completion)",
+    ("kind", "model", "direction")))
+LLM_ERRORS = REGISTRY.register(Counter(
+    "bot_llm_errors_total", "Failed OpenAI attempts by exception type", ("kind", "error")))
+
+
+def record_error(handler: str, error: BaseException) -> None:
+    """Count an error a handler caught and answered itself."""
+    HANDLER_ERRORS.inc(handler=handler, error=type(error).__name__)
+
+
+@contextmanager
+def stage(handler: str, name: str) -> Iterator[None]:
+    """Time one step of a handler: ``with stage("voice", "stt"): ...``."""
+    with STAGE_SECONDS.time(handler=handler, stage=name):
+        yield
+
+
+def instrument(handler: str) -> Callable:
+    """Decorator recording latency, in-flight count and escaping errors."""
+    def decorate(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            HANDLER_IN_FLIGHT.inc(handler=handler)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                record_error(handler, e)
+                raise
+            finally:
+                HANDLER_IN_FLIGHT.dec(handler=handler)
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler)
+        return wrapper
+    return decorate
+
+
+class MetricsServer:
+    """Serves ``GET /metrics`` from a registry on a local port."""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = "127.0.0.1", port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the request headers
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,83 @@
+"""
+Prompt registry
+
+Every system prompt the bots send lives here, one constant per kind of
+call. OpenAI reuses the computation for a prompt prefix it has seen
+recently (cached prompt tokens are cheaper and faster), but only when the
+prefix is byte-for-byte identical. So prompts are built in one order:
+
+    fixed system prompt → summary (changes on compaction) → history → new input
+
+and nothing volatile (data, timestamps, user text) is ever mixed into the
+fixed part. Handlers take fresh message dicts from :func:`system_message`
+instead of writing prompt text inline or editing ``messages[0]``.
+"""
+
+from typing import Dict, List
+
+CHAT = "chat"
+VOICE = "voice"
+DASHBOARD = "dashboard"
+SUMMARY = "summary"
+EMBEDDING = "embedding"  # call kind only; embeddings have no system prompt
+
+SYSTEM_PROMPTS: Dict[str, str] = {
+    CHAT: (
+        "You are a helpful Telegram assistant. "
+        "Be concise, friendly, and helpful. "
+        "Keep responses under 2000 characters for Telegram."
+    ),
+    VOICE: (
+        "You are a helpful voice assistant. "
+        "Keep responses natural and concise for voice. "
+        "Max 500 characters."
+    ),
+    DASHBOARD: (
+        "You are a data analyst. Provide clear, concise insights from data. "
+        "Keep responses under 500 characters."
+    ),
+    SUMMARY: (
+        "You maintain a running summary of a chat between a user and an assistant. "
+        "Merge the new messages into the existing summary. Keep names, facts, "
+        "preferences and open questions. Reply with the summary only, under 150 words."
+    ),
+}
+
+# /analyze instructions, sent ahead of the data they apply to
+ANALYSIS_TASKS: Dict[str, str] = {
+    "general": "Analyze this data and provide a brief, human-readable summary. "
+               "Give 2-3 key insights in bullet points. Be concise.",
+    "thingspeak": "Analyze these IoT sensor readings and identify patterns or anomalies. "
+                  "Provide actionable insights. Focus on trends and any concerning values.",
+    "weather": "Summarize this weather forecast data for a user. "
+               "Include current conditions and any weather warnings or notable changes.",
+    "database": "Summarize these database metrics and highlight important statistics. "
+                "Focus on performance indicators and anomalies.",
+}
+
+
+def system_prompt(kind: str) -> str:
+    """Fixed system prompt text for ``kind``."""
+    return SYSTEM_PROMPTS[kind]
+
+
+def system_message(kind: str) -> Dict[str, str]:
+    """A new system message dict for ``kind``; safe to put in any list."""
+    return {"role": "system", "content": SYSTEM_PROMPTS[kind]}
+
+
+def analysis_messages(analysis_type: str, data_json: str) -> List[Dict[str, str]]:
+    """Messages for a dashboard analysis, with the data last."""
+    task = ANALYSIS_TASKS.get(analysis_type, ANALYSIS_TASKS["general"])
+    return [
+        system_message(DASHBOARD),
+        {"role": "user", "content": f"{task}\n\n{data_json}"},
+    ]
+
+
+def summary_messages(summary: str, transcript: str) -> List[Dict[str, str]]:
+    """Messages that fold ``transcript`` into the running ``summary``."""
+    return [
+        system_message(SUMMARY),
+        {"role": "user", "content": f"Existing summary:\n{summary}\n\nNew messages:\n{transcript}"},
+    ]
@@ -0,0 +1,206 @@
+"""
+Per-user rate limiting
+
+A sliding-window counter per user, checked in handler group -1 before any
+other handler runs, so an over-limit user never reaches downloads, ffmpeg,
+speech recognition or OpenAI. Each update costs a weight by kind (a voice
+note is worth several text messages); over-limit updates get one short
+"slow down" reply per window and are otherwise dropped.
+
+The window is approximated from two fixed buckets: the previous minute's
+count, weighted by how much of it still overlaps the window, plus the
+current minute's count. That is exact enough for abuse control and needs
+two integers per user, in-process or in Redis.
+"""
+
+import time
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+try:
+    import redis.asyncio as redis
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_COMMANDS = ("/thingspeak", "/weather", "/analyze")
+
+
+class RateLimiter(ABC):
+    """Sliding-window limit of ``limit`` weight units per ``window`` seconds."""
+
+    def __init__(self, limit: int, window: int = 60):
+        self.limit = limit
+        self.window = window
+
+    def _estimate(self, previous: int, current: int, now: float) -> float:
+        overlap = 1 - (now % self.window) / self.window
+        return previous * overlap + current
+
+    @abstractmethod
+    async def hit(self, key: str, weight: int = 1) -> Tuple[bool, float]:
+        """Count ``weight`` for ``key``; returns (allowed, seconds until retry)."""
+        pass
+
+    def _retry_after(self, now: float) -> float:
+        return self.window - now % self.window
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryRateLimiter(RateLimiter):
+    """Process-local counters."""
+
+    def __init__(self, limit: int, window: int = 60, max_keys: int = 100_000):
+        super().__init__(limit, window)
+        self.max_keys = max_keys
+        # key → (window index, previous count, current count)
+        self._counters: Dict[str, Tuple[int, int, int]] = {}
+
+    def _counts(self, key: str, index: int) -> Tuple[int, int]:
+        slot, previous, current = self._counters.get(key, (index, 0, 0))
+        if slot == index:
+            return previous, current
+        if slot == index - 1:
+            return current, 0
+        return 0, 0
+
+    def _prune(self, index: int) -> None:
+        stale = [key for key, (slot, _, _) in self._counters.items() if slot < index - 1]
+        for key in stale:
+            del self._counters[key]
+
+    async def hit(self, key: str, weight: int = 1) -> Tuple[bool, float]:
+        now = time.time()
+        index = int(now // self.window)
+        previous, current = self._counts(key, index)
+        if self._estimate(previous, current + weight, now) > self.limit:
+            self._counters[key] = (index, previous, current)
+            return False, self._retry_after(now)
+        self._counters[key] = (index, previous, current + weight)
+        if len(self._counters) > self.max_keys:
+            self._prune(index)
+        return True, 0.0
+
+
+class RedisRateLimiter(RateLimiter):
+    """Counters shared by every worker.
+
+    ``rl:{key}:{window index}`` holds one window's count with a TTL of two
+    windows. The increment and the read of the previous window go out in
+    one pipeline; a rejected hit is rolled back so it does not count.
+    """
+
+    def __init__(self, redis_url: str, limit: int, window: int = 60, prefix: str = "rl:"):
+        if not HAS_REDIS:
+            logger.error("redis package not installed. Use: pip install redis")
+            raise ImportError("redis package not installed")
+        super().__init__(limit, window)
+        self.url = redis_url
+        self.prefix = prefix
+        self._client = None
+
+    async def _get_client(self):
+        if self._client is None:
+            self._client = redis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    async def hit(self, key: str, weight: int = 1) -> Tuple[bool, float]:
+        client = await self._get_client()
+        now = time.time()
+        index = int(now // self.window)
+        current_key = f"{self.prefix}{key}:{index}"
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incrby(current_key, weight)
+            pipe.expire(current_key, self.window * 2)
+            pipe.get(f"{self.prefix}{key}:{index - 1}")
+            current, _, previous = await pipe.execute()
+        if self._estimate(int(previous or 0), current, now) > self.limit:
+            await client.decrby(current_key, weight)
+            return False, self._retry_after(now)
+        return True, 0.0
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def update_weight(update: Update) -> int:
+    """Cost of an update; 0 for cheap ones that are never limited."""
+    message = update.effective_message
+    if message is None:
+        return 0
+    if message.voice:
+        return config.rate_limit_voice_weight
+    text = message.text or ""
+    if text.startswith("/"):
+        command = text.split()[0].split("@")[0].lower()
+        return config.rate_limit_dashboard_weight if command in DASHBOARD_COMMANDS else 0
+    return 1 if text else 0
+
+
+class RateLimitGate:
+    """Handler-group -1 check that stops over-limit updates.
+
+    Args:
+        limiter: Counter storage.
+        exempt: User ids never limited (admins).
+    """
+
+    def __init__(self, limiter: RateLimiter, exempt=()):
+        self.limiter = limiter
+        self.exempt = set(exempt)
+        # user id → window index in which they were already told to slow down
+        self._notified: Dict[int, int] = {}
+        self.stats = {"checked": 0, "throttled": 0}
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        weight = update_weight(update)
+        if user is None or weight == 0 or user.id in self.exempt:
+            return
+        self.stats["checked"] += 1
+        try:
+            allowed, retry_after = await self.limiter.hit(str(user.id), weight)
+        except Exception as e:
+            # A limiter outage must not take the bot down with it
+            logger.warning(f"Rate limiter unavailable, allowing update: {e}")
+            return
+        if allowed:
+            return
+
+        self.stats["throttled"] += 1
+        window = int(time.time() // self.limiter.window)
+        if self._notified.get(user.id) != window:
+            if len(self._notified) > 10_000:
+                self._notified.clear()
+            self._notified[user.id] = window
+            logger.info(f"Rate limited user {user.id} for {retry_after:.0f}s")
+            await update.effective_message.reply_text(
+                f"⏳ You're sending messages too quickly. Please wait {retry_after:.0f}s."
+            )
+        raise ApplicationHandlerStop
+
+    def handler(self) -> TypeHandler:
+        """Register with ``app.add_handler(gate.handler(), group=-1)``."""
+        return TypeHandler(Update, self)
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """Limiter from config; Redis-backed when memory lives in Redis."""
+    if config.rate_limit_per_minute <= 0:
+        return None
+    backend = config.memory_backend or ("redis" if config.use_redis else "memory")
+    if backend == "redis":
+        return RedisRateLimiter(config.redis_url, config.rate_limit_per_minute)
+    return InMemoryRateLimiter(config.rate_limit_per_minute)
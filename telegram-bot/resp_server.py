@@ -0,0 +1,437 @@
+"""
+Minimal in-process Redis stand-in speaking RESP2
+
+Implements the subset of commands the bot uses (strings, lists, hashes,
+sorted sets, counters, TTLs, MULTI/EXEC/WATCH, SCAN and pub/sub) so
+RedisBackend can be benchmarked or run locally without a Redis server. Not a Redis replacement:
+single database, no persistence, no eviction.
+
+Usage:
+    server = RespServer()
+    port = server.start_in_thread()        # loopback, own event loop
+    backend = RedisBackend(f"redis://127.0.0.1:{port}")
+
+    python resp_server.py --port 6379      # standalone
+"""
+
+import time
+import fnmatch
+import asyncio
+import argparse
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class RespError(Exception):
+    """Error reply sent back to the client."""
+
+
+WRONGTYPE = RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+def _encode(value: Any) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-" + str(value).encode() + b"\r\n"
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, Status):
+        return b"+" + value.text.encode() + b"\r\n"
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class Status:
+    """Simple-string reply such as ``+OK``."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+OK = Status("OK")
+QUEUED = Status("QUEUED")
+
+
+class _Client:
+    __slots__ = ("writer", "queued", "watched", "channels")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.queued: Optional[List[List[bytes]]] = None
+        self.watched: Dict[bytes, int] = {}
+        self.channels: Set[bytes] = set()
+
+
+class _SortedSet(dict):
+    """Sorted set as member → score; ordered on read."""
+
+
+class RespServer:
+    """Single-threaded keyspace served over asyncio streams."""
+
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.versions: Dict[bytes, int] = {}
+        self.subscribers: Dict[bytes, Set[_Client]] = {}
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # ----- lifecycle -----
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    def start_in_thread(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Serve from a daemon thread with its own event loop; returns the port."""
+        ready = threading.Event()
+        result: Dict[str, int] = {}
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            result["port"] = self._loop.run_until_complete(self.start(host, port))
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="resp-server", daemon=True).start()
+        ready.wait()
+        return result["port"]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # ----- protocol -----
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = _Client(writer)
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                writer.write(_encode(self._dispatch(client, command)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in client.channels:
+                self.subscribers.get(channel, set()).discard(client)
+            writer.close()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    def _dispatch(self, client: _Client, command: List[bytes]) -> Any:
+        name = command[0].decode().upper()
+        args = command[1:]
+        if client.queued is not None and name not in ("EXEC", "DISCARD", "MULTI", "WATCH"):
+            client.queued.append(command)
+            return QUEUED
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if name in ("MULTI", "EXEC", "DISCARD", "WATCH", "UNWATCH", "SUBSCRIBE", "UNSUBSCRIBE"):
+            return handler(client, *args)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args)
+        except RespError as e:
+            return e
+        except (TypeError, ValueError) as e:
+            return RespError(f"ERR {e}")
+
+    # ----- keyspace helpers -----
+
+    def _get(self, key: bytes, kind: Optional[type] = None) -> Any:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self._delete(key)
+        value = self.data.get(key)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise WRONGTYPE
+        return value
+
+    def _touch(self, key: bytes) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _delete(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        self._touch(key)
+        return self.data.pop(key, None) is not None
+
+    def _set(self, key: bytes, value: Any) -> None:
+        self.data[key] = value
+        self._touch(key)
+
+    def _collection(self, key: bytes, kind: type) -> Any:
+        value = self._get(key, kind)
+        if value is None:
+            value = kind()
+            self.data[key] = value
+        self._touch(key)
+        return value
+
+    def _drop_if_empty(self, key: bytes) -> None:
+        if not self.data.get(key):
+            self._delete(key)
+
+    # ----- connection -----
+
+    def cmd_ping(self, *args: bytes) -> Any:
+        return args[0] if args else Status("PONG")
+
+    def cmd_client(self, *args: bytes) -> Any:
+        return OK
+
+    def cmd_select(self, db: bytes) -> Any:
+        return OK
+
+    def cmd_flushall(self, *args: bytes) -> Any:
+        self.data.clear()
+        self.expires.clear()
+        return OK
+
+    # ----- strings -----
+
+    def cmd_get(self, key: bytes) -> Any:
+        return self._get(key, bytes)
+
+    def cmd_set(self, key: bytes, value: bytes, *options: bytes) -> Any:
+        self._set(key, value)
+        self.expires.pop(key, None)
+        opts = [opt.upper() for opt in options]
+        if b"EX" in opts:
+            self.expires[key] = time.time() + int(options[opts.index(b"EX") + 1])
+        return OK
+
+    def cmd_incrby(self, key: bytes, amount: bytes) -> Any:
+        value = int(self._get(key, bytes) or 0) + int(amount)
+        self.data[key] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def cmd_incr(self, key: bytes) -> Any:
+        return self.cmd_incrby(key, b"1")
+
+    def cmd_decrby(self, key: bytes, amount: bytes) -> Any:
+        return self.cmd_incrby(key, str(-int(amount)).encode())
+
+    # ----- generic -----
+
+    def cmd_del(self, *keys: bytes) -> Any:
+        return sum(self._get(key) is not None and self._delete(key) for key in keys)
+
+    def cmd_exists(self, *keys: bytes) -> Any:
+        return sum(self._get(key) is not None for key in keys)
+
+    def cmd_type(self, key: bytes) -> Any:
+        value = self._get(key)
+        kind = {bytes: "string", list: "list", dict: "hash", _SortedSet: "zset"}.get(type(value), "none")
+        return Status(kind)
+
+    def cmd_expire(self, key: bytes, seconds: bytes) -> Any:
+        if self._get(key) is None:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_ttl(self, key: bytes) -> Any:
+        if self._get(key) is None:
+            return -2
+        deadline = self.expires.get(key)
+        return -1 if deadline is None else max(0, int(deadline - time.time()))
+
+    def cmd_scan(self, cursor: bytes, *options: bytes) -> Any:
+        opts = [opt.upper() for opt in options]
+        pattern = options[opts.index(b"MATCH") + 1].decode() if b"MATCH" in opts else "*"
+        kind = options[opts.index(b"TYPE") + 1].decode() if b"TYPE" in opts else None
+        keys = [
+            key for key in list(self.data)
+            if fnmatch.fnmatchcase(key.decode(), pattern)
+            and (kind is None or self.cmd_type(key).text == kind)
+        ]
+        # Whole keyspace in one page
+        return [b"0", keys]
+
+    # ----- lists -----
+
+    def cmd_rpush(self, key: bytes, *values: bytes) -> Any:
+        items = self._collection(key, list)
+        items.extend(values)
+        return len(items)
+
+    def cmd_llen(self, key: bytes) -> Any:
+        return len(self._get(key, list) or [])
+
+    @staticmethod
+    def _range(length: int, start: int, stop: int) -> slice:
+        start = max(0, start + length if start < 0 else start)
+        stop = stop + length if stop < 0 else stop
+        return slice(start, max(start, stop + 1))
+
+    def cmd_lrange(self, key: bytes, start: bytes, stop: bytes) -> Any:
+        items = self._get(key, list) or []
+        return items[self._range(len(items), int(start), int(stop))]
+
+    def cmd_ltrim(self, key: bytes, start: bytes, stop: bytes) -> Any:
+        items = self._get(key, list)
+        if items is not None:
+            items[:] = items[self._range(len(items), int(start), int(stop))]
+            self._touch(key)
+            self._drop_if_empty(key)
+        return OK
+
+    # ----- hashes -----
+
+    def cmd_hset(self, key: bytes, *pairs: bytes) -> Any:
+        fields = self._collection(key, dict)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        return added
+
+    def cmd_hget(self, key: bytes, field: bytes) -> Any:
+        return (self._get(key, dict) or {}).get(field)
+
+    def cmd_hgetall(self, key: bytes) -> Any:
+        fields = self._get(key, dict) or {}
+        return [item for pair in fields.items() for item in pair]
+
+    def cmd_hdel(self, key: bytes, *names: bytes) -> Any:
+        fields = self._get(key, dict)
+        if fields is None:
+            return 0
+        removed = sum(fields.pop(name, None) is not None for name in names)
+        self._touch(key)
+        self._drop_if_empty(key)
+        return removed
+
+    # ----- sorted sets -----
+
+    def cmd_zadd(self, key: bytes, *pairs: bytes) -> Any:
+        members = self._collection(key, _SortedSet)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def cmd_zcard(self, key: bytes) -> Any:
+        return len(self._get(key, _SortedSet) or {})
+
+    def cmd_zrem(self, key: bytes, *members: bytes) -> Any:
+        zset = self._get(key, _SortedSet)
+        if zset is None:
+            return 0
+        removed = sum(zset.pop(member, None) is not None for member in members)
+        self._touch(key)
+        self._drop_if_empty(key)
+        return removed
+
+    def cmd_zpopmin(self, key: bytes, count: bytes = b"1") -> Any:
+        zset = self._get(key, _SortedSet)
+        if zset is None:
+            return []
+        lowest = sorted(zset.items(), key=lambda item: (item[1], item[0]))[:int(count)]
+        for member, _ in lowest:
+            del zset[member]
+        self._touch(key)
+        self._drop_if_empty(key)
+        return [item for member, score in lowest for item in (member, repr(score).encode())]
+
+    # ----- transactions -----
+
+    def cmd_multi(self, client: _Client) -> Any:
+        client.queued = []
+        return OK
+
+    def cmd_discard(self, client: _Client) -> Any:
+        client.queued = None
+        client.watched.clear()
+        return OK
+
+    def cmd_watch(self, client: _Client, *keys: bytes) -> Any:
+        for key in keys:
+            client.watched[key] = self.versions.get(key, 0)
+        return OK
+
+    def cmd_unwatch(self, client: _Client) -> Any:
+        client.watched.clear()
+        return OK
+
+    def cmd_exec(self, client: _Client) -> Any:
+        queued, client.queued = client.queued, None
+        if queued is None:
+            return RespError("ERR EXEC without MULTI")
+        watched, client.watched = client.watched, {}
+        if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+            return None
+        return [self._dispatch(client, command) for command in queued]
+
+    # ----- pub/sub -----
+
+    def cmd_subscribe(self, client: _Client, *channels: bytes) -> Any:
+        replies = []
+        for channel in channels:
+            client.channels.add(channel)
+            self.subscribers.setdefault(channel, set()).add(client)
+            replies.append([b"subscribe", channel, len(client.channels)])
+        # Every confirmation is its own push frame
+        for reply in replies[:-1]:
+            client.writer.write(_encode(reply))
+        return replies[-1]
+
+    def cmd_unsubscribe(self, client: _Client, *channels: bytes) -> Any:
+        for channel in channels or list(client.channels):
+            client.channels.discard(channel)
+            self.subscribers.get(channel, set()).discard(client)
+        return [b"unsubscribe", channels[0] if channels else None, len(client.channels)]
+
+    def cmd_publish(self, channel: bytes, message: bytes) -> Any:
+        receivers = self.subscribers.get(channel, set())
+        for receiver in receivers:
+            receiver.writer.write(_encode([b"message", channel, message]))
+        return len(receivers)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Minimal RESP2 server for local runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    async def serve() -> None:
+        server = RespServer()
+        port = await server.start(args.host, args.port)
+        print(f"Listening on {args.host}:{port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
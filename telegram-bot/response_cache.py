@@ -0,0 +1,311 @@
+"""
+Response cache in front of the LLM call
+
+Replies are keyed on the full prompt the model would see: model name,
+normalized system prompt, the (budgeted) history and the new user message.
+An exact hit therefore only happens when the model would have been asked
+the very same thing, which in practice means openers ("hi", "what can you
+do?") and FAQ questions at the start of a conversation.
+
+With a similarity threshold and an embedder, a miss falls back to a local
+vector index of earlier user messages *with the same context*. Only the
+last user message is compared, so "how much is premium?" can reuse the
+answer to "how much does premium cost" but never an answer given under a
+different history or system prompt.
+
+Entries expire after ``ttl`` seconds and the store is bounded by entry
+count, either in-process (LRU) or in Redis (shared by every worker).
+
+Embeddings go through the same :class:`llm.LLMClient` (deadline, retries,
+circuit breaker, metrics) and :class:`scheduler.LLMScheduler` (rate and
+token budgets) as chat completions.
+"""
+
+import json
+import math
+import time
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import redis.asyncio as redis
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+from config import config
+from memory import count_tokens
+from prompts import EMBEDDING
+from scheduler import LLMScheduler, Priority, get_llm_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Text → unit-length embedding vector
+Embedder = Callable[[str], Awaitable[List[float]]]
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def normalize(text: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive form."""
+    return " ".join(text.lower().split()).strip(" .!?")
+
+
+class CacheStore(ABC):
+    """Key → entry storage with TTL and bounded size."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, entry: Dict, ttl: int) -> None:
+        pass
+
+    async def clear(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryCacheStore(CacheStore):
+    """Process-local LRU store."""
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Dict]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires, entry = item
+        if expires <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def set(self, key: str, entry: Dict, ttl: int) -> None:
+        self._entries[key] = (time.time() + ttl, entry)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+
+class RedisCacheStore(CacheStore):
+    """Redis store shared by all workers.
+
+    Entries are JSON strings with a Redis TTL. A sorted set of keys by
+    insertion time bounds the count: once it grows past ``max_entries`` the
+    oldest keys are popped and deleted.
+    """
+
+    def __init__(self, redis_url: str, max_entries: int = 10_000, prefix: str = "rcache:"):
+        if not HAS_REDIS:
+            logger.error("redis package not installed. Use: pip install redis")
+            raise ImportError("redis package not installed")
+        self.url = redis_url
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self._index_key = f"{prefix}index"
+        self._client = None
+
+    async def _get_client(self):
+        if self._client is None:
+            self._client = redis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    async def get(self, key: str) -> Optional[Dict]:
+        client = await self._get_client()
+        data = await client.get(self.prefix + key)
+        return json.loads(data) if data else None
+
+    async def set(self, key: str, entry: Dict, ttl: int) -> None:
+        client = await self._get_client()
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.set(self.prefix + key, json.dumps(entry), ex=ttl)
+            pipe.zadd(self._index_key, {key: time.time()})
+            pipe.zcard(self._index_key)
+            size = (await pipe.execute())[-1]
+        excess = size - self.max_entries
+        if excess > 0:
+            oldest = await client.zpopmin(self._index_key, excess)
+            if oldest:
+                await client.delete(*(self.prefix + member for member, _ in oldest))
+
+    async def clear(self) -> None:
+        client = await self._get_client()
+        members = await client.zpopmin(self._index_key, 2 ** 31)
+        if members:
+            await client.delete(*(self.prefix + member for member, _ in members))
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+@dataclass
+class CacheProbe:
+    """Result of :meth:`ResponseCache.lookup`, passed back to :meth:`ResponseCache.store`."""
+    key: str
+    context: str
+    query: str
+    reply: Optional[str] = None
+    match: Optional[str] = None  # "exact" or "similar" on a hit
+    embedding: Optional[List[float]] = field(default=None, repr=False)
+
+
+class ResponseCache:
+    """Exact and (optionally) similarity-matched cache of LLM replies.
+
+    Args:
+        store: Where entries live (in-process or Redis).
+        ttl: Seconds an entry stays valid.
+        embedder: Enables similarity matching together with ``similarity``.
+        similarity: Cosine similarity needed for a near-duplicate hit
+            (0 = exact matching only).
+        index_size: Embeddings kept in the local vector index.
+    """
+
+    def __init__(self, store: CacheStore, ttl: int = 3600,
+                 embedder: Optional[Embedder] = None, similarity: float = 0.0,
+                 index_size: int = 10_000):
+        self.backend = store
+        self.ttl = ttl
+        self.embedder = embedder if similarity > 0 else None
+        self.similarity = similarity
+        self.index_size = index_size
+        # context hash → [(embedding, entry key)], oldest first
+        self._index: "OrderedDict[str, List[Tuple[List[float], str]]]" = OrderedDict()
+        self._indexed = 0
+        self.stats = {
+            "lookups": 0,
+            "exact_hits": 0,
+            "similar_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "saved_latency_s": 0.0,
+        }
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+    def _keys(self, messages: List[Dict], model: str) -> Tuple[str, str, str]:
+        """(entry key, context key, normalized query) for a prompt."""
+        *context, last = messages
+        context_key = self._digest(
+            model, *(f"{msg['role']}:{normalize(msg['content'])}" for msg in context)
+        )
+        query = normalize(last["content"])
+        return self._digest(context_key, query), context_key, query
+
+    async def lookup(self, messages: List[Dict], model: str) -> CacheProbe:
+        """Find a cached reply for ``messages`` (the full prompt, user message last)."""
+        key, context, query = self._keys(messages, model)
+        probe = CacheProbe(key, context, query)
+        self.stats["lookups"] += 1
+
+        entry = await self.backend.get(key)
+        if entry is not None:
+            probe.match = "exact"
+        elif self.embedder is not None and context in self._index:
+            probe.embedding = await self.embedder(query)
+            similar_key = self._nearest(context, probe.embedding)
+            if similar_key is not None:
+                entry = await self.backend.get(similar_key)
+                if entry is not None:
+                    probe.match = "similar"
+
+        if entry is None:
+            self.stats["misses"] += 1
+            return probe
+        probe.reply = entry["reply"]
+        self.stats[f"{probe.match}_hits"] += 1
+        self.stats["saved_latency_s"] += entry.get("latency", 0.0)
+        return probe
+
+    async def store(self, probe: CacheProbe, reply: str, latency: float) -> None:
+        """Remember the reply generated after a miss, with its generation time."""
+        await self.backend.set(probe.key, {"reply": reply, "latency": latency}, self.ttl)
+        self.stats["stores"] += 1
+        if self.embedder is not None:
+            embedding = probe.embedding or await self.embedder(probe.query)
+            self._add_to_index(probe.context, embedding, probe.key)
+
+    def _nearest(self, context: str, embedding: List[float]) -> Optional[str]:
+        best_key, best_score = None, self.similarity
+        for vector, key in self._index.get(context, ()):
+            score = sum(a * b for a, b in zip(vector, embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _add_to_index(self, context: str, embedding: List[float], key: str) -> None:
+        self._index.setdefault(context, []).append((embedding, key))
+        self._index.move_to_end(context)
+        self._indexed += 1
+        # Drop whole least-recently-extended contexts until back in bounds
+        while self._indexed > self.index_size and self._index:
+            _, dropped = self._index.popitem(last=False)
+            self._indexed -= len(dropped)
+
+    def cache_stats(self) -> Dict:
+        hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+        lookups = self.stats["lookups"]
+        return {
+            **self.stats,
+            "saved_latency_s": round(self.stats["saved_latency_s"], 3),
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+def llm_embedder(llm, scheduler: LLMScheduler, model: str = EMBEDDING_MODEL) -> Embedder:
+    """Embedder backed by the OpenAI embeddings endpoint, through ``llm``
+    and admitted by ``scheduler`` like any other call."""
+    async def embed(text: str) -> List[float]:
+        async with scheduler.slot(Priority.INTERACTIVE, tokens=count_tokens(text)) as ticket:
+            response = await llm.embed(kind=EMBEDDING, model=model, input=text)
+            ticket.charge(response.usage.total_tokens)
+        vector = response.data[0].embedding
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+    return embed
+
+
+def get_response_cache(llm=None, scheduler: Optional[LLMScheduler] = None) -> Optional[ResponseCache]:
+    """Response cache from config, or None when RESPONSE_CACHE is off.
+
+    Similarity matching needs ``llm`` (an :class:`llm.LLMClient`) for embeddings.
+    """
+    kind = config.response_cache
+    if kind in ("", "off"):
+        return None
+    if kind == "memory":
+        store = InMemoryCacheStore(config.response_cache_size)
+    elif kind == "redis":
+        store = RedisCacheStore(config.redis_url, config.response_cache_size)
+    else:
+        raise ValueError(f"Unknown RESPONSE_CACHE: {kind}")
+    embedder = None
+    if config.response_cache_similarity > 0 and llm is not None:
+        embedder = llm_embedder(llm, scheduler or get_llm_scheduler())
+    logger.info(
+        f"Response cache enabled ({kind}, ttl={config.response_cache_ttl}s, "
+        f"similarity={config.response_cache_similarity or 'exact only'})"
+    )
+    return ResponseCache(store, config.response_cache_ttl, embedder,
+                         config.response_cache_similarity)
@@ -0,0 +1,165 @@
+"""
+Model routing
+
+Picks the model and ``max_tokens`` for each reply from cheap local
+features, before any tokens are spent:
+
+- voice replies are read aloud and kept short: fast model, voice budget
+- short plain text messages ("thanks!", "what time is it in Rome?"): fast
+  model with a small completion budget, only when a fast model other than
+  the main one is configured
+- long messages, multi-line or with code: the main model, full budget
+
+Each model's recent latency is tracked from the calls themselves (see
+``LLMClient.add_latency_listener``). When the chosen model's p95 over the
+last few minutes is above the latency SLO and the other model is not, the
+request falls back to the other one. Old samples age out, so a model that
+was slow is tried again once its window has passed.
+"""
+
+import time
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+
+from config import config
+from prompts import VOICE
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Model and completion budget chosen for one call."""
+    model: str
+    max_tokens: int
+    reason: str  # voice, short, long, or one of those + "_fallback"
+
+
+class ModelRouter:
+    """Chooses between a fast and a strong model per request.
+
+    Args:
+        fast_model / strong_model: Models for short and long requests
+            (may be the same; then only ``max_tokens`` differs).
+        short_chars: Messages up to this length without line breaks or code
+            count as short (0 = nothing is short).
+        short_max_tokens / long_max_tokens / voice_max_tokens: Completion budgets.
+        latency_slo: p95 seconds above which a model is avoided (0 = never).
+        window: Seconds of latency samples considered.
+        min_samples: Samples needed before a model can be judged slow.
+    """
+
+    def __init__(self, fast_model: str, strong_model: str, short_chars: int = 200,
+                 short_max_tokens: int = 400, long_max_tokens: int = 1500,
+                 voice_max_tokens: int = 500, latency_slo: float = 0.0,
+                 window: float = 300.0, min_samples: int = 10):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.short_chars = short_chars
+        self.short_max_tokens = short_max_tokens
+        self.long_max_tokens = long_max_tokens
+        self.voice_max_tokens = voice_max_tokens
+        self.latency_slo = latency_slo
+        self.window = window
+        self.min_samples = min_samples
+        # model → (monotonic time, seconds) of recent calls
+        self._samples: Dict[str, Deque[Tuple[float, float]]] = {}
+        self.decisions: Dict[str, int] = {}
+        self._decide_time = 0.0
+
+    def is_short(self, text: str) -> bool:
+        return len(text) <= self.short_chars and "\n" not in text and "```" not in text
+
+    def route(self, kind: str, text: str = "") -> Route:
+        """Route a ``kind`` (prompts.CHAT, VOICE or DASHBOARD) reply to ``text``."""
+        started = time.perf_counter()
+        if kind == VOICE:
+            model, max_tokens, reason = self.fast_model, self.voice_max_tokens, "voice"
+        elif self.is_short(text):
+            model, max_tokens, reason = self.fast_model, self.short_max_tokens, "short"
+        else:
+            model, max_tokens, reason = self.strong_model, self.long_max_tokens, "long"
+
+        other = self.strong_model if model == self.fast_model else self.fast_model
+        if other != model and self._slow(model) and not self._slow(other):
+            model, reason = other, f"{reason}_fallback"
+
+        key = f"{model}:{reason}"
+        self.decisions[key] = self.decisions.get(key, 0) + 1
+        self._decide_time += time.perf_counter() - started
+        logger.debug(f"Route {kind} ({len(text)} chars) → {model}, max_tokens={max_tokens} ({reason})")
+        return Route(model, max_tokens, reason)
+
+    def observe(self, model: str, latency: float) -> None:
+        """Record how long a call to ``model`` took."""
+        self._samples.setdefault(model, deque(maxlen=500)).append((time.monotonic(), latency))
+
+    def p95(self, model: str) -> Optional[float]:
+        """p95 latency of ``model`` within the window, if enough samples."""
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        cutoff = time.monotonic() - self.window
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        if len(samples) < self.min_samples:
+            return None
+        ordered = sorted(latency for _, latency in samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _slow(self, model: str) -> bool:
+        if self.latency_slo <= 0:
+            return False
+        p95 = self.p95(model)
+        return p95 is not None and p95 > self.latency_slo
+
+    def metrics(self) -> Dict:
+        """Decision counts, per-model p95 and routing overhead."""
+        total = sum(self.decisions.values())
+        latency = {}
+        for model in {self.fast_model, self.strong_model}:
+            p95 = self.p95(model)
+            latency[model] = round(p95, 3) if p95 is not None else None
+        return {
+            "decisions": dict(self.decisions),
+            "p95_s": latency,
+            "decide_us": round(self._decide_time / total * 1e6, 1) if total else 0.0,
+        }
+
+
+_router: Optional[ModelRouter] = None
+
+
+def get_model_router(llm=None) -> ModelRouter:
+    """Process-wide router from config, fed with latencies from ``llm``."""
+    global _router
+    if _router is None:
+        if config.router_enabled:
+            fast_model = config.router_fast_model or config.model
+            # The short budget trades answer length for the fast model's
+            # speed; with a single model it would only truncate replies
+            short_chars = config.router_short_chars if fast_model != config.model else 0
+            _router = ModelRouter(
+                fast_model=fast_model,
+                strong_model=config.model,
+                short_chars=short_chars,
+                short_max_tokens=config.router_short_max_tokens,
+                long_max_tokens=config.max_tokens,
+                voice_max_tokens=config.voice_max_tokens,
+                latency_slo=config.router_latency_slo,
+            )
+            logger.info(
+                f"Model router: fast {_router.fast_model} (≤{short_chars} chars, "
+                f"{config.router_short_max_tokens} tokens), strong {_router.strong_model}, "
+                f"p95 SLO {config.router_latency_slo or 'off'}"
+            )
+        else:
+            # Fixed model and budgets, as before routing existed
+            _router = ModelRouter(config.model, config.model, short_chars=0,
+                                  long_max_tokens=config.max_tokens,
+                                  voice_max_tokens=config.voice_max_tokens)
+        if llm is not None:
+            llm.add_latency_listener(_router.observe)
+    return _router
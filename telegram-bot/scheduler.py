@@ -0,0 +1,246 @@
+"""
+Admission control for LLM calls
+
+Every chat completion goes through :class:`LLMScheduler`, which bounds
+concurrency and spends two token buckets (requests per minute and tokens per
+minute) so a burst of users queues briefly here instead of all hitting
+provider 429s at once. Waiting calls are admitted strictly by priority
+class, then in arrival order; the queue is bounded and every wait has a
+timeout, so overload turns into a quick "busy" answer rather than a pile-up.
+
+Usage:
+    scheduler = get_llm_scheduler()
+    async with scheduler.slot(Priority.INTERACTIVE, tokens=estimate) as ticket:
+        response = await client.chat.completions.create(...)
+        ticket.charge(response.usage.total_tokens)
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from config import config
+from memory import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Admission order; lower values go first."""
+    INTERACTIVE = 0  # text and voice replies a user is waiting for
+    DASHBOARD = 1    # /thingspeak, /weather, /analyze
+    BACKGROUND = 2   # history summaries and other deferrable work
+
+
+class SchedulerBusy(Exception):
+    """The call was not admitted: queue full or waited too long."""
+
+
+class TokenBucket:
+    """Refills ``rate`` units per second up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until ``amount`` is available (0 if it is now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        """Spend ``amount``; may go negative to record debt."""
+        self._refill()
+        self.level -= amount
+
+
+class Ticket:
+    """An admitted call; :meth:`charge` corrects the token estimate."""
+
+    def __init__(self, scheduler: "LLMScheduler", tokens: int):
+        self._scheduler = scheduler
+        self.tokens = tokens
+
+    def charge(self, actual_tokens: int) -> None:
+        if self._scheduler.tokens is not None:
+            self._scheduler.tokens.take(actual_tokens - self.tokens)
+        self.tokens = actual_tokens
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "future", "enqueued")
+
+    def __init__(self, priority: int, seq: int, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.future = future
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class LLMScheduler:
+    """Priority admission queue in front of the LLM provider.
+
+    Args:
+        requests_per_minute: Request budget (0 = unlimited).
+        tokens_per_minute: Prompt + completion token budget (0 = unlimited).
+        max_concurrency: Calls in flight at once.
+        max_queue: Calls allowed to wait; more are rejected immediately.
+        queue_timeout: Seconds a call may wait before it is rejected.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0,
+                 max_concurrency: int = 32, max_queue: int = 200,
+                 queue_timeout: float = 20.0):
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute) \
+            if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) \
+            if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._heap: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=1000) for p in Priority}
+        self.stats = {
+            "admitted": 0,
+            "rejected_full": 0,
+            "timed_out": 0,
+            "max_queue_depth": 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for waiter in self._heap if not waiter.future.done())
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.INTERACTIVE,
+                   tokens: int = 0) -> AsyncIterator[Ticket]:
+        """Wait for admission, then hold a concurrency slot for the block."""
+        await self._acquire(priority, tokens)
+        try:
+            yield Ticket(self, tokens)
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    async def _acquire(self, priority: Priority, tokens: int) -> None:
+        if self.queue_depth >= self.max_queue:
+            self.stats["rejected_full"] += 1
+            raise SchedulerBusy(f"LLM queue full ({self.max_queue} waiting)")
+
+        waiter = _Waiter(priority, next(self._seq), tokens,
+                         asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self.stats["timed_out"] += 1
+                raise SchedulerBusy(f"LLM queue wait exceeded {self.queue_timeout:.0f}s")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as the caller went away: hand the slot back
+                self.in_flight -= 1
+                self._dispatch()
+            else:
+                waiter.future.cancel()
+            raise
+        self._waits[priority].append(time.monotonic() - waiter.enqueued)
+
+    def _dispatch(self) -> None:
+        """Admit waiters from the head of the queue while budgets allow."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        while self._heap:
+            waiter = self._heap[0]
+            if waiter.future.done():  # timed out or cancelled
+                heapq.heappop(self._heap)
+                continue
+            if self.in_flight >= self.max_concurrency:
+                return  # a release will dispatch again
+            delay = max(
+                self.requests.delay(1) if self.requests else 0.0,
+                self.tokens.delay(waiter.tokens) if self.tokens else 0.0,
+            )
+            if delay > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._heap)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            waiter.future.set_result(None)
+
+    def metrics(self) -> Dict:
+        """Queue depth, in-flight calls and wait-time percentiles per priority."""
+        waits = {}
+        for priority, samples in self._waits.items():
+            ordered = sorted(samples)
+            if ordered:
+                waits[priority.name.lower()] = {
+                    "p50_s": round(ordered[len(ordered) // 2], 3),
+                    "p95_s": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                }
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "wait": waits,
+        }
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int) -> int:
+    """Prompt tokens plus the completion budget, for admission."""
+    prompt = sum(count_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+    return prompt + max_tokens
+
+
+_scheduler: Optional[LLMScheduler] = None
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Process-wide scheduler built from config."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler(
+            requests_per_minute=config.llm_requests_per_minute,
+            tokens_per_minute=config.llm_tokens_per_minute,
+            max_concurrency=config.llm_max_concurrency,
+            max_queue=config.llm_max_queue,
+            queue_timeout=config.llm_queue_timeout,
+        )
+        logger.info(
+            f"LLM scheduler: {config.llm_requests_per_minute or '∞'} req/min, "
+            f"{config.llm_tokens_per_minute or '∞'} tokens/min, "
+            f"concurrency {config.llm_max_concurrency}, queue {config.llm_max_queue}"
+        )
+    return _scheduler
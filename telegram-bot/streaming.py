@@ -0,0 +1,151 @@
+"""
+Streaming replies for Telegram
+
+The model's answer is shown while it is generated: a first message is sent
+as soon as the opening tokens arrive, then edited in place at a throttled
+interval. Telegram allows roughly one message or edit per second per chat,
+so edits are spaced by ``edit_interval`` and a 429 (RetryAfter) pushes the
+next edit back instead of failing the reply.
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram's limit for one text message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class StreamStats:
+    """Rolling time-to-first-visible-token and edit counters."""
+
+    def __init__(self, window: int = 1000):
+        self.ttft: Deque[float] = deque(maxlen=window)
+        self.replies = 0
+        self.edits = 0
+        self.throttled = 0
+
+    def record_first_token(self, seconds: float) -> None:
+        self.ttft.append(seconds)
+
+    def snapshot(self) -> Dict:
+        ordered = sorted(self.ttft)
+
+        def pct(p: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 3)
+
+        return {
+            "replies": self.replies,
+            "edits": self.edits,
+            "throttled": self.throttled,
+            "ttft_p50_s": pct(0.50),
+            "ttft_p95_s": pct(0.95),
+        }
+
+
+stream_stats = StreamStats()
+
+
+def _message_end(text: str, offset: int) -> int:
+    """End of the message starting at ``offset``, split at a line or word break."""
+    end = offset + MAX_MESSAGE_LENGTH
+    if end >= len(text):
+        return len(text)
+    for sep in ("\n", " "):
+        cut = text.rfind(sep, offset + MAX_MESSAGE_LENGTH // 2, end)
+        if cut != -1:
+            return cut + 1
+    return end
+
+
+async def iter_deltas(stream) -> AsyncIterator[str]:
+    """Text pieces of an OpenAI ``stream=True`` chat completion."""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def stream_reply(reply_to: Message, deltas: AsyncIterator[str],
+                       started: Optional[float] = None, edit_interval: float = 1.0,
+                       first_chars: int = 20) -> str:
+    """Show ``deltas`` as a progressively edited reply; returns the full text.
+
+    Args:
+        reply_to: Message being answered.
+        deltas: Text pieces as they arrive from the model.
+        started: ``time.monotonic()`` when the request began, for the
+            time-to-first-visible-token metric (defaults to now).
+        edit_interval: Minimum seconds between edits of the reply.
+        first_chars: Characters collected before the first message is sent,
+            so it does not open with a single word.
+    """
+    started = time.monotonic() if started is None else started
+    text = ""
+    offset = 0  # start of the part shown in the current message
+    current: Optional[Message] = None
+    shown = ""
+    next_edit = 0.0
+
+    async def show(final: bool = False) -> None:
+        nonlocal current, shown, offset, next_edit
+        while True:
+            end = _message_end(text, offset)
+            visible = text[offset:end]
+            if visible == shown and end < len(text):
+                # This message is already complete; the rest goes in a new one
+                offset = end
+                current, shown = None, ""
+                continue
+            if not visible.strip() or visible == shown:
+                return
+            now = time.monotonic()
+            if not final and now < next_edit:
+                return
+            try:
+                if current is None:
+                    current = await reply_to.reply_text(visible)
+                    if offset == 0:
+                        ttft = time.monotonic() - started
+                        stream_stats.record_first_token(ttft)
+                        logger.debug(f"First tokens shown in chat {reply_to.chat_id} after {ttft:.2f}s")
+                else:
+                    await current.edit_text(visible)
+                    stream_stats.edits += 1
+            except RetryAfter as e:
+                stream_stats.throttled += 1
+                next_edit = now + e.retry_after
+                if not final:
+                    return
+                await asyncio.sleep(e.retry_after)
+                continue
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            shown = visible
+            next_edit = time.monotonic() + edit_interval
+            # A full message is finished; the rest continues in a new one
+            if end < len(text):
+                offset = end
+                current, shown = None, ""
+                continue
+            return
+
+    async for piece in deltas:
+        text += piece
+        if current is None and offset == 0 and len(text.strip()) < first_chars:
+            continue
+        await show()
+
+    await show(final=True)
+    stream_stats.replies += 1
+    return text
+
@@ -0,0 +1,460 @@
+"""
+Multi-process runtime for the advanced bot
+
+One supervisor process long-polls Telegram and hands every update to one of
+N worker processes, picked by consistent hashing on the chat id. A chat
+always lands on the same worker and each worker runs a chat's updates one at
+a time, so replies stay in order within a chat while different chats run in
+parallel on every core.
+
+Workers are ordinary bot_advanced applications without an updater. They
+share the configured memory backend (Redis or SQLite for state that survives
+a worker crash; the in-memory backend keeps one store per worker, which is
+still consistent because a chat never changes worker).
+
+A worker acknowledges an update once it has been answered; for text
+messages buffered by the coalescer that is when the batch holding them has
+been replied to, not when the handler returns. A crashed worker is
+restarted in the same slot, so no chat moves and the updates it had not
+acknowledged are replayed to the new process in their original order. A
+slot that keeps crashing is retired: its chats, and their queued updates,
+move to the remaining workers.
+
+Usage:
+    python supervisor.py [--workers 4]
+"""
+
+import os
+import sys
+import time
+import bisect
+import signal
+import hashlib
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from dotenv import load_dotenv  # type: ignore
+except ImportError:
+    # Dummy function if dotenv not installed
+    def load_dotenv():
+        pass
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+load_dotenv()
+
+from config import config
+
+logging.basicConfig(
+    level=config.log_level,
+    format="%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+READY = "ready"
+
+
+class HashRing:
+    """Consistent hash ring mapping routing keys to worker slots.
+
+    Each slot owns ``replicas`` points on the ring, so removing a slot only
+    moves the keys that slot owned and spreads them over the others.
+    """
+
+    def __init__(self, slots: Iterable[int] = (), replicas: int = 160):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: List[int] = []
+        self._slots = set()
+        for slot in slots:
+            self.add(slot)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def add(self, slot: int) -> None:
+        if slot in self._slots:
+            return
+        self._slots.add(slot)
+        for replica in range(self.replicas):
+            point = self._hash(f"slot-{slot}-{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, slot)
+
+    def remove(self, slot: int) -> None:
+        if slot not in self._slots:
+            return
+        self._slots.discard(slot)
+        kept = [(p, o) for p, o in zip(self._points, self._owners) if o != slot]
+        self._points = [p for p, _ in kept]
+        self._owners = [o for _, o in kept]
+
+    def lookup(self, key: Any) -> int:
+        if not self._points:
+            raise LookupError("Hash ring is empty")
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[index]
+
+    def __contains__(self, slot: int) -> bool:
+        return slot in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+def route_key(update: Update) -> int:
+    """Chat id where there is one, so a chat's updates share a worker."""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+# ===== WORKER PROCESS =====
+
+def _worker_main(slot: int, conn, workers: int = 1) -> None:
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group; only the supervisor reacts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if config.snapshot_path:
+        # Each worker holds different chats, so each keeps its own snapshot
+        config.snapshot_path = f"{config.snapshot_path}.{slot}"
+    # Provider budgets are account-wide; each worker gets its share
+    if config.llm_requests_per_minute:
+        config.llm_requests_per_minute = max(1, config.llm_requests_per_minute // workers)
+    if config.llm_tokens_per_minute:
+        config.llm_tokens_per_minute = max(1, config.llm_tokens_per_minute // workers)
+    config.llm_max_concurrency = max(1, config.llm_max_concurrency // workers)
+    if config.metrics_port:
+        # One endpoint per worker, right after the base port
+        config.metrics_port += 1 + slot
+
+    import bot_advanced
+    from telegram.ext import Application
+
+    app = bot_advanced.build_application(
+        Application.builder().token(config.telegram_token).updater(None)
+    )
+    asyncio.run(_serve(slot, conn, app, bot_advanced.pending_answer))
+
+
+async def _serve(slot: int, conn, app,
+                 pending_answer: Callable[[Update], Optional[asyncio.Future]] = lambda update: None) -> None:
+    """Process updates from the supervisor until it sends ``None``.
+
+    ``pending_answer(update)`` returns a future for work the handlers left
+    running (a coalesced reply); the update is acknowledged when it is done.
+    """
+    loop = asyncio.get_running_loop()
+    receiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"worker-{slot}-recv")
+    # Last scheduled task per chat; the next update of that chat waits on it
+    tails: Dict[int, asyncio.Task] = {}
+
+    def ack(update_id: int) -> None:
+        try:
+            conn.send(update_id)
+        except OSError:
+            pass  # supervisor gone; it replays whatever was not acknowledged
+
+    async def handle(update: Update, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        answered = None
+        try:
+            await app.process_update(update)
+            answered = pending_answer(update)
+        finally:
+            if answered is None:
+                ack(update.update_id)
+        if answered is not None:
+            # Not awaited here: the chat's next update must reach the coalescer
+            # while this one is still buffered
+            answered.add_done_callback(lambda _, update_id=update.update_id: ack(update_id))
+
+    def forget(key: int, task: asyncio.Task) -> None:
+        if tails.get(key) is task:
+            del tails[key]
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    conn.send(READY)
+    logger.info(f"Worker {slot} ready (pid {os.getpid()})")
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(receiver, conn.recv)
+            except (EOFError, OSError):
+                logger.warning(f"Worker {slot} lost its supervisor")
+                break
+            if data is None:
+                break
+            update = Update.de_json(data, app.bot)
+            key = route_key(update)
+            task = asyncio.create_task(handle(update, tails.get(key)))
+            task.add_done_callback(lambda t, key=key: forget(key, t))
+            tails[key] = task
+        if tails:
+            await asyncio.wait(list(tails.values()))
+    finally:
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        receiver.shutdown(wait=False)
+        conn.close()
+        logger.info(f"Worker {slot} stopped")
+
+
+# ===== SUPERVISOR =====
+
+class _Slot:
+    """Supervisor-side state of one worker slot."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.conn = None
+        self.ready = False
+        # Sent but not yet acknowledged, in send order: update_id → (payload, key)
+        self.inflight: "OrderedDict[int, Tuple[dict, int]]" = OrderedDict()
+        # Routed here but not yet sent: (update_id, payload, route key)
+        self.pending: Deque[Tuple[int, dict, int]] = deque()
+        self.restarts: Deque[float] = deque()
+        self.reader: Optional[asyncio.Task] = None
+
+    @property
+    def backlog(self) -> int:
+        return len(self.inflight) + len(self.pending)
+
+
+class Supervisor:
+    """Polls Telegram and routes updates to chat-sharded worker processes.
+
+    Args:
+        workers: Number of worker processes.
+        max_inflight: Unacknowledged updates allowed per worker; the rest
+            wait in the supervisor so a slow worker cannot flood its pipe.
+        max_backlog: Total queued updates at which polling pauses.
+        max_restarts: Crashes within ``restart_window`` seconds after which
+            a slot is retired and its chats move to the other workers.
+    """
+
+    def __init__(self, workers: int, max_inflight: int = 256, max_backlog: int = 10_000,
+                 max_restarts: int = 5, restart_window: float = 60.0,
+                 poll_timeout: int = 30):
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.max_backlog = max_backlog
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.poll_timeout = poll_timeout
+        self.ring = HashRing(range(workers))
+        self.slots = {index: _Slot(index) for index in range(workers)}
+        self._mp = multiprocessing.get_context("spawn")
+        # One blocking recv() per worker pipe
+        self._io = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="supervisor-recv")
+        self._stopping = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._closing = False
+        self._offset: Optional[int] = None
+        self._failed: Optional[str] = None
+
+    # ----- workers -----
+
+    def _spawn(self, slot: _Slot) -> None:
+        parent, child = self._mp.Pipe()
+        process = self._mp.Process(
+            target=_worker_main, args=(slot.index, child, self.workers), name=f"worker-{slot.index}"
+        )
+        process.start()
+        child.close()
+        slot.process, slot.conn, slot.ready = process, parent, False
+        slot.reader = asyncio.create_task(self._read_acks(slot))
+        logger.info(f"Started worker {slot.index} (pid {process.pid})")
+
+    async def _read_acks(self, slot: _Slot) -> None:
+        loop = asyncio.get_running_loop()
+        conn = slot.conn
+        while True:
+            try:
+                message = await loop.run_in_executor(self._io, conn.recv)
+            except (EOFError, OSError):
+                break
+            if message == READY:
+                slot.ready = True
+            else:
+                slot.inflight.pop(message, None)
+            self._pump(slot)
+        await self._on_exit(slot)
+
+    async def _on_exit(self, slot: _Slot) -> None:
+        """Replay the slot's unacknowledged updates to a fresh worker."""
+        process = slot.process
+        await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+        slot.conn.close()
+        if self._closing:
+            return
+
+        logger.error(
+            f"Worker {slot.index} exited with code {process.exitcode}; "
+            f"{len(slot.inflight)} unacknowledged updates will be replayed"
+        )
+        # Unacknowledged updates go first, in the order they were sent
+        replay = deque((uid, data, key) for uid, (data, key) in slot.inflight.items())
+        replay.extend(slot.pending)
+        slot.inflight.clear()
+        slot.pending = replay
+
+        now = time.monotonic()
+        slot.restarts.append(now)
+        while slot.restarts and now - slot.restarts[0] > self.restart_window:
+            slot.restarts.popleft()
+        if len(slot.restarts) > self.max_restarts:
+            self._retire(slot)
+            return
+        self._spawn(slot)
+
+    def _retire(self, slot: _Slot) -> None:
+        """Take a crash-looping slot off the ring and re-route its chats."""
+        self.ring.remove(slot.index)
+        del self.slots[slot.index]
+        if not self.ring:
+            self._failed = "every worker slot was retired"
+            self._stopping.set()
+            return
+        logger.error(
+            f"Worker {slot.index} crashed {len(slot.restarts)} times in "
+            f"{self.restart_window:.0f}s; moving its chats to {len(self.ring)} other workers"
+        )
+        # Each chat on this slot moves as a whole, so its order is kept
+        for update_id, data, key in slot.pending:
+            self._route(update_id, data, key)
+
+    def _pump(self, slot: _Slot) -> None:
+        """Send pending updates while the worker has room."""
+        if not slot.ready:
+            return
+        while slot.pending and len(slot.inflight) < self.max_inflight:
+            update_id, data, key = slot.pending.popleft()
+            slot.inflight[update_id] = (data, key)
+            try:
+                slot.conn.send(data)
+            except (BrokenPipeError, OSError):
+                # The reader notices the exit and replays inflight
+                slot.ready = False
+                return
+        if self._stopping.is_set():
+            self._check_drained()
+
+    def _check_drained(self) -> None:
+        if not any(slot.backlog for slot in self.slots.values()):
+            self._drained.set()
+
+    def _route(self, update_id: int, data: dict, key: int) -> None:
+        slot = self.slots[self.ring.lookup(key)]
+        slot.pending.append((update_id, data, key))
+        self._pump(slot)
+
+    def dispatch(self, update: Update) -> None:
+        self._route(update.update_id, update.to_dict(), route_key(update))
+
+    def backlog(self) -> int:
+        return sum(slot.backlog for slot in self.slots.values())
+
+    # ----- polling -----
+
+    async def _poll(self, bot: Bot) -> None:
+        """Long-poll Telegram until stopped."""
+        while not self._stopping.is_set():
+            if self.backlog() >= self.max_backlog:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                updates = await bot.get_updates(
+                    offset=self._offset, timeout=self.poll_timeout,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            except TelegramError as e:
+                logger.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.dispatch(update)
+                self._offset = update.update_id + 1
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        for slot in list(self.slots.values()):
+            self._spawn(slot)
+
+        api_urls = {}
+        if config.telegram_api_url:
+            api_urls = {"base_url": f"{config.telegram_api_url}/bot",
+                        "base_file_url": f"{config.telegram_api_url}/file/bot"}
+        async with Bot(config.telegram_token, **api_urls) as bot:
+            await bot.delete_webhook()
+            logger.info(f"🎬 Polling with {self.workers} workers")
+            poller = asyncio.create_task(self._poll(bot))
+            await self._stopping.wait()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+
+            logger.info("Stopping: waiting for workers to finish queued updates")
+            self._check_drained()
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                logger.warning(f"{self.backlog()} updates still queued at shutdown")
+            if self._offset is not None:
+                # Confirm the dispatched updates so Telegram does not resend them
+                await bot.get_updates(offset=self._offset, timeout=0)
+
+        self._closing = True
+        for slot in self.slots.values():
+            try:
+                slot.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        await asyncio.gather(*(slot.reader for slot in self.slots.values()),
+                             return_exceptions=True)
+        self._io.shutdown(wait=False)
+        if self._failed:
+            raise RuntimeError(f"Supervisor stopped: {self._failed}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=config.workers or os.cpu_count() or 1,
+                        help="Worker processes (default: WORKERS or the CPU count)")
+    args = parser.parse_args()
+
+    config.validate()
+    backend = config.memory_backend or ("redis" if config.use_redis else "memory")
+    logger.info(f"🚀 Supervisor starting {args.workers} workers, memory backend: {backend}")
+    if backend == "memory" and args.workers > 1:
+        logger.warning("In-memory backend: a chat's history is lost if its worker slot is retired")
+
+    try:
+        asyncio.run(Supervisor(args.workers).run())
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
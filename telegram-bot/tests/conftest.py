@@ -0,0 +1,8 @@
+"""Make the bot modules importable from the tests directory."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
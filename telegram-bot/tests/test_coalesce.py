@@ -0,0 +1,64 @@
+"""
+Answer futures of coalesced messages
+
+The supervisor's workers acknowledge a coalesced update only when its
+future resolves, so it must resolve once the reply exists and never for
+a batch that was cancelled without an answer.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from coalesce import MessageCoalescer
+
+
+def _message(message_id: int, text: str = "hi") -> SimpleNamespace:
+    return SimpleNamespace(message_id=message_id, text=text)
+
+
+def test_future_resolves_after_the_folded_batch_is_answered():
+    async def run():
+        answered = []
+
+        async def respond(batch):
+            await asyncio.sleep(0.1)
+            answered.append([message.message_id for message in batch.messages])
+
+        coalescer = MessageCoalescer(respond, window=0.05, max_wait=5)
+        first = coalescer.submit(1, _message(1))
+        await asyncio.sleep(0.08)  # first batch is waiting for the model
+        second = coalescer.submit(1, _message(2))  # cancels it and folds it in
+
+        assert not first.done()
+        await asyncio.wait_for(asyncio.gather(first, second), 2)
+        assert answered == [[1, 2]]
+        assert coalescer.answered(1, 1) is None
+
+    asyncio.run(run())
+
+
+def test_cancelled_batch_does_not_resolve():
+    async def run():
+        async def respond(batch):
+            await asyncio.sleep(10)
+
+        coalescer = MessageCoalescer(respond, window=0.01)
+        future = coalescer.submit(1, _message(1))
+        await asyncio.sleep(0.05)
+        coalescer._chats[1].inflight.cancel()
+        await asyncio.sleep(0.01)
+
+        assert not future.done()
+
+    asyncio.run(run())
+
+
+def test_failed_batch_resolves():
+    async def run():
+        async def respond(batch):
+            raise RuntimeError("model down")
+
+        coalescer = MessageCoalescer(respond, window=0.01)
+        await asyncio.wait_for(coalescer.submit(1, _message(1)), 1)
+
+    asyncio.run(run())
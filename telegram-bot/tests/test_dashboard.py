@@ -0,0 +1,41 @@
+"""
+Model choice for dashboard analyses
+
+Analyses go through the model router like chat and voice replies, capped
+at the dashboard's own completion budget.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from dashboard import ANALYSIS_MAX_TOKENS, DashboardManager
+from router import ModelRouter
+from scheduler import LLMScheduler
+
+
+class RecordingLLM:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Temperatures are stable."))],
+            usage=SimpleNamespace(total_tokens=120),
+        )
+
+
+def test_analysis_uses_the_routed_model_within_its_budget():
+    async def run():
+        llm = RecordingLLM()
+        router = ModelRouter("fast-model", "strong-model", long_max_tokens=1500)
+        dashboard = DashboardManager(llm, LLMScheduler(), router)
+
+        data = {"feeds": [{"field1": str(20 + index)} for index in range(10)]}
+        assert await dashboard.analyze_with_ai(data, "sensor") == "Temperatures are stable."
+
+        (call,) = llm.calls
+        assert call["model"] == "strong-model"
+        assert call["max_tokens"] == ANALYSIS_MAX_TOKENS
+
+    asyncio.run(run())
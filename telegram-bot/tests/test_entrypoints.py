@@ -0,0 +1,39 @@
+"""
+Import order of the entry points
+
+config reads the environment once, on import. Every project module an
+entry point imports (dashboard, scheduler, llm, ...) reaches config, so
+all of them must come after load_dotenv() or settings from .env are lost.
+"""
+
+import ast
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+PROJECT_MODULES = {path.stem for path in ROOT.glob("*.py")}
+
+
+def _top_level(tree: ast.Module):
+    """Imported project modules and the index of load_dotenv(), in order."""
+    for index, node in enumerate(tree.body):
+        if isinstance(node, ast.ImportFrom) and node.module in PROJECT_MODULES:
+            yield index, node.module
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name in PROJECT_MODULES:
+                    yield index, alias.name
+        elif (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+              and getattr(node.value.func, "id", None) == "load_dotenv"):
+            yield index, None
+
+
+@pytest.mark.parametrize("entry_point", ["bot.py", "bot_advanced.py", "supervisor.py"])
+def test_project_imports_follow_load_dotenv(entry_point):
+    tree = ast.parse((ROOT / entry_point).read_text(encoding="utf-8"))
+    found = list(_top_level(tree))
+    calls = [index for index, module in found if module is None]
+    assert calls, f"{entry_point} never calls load_dotenv()"
+    early = [module for index, module in found if module and index < calls[0]]
+    assert early == [], f"{entry_point} imports {early} before load_dotenv()"
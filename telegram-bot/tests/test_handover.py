@@ -0,0 +1,52 @@
+"""
+Agent-mode cache racing with invalidations
+
+With a backend that pushes invalidations the cache has no TTL, so a read
+that an invalidation overtook must not be cached, or the chat could stay
+in the wrong mode indefinitely.
+"""
+
+import asyncio
+
+from handover import AGENT_KEY, AgentModeRegistry
+from memory import InMemoryBackend
+
+
+class PushingBackend(InMemoryBackend):
+    """Pretends to push invalidations; metadata reads wait for ``release``."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.listeners = []
+
+    @property
+    def pushes_invalidations(self) -> bool:
+        return True
+
+    def add_invalidation_listener(self, callback) -> None:
+        self.listeners.append(callback)
+
+    async def get_metadata(self, chat_id, key):
+        value = await super().get_metadata(chat_id, key)
+        await self.release.wait()
+        return value
+
+
+def test_read_overtaken_by_invalidation_is_not_cached():
+    async def run():
+        backend = PushingBackend()
+        registry = AgentModeRegistry(backend)
+
+        read = asyncio.create_task(registry.get(1))
+        await asyncio.sleep(0)  # read has the old value (no agent) in hand
+        # Another worker enables agent mode and the invalidation arrives
+        await backend.set_metadata(1, AGENT_KEY, {"agent": "alice"})
+        for listener in backend.listeners:
+            listener(1)
+        backend.release.set()
+        assert await read is None
+
+        assert await registry.get(1) == {"agent": "alice"}
+
+    asyncio.run(run())
@@ -0,0 +1,190 @@
+"""
+LLMClient retries, deadlines, hedging and circuit breaker
+
+The provider is replaced by a fake ``chat.completions.create`` whose
+behaviour each test scripts.
+"""
+
+import time
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from llm import CircuitBreaker, CircuitOpen, DeadlineExceeded, LLMClient
+
+
+class FakeOpenAI:
+    """Just enough of AsyncOpenAI for LLMClient: ``create`` is the endpoint."""
+
+    def __init__(self, create):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+    def with_options(self, **options):
+        return self
+
+
+def _client(create, **kwargs) -> LLMClient:
+    kwargs.setdefault("backoff_base", 0.001)
+    return LLMClient(FakeOpenAI(create), **kwargs)
+
+
+def _status_error(status: int, retry_after: str = "") -> openai.APIStatusError:
+    headers = {"retry-after": retry_after} if retry_after else {}
+    response = httpx.Response(status, headers=headers,
+                              request=httpx.Request("POST", "https://api.test/v1/chat/completions"))
+    return openai.APIStatusError(f"status {status}", response=response, body=None)
+
+
+def _scripted(*outcomes):
+    """Endpoint returning (or raising) ``outcomes`` in turn; counts calls."""
+    calls = []
+
+    async def create(**kwargs):
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(kwargs)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    return create, calls
+
+
+def test_retryable_errors_are_retried_until_success():
+    create, calls = _scripted(_status_error(503), openai.APIConnectionError(
+        request=httpx.Request("POST", "https://api.test")), "reply")
+    llm = _client(create)
+    assert asyncio.run(llm.create(model="m")) == "reply"
+    assert len(calls) == 3
+    assert llm.stats["retries"] == 2
+    assert llm.breaker.state == "closed" and llm.breaker.failures == 0
+
+
+def test_retry_after_header_sets_the_minimum_backoff():
+    create, calls = _scripted(_status_error(429, retry_after="0.3"), "reply")
+    llm = _client(create)
+    started = time.monotonic()
+    assert asyncio.run(llm.create(model="m")) == "reply"
+    assert time.monotonic() - started >= 0.3
+    assert len(calls) == 2
+
+
+def test_non_retryable_error_is_raised_at_once_and_spares_the_breaker():
+    create, calls = _scripted(_status_error(400), "reply")
+    llm = _client(create, breaker=CircuitBreaker(threshold=1))
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(llm.create(model="m"))
+    assert len(calls) == 1
+    assert llm.breaker.state == "closed"
+
+
+def test_retries_stop_at_max_attempts():
+    create, calls = _scripted(_status_error(500))
+    llm = _client(create, max_attempts=2)
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(llm.create(model="m"))
+    assert len(calls) == 2
+    assert llm.stats["failures"] == 1
+
+
+def test_deadline_bounds_the_whole_call():
+    async def hang(**kwargs):
+        await asyncio.sleep(60)
+
+    llm = _client(hang)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(llm.create(model="m", deadline=0.2))
+    assert time.monotonic() - started < 1.0
+
+
+def test_breaker_opens_rejects_then_probes_after_cooldown():
+    async def run():
+        create, calls = _scripted(_status_error(503), _status_error(503), _status_error(503), "reply")
+        llm = _client(create, max_attempts=1, breaker=CircuitBreaker(threshold=2, cooldown=0.2))
+
+        with pytest.raises(openai.APIStatusError):
+            await llm.create(model="m")
+        # The failure that opens the circuit is reported as such
+        with pytest.raises(CircuitOpen):
+            await llm.create(model="m")
+        assert llm.breaker.state == "open"
+
+        # Open: fail fast without reaching the provider
+        with pytest.raises(CircuitOpen):
+            await llm.create(model="m")
+        assert len(calls) == 2 and llm.stats["short_circuited"] == 1
+
+        # Cooldown over: one probe; its failure opens the circuit again
+        await asyncio.sleep(0.25)
+        with pytest.raises(CircuitOpen):
+            await llm.create(model="m")
+        assert len(calls) == 3 and llm.breaker.state == "open"
+
+        # Next probe succeeds and closes it
+        await asyncio.sleep(0.25)
+        assert await llm.create(model="m") == "reply"
+        assert llm.breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_half_open_breaker_allows_a_single_probe():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.record_failure()
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.record_success()
+    assert breaker.allow() is True
+
+
+def test_hedge_wins_and_the_slow_attempt_is_cancelled():
+    async def run():
+        cancelled = []
+        calls = []
+
+        async def create(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return "hedged reply"
+
+        llm = _client(create, hedge=True)
+        llm._latencies.extend([0.05] * 20)  # p95 of 50 ms
+        assert await llm.create(model="m") == "hedged reply"
+        await asyncio.sleep(0)  # let the loser see its cancellation
+        assert len(calls) == 2
+        assert cancelled == [True]
+        assert llm.stats["hedges"] == 1 and llm.stats["hedge_wins"] == 1
+
+    asyncio.run(run())
+
+
+def test_cancelled_half_open_probe_lets_the_next_call_probe():
+    async def run():
+        async def hang(**kwargs):
+            await asyncio.sleep(60)
+
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        probe = asyncio.create_task(_client(hang, breaker=breaker).create(model="m"))
+        await asyncio.sleep(0.05)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+
+        async def ok(**kwargs):
+            return "reply"
+
+        assert await _client(ok, breaker=breaker).create(model="m") == "reply"
+        assert breaker.state == "closed"
+
+    asyncio.run(run())
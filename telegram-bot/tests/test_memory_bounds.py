@@ -0,0 +1,73 @@
+"""
+InMemoryBackend bounds
+
+At most ``max_chats`` chats are kept, evicting the least recently used,
+and chats idle for longer than ``idle_ttl`` are dropped by the sweeper.
+"""
+
+import asyncio
+
+import pytest
+
+import memory
+from memory import InMemoryBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Wall clock the backend sees, moved by hand."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(memory.time, "time", lambda: now[0])
+    return now
+
+
+async def _contents(backend, chat_id: int):
+    return [msg.content for msg in await backend.get_history(chat_id)]
+
+
+def test_least_recently_used_chat_is_evicted_at_max_chats(clock):
+    async def run():
+        backend = InMemoryBackend(max_chats=3)
+        for chat_id in (1, 2, 3):
+            await backend.add_message(chat_id, "user", f"hello from {chat_id}")
+        await backend.get_history(1)  # 2 is now the least recently used
+        await backend.add_message(4, "user", "hello from 4")
+
+        assert await _contents(backend, 2) == []
+        for chat_id in (1, 3, 4):
+            assert await _contents(backend, chat_id) == [f"hello from {chat_id}"]
+        stats = backend.stats()
+        assert stats["chats"] == 3 and stats["evictions"] == 1 and stats["messages"] == 3
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_idle_chats_expire(clock):
+    async def run():
+        backend = InMemoryBackend(idle_ttl=100, sweep_interval=3600)
+        await backend.add_message(1, "user", "old")
+        clock[0] += 60
+        await backend.add_message(2, "user", "recent")
+        clock[0] += 60  # chat 1 idle for 120s, chat 2 for 60s
+
+        assert backend.expire_idle() == 1
+        assert await _contents(backend, 1) == []
+        assert await _contents(backend, 2) == ["recent"]
+        stats = backend.stats()
+        assert stats["expirations"] == 1 and stats["messages"] == 1
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_sweeper_runs_in_the_background(clock):
+    async def run():
+        backend = InMemoryBackend(idle_ttl=100, sweep_interval=0.01)
+        await backend.add_message(1, "user", "old")
+        clock[0] += 200
+        await asyncio.sleep(0.05)
+        assert backend.stats()["chats"] == 0
+        await backend.close()
+
+    asyncio.run(run())
@@ -0,0 +1,117 @@
+"""
+Compaction racing with appends
+
+The summarizer is slow, and replies keep arriving while it runs. Whatever
+the appends prune from the head meanwhile, compaction must only evict
+messages the summary actually covers.
+"""
+
+import asyncio
+from typing import List, Optional
+
+import pytest
+
+from memory import (
+    SUMMARY_KEY, InMemoryBackend, Message, MemoryManager, RedisBackend, SQLiteBackend,
+)
+from resp_server import RespServer
+
+MAX_HISTORY = 8
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_backend(request, tmp_path):
+    def make():
+        if request.param == "sqlite":
+            return SQLiteBackend(str(tmp_path / "memory.db"), max_history=MAX_HISTORY)
+        if request.param == "redis":
+            port = RespServer().start_in_thread()
+            return RedisBackend(f"redis://127.0.0.1:{port}", max_history=MAX_HISTORY)
+        return InMemoryBackend(max_history=MAX_HISTORY)
+    return make
+
+
+def _contents(history: List[Message]) -> List[str]:
+    return [msg.content for msg in history]
+
+
+async def _fill(backend, count: int, start: int = 0) -> None:
+    for index in range(start, start + count, 2):
+        await backend.add_messages(1, [("user", f"m{index}"), ("assistant", f"m{index + 1}")])
+
+
+def test_compact_trims_only_summarized_messages(make_backend):
+    async def run():
+        backend = make_backend()
+        summarized: List[str] = []
+
+        async def summarize(summary: Optional[str], messages: List[Message]) -> str:
+            summarized.extend(_contents(messages))
+            return "summary"
+
+        manager = MemoryManager(backend, summarizer=summarize, compact_threshold=6, compact_keep=2)
+        await _fill(backend, 6)  # m0..m5
+
+        await manager.compact(1)
+
+        assert summarized == ["m0", "m1", "m2", "m3"]
+        assert _contents(await backend.get_history(1)) == ["m4", "m5"]
+        assert await backend.get_metadata(1, SUMMARY_KEY) == "summary"
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_compact_racing_with_appends_keeps_unsummarized_messages(make_backend):
+    async def run():
+        backend = make_backend()
+        release = asyncio.Event()
+        summarized: List[str] = []
+
+        async def summarize(summary: Optional[str], messages: List[Message]) -> str:
+            summarized.extend(_contents(messages))
+            await release.wait()
+            return "summary"
+
+        manager = MemoryManager(backend, summarizer=summarize, compact_threshold=6, compact_keep=2)
+        await _fill(backend, 6)  # m0..m5; m0..m3 will be summarized
+
+        task = asyncio.create_task(manager.compact(1))
+        await asyncio.sleep(0.05)
+        # Four more messages: the cap of 8 prunes m0 and m1 from the head
+        await _fill(backend, 4, start=6)
+        assert _contents(await backend.get_history(1))[0] == "m2"
+        release.set()
+        await task
+
+        # A count-based trim of 4 would also drop m6 and m7, never summarized
+        assert summarized == ["m0", "m1", "m2", "m3"]
+        assert _contents(await backend.get_history(1)) == ["m4", "m5", "m6", "m7", "m8", "m9"]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_compact_after_boundary_was_pruned_trims_nothing(make_backend):
+    async def run():
+        backend = make_backend()
+        release = asyncio.Event()
+
+        async def summarize(summary: Optional[str], messages: List[Message]) -> str:
+            await release.wait()
+            return "summary"
+
+        manager = MemoryManager(backend, summarizer=summarize, compact_threshold=6, compact_keep=2)
+        await _fill(backend, 6)
+
+        task = asyncio.create_task(manager.compact(1))
+        await asyncio.sleep(0.05)
+        # Eight more messages push every summarized message out by themselves
+        await _fill(backend, 8, start=6)
+        release.set()
+        await task
+
+        assert _contents(await backend.get_history(1)) == [f"m{i}" for i in range(6, 14)]
+        await backend.close()
+
+    asyncio.run(run())
@@ -0,0 +1,52 @@
+"""
+RedisBackend read-through cache across workers
+
+Each worker caches history locally. A write from one worker must reach
+every other worker's cache through the invalidation feed, so their next
+read goes to Redis instead of answering from a stale copy.
+"""
+
+import time
+import asyncio
+
+from memory import RedisBackend
+from resp_server import RespServer
+
+
+async def _until(condition, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def _contents(history):
+    return [msg.content for msg in history]
+
+
+def test_write_on_one_worker_invalidates_the_other():
+    async def run():
+        url = f"redis://127.0.0.1:{RespServer().start_in_thread()}"
+        first = RedisBackend(url, cache_size=100)
+        second = RedisBackend(url, cache_size=100)
+        await first._get_client()
+        await second._get_client()
+        await _until(lambda: first._cache_live and second._cache_live)
+
+        await first.add_message(1, "user", "hello")
+        await _until(lambda: second.stats["invalidations"] >= 1)
+        assert _contents(await second.get_history(1)) == ["hello"]
+        assert _contents(await second.get_history(1)) == ["hello"]
+        assert second.stats["history_hits"] == 1  # served from the local copy
+
+        await first.add_message(1, "assistant", "hi there")
+        await _until(lambda: second.stats["invalidations"] >= 2)
+        assert _contents(await second.get_history(1)) == ["hello", "hi there"]
+        assert second.stats["history_hits"] == 1
+
+        # A worker's own writes don't invalidate its own cache
+        assert first.stats["invalidations"] == 0
+        await first.close()
+        await second.close()
+
+    asyncio.run(run())
@@ -0,0 +1,121 @@
+"""
+RedisBackend list layout
+
+History is a Redis list, one encoded message per element. Keys written by
+older versions as a single JSON string are converted when first touched
+or by migrate_legacy_history(); any other Redis error must not be
+mistaken for the legacy layout.
+"""
+
+import json
+import asyncio
+
+import pytest
+import redis.asyncio as redis
+
+from memory import Message, RedisBackend
+from resp_server import RespServer
+
+MAX_HISTORY = 4
+
+
+@pytest.fixture
+def url():
+    return f"redis://127.0.0.1:{RespServer().start_in_thread()}"
+
+
+def _legacy(count: int) -> str:
+    """History in the old layout: a JSON list of dicts with ISO timestamps."""
+    return json.dumps([
+        {"role": "user" if index % 2 == 0 else "assistant", "content": f"old{index}",
+         "timestamp": f"2024-01-01T00:00:{index:02d}"}
+        for index in range(count)
+    ])
+
+
+async def _seed(url: str, key: str, value: str, ttl: int = 0) -> None:
+    raw = redis.from_url(url, decode_responses=True)
+    await raw.set(key, value, ex=ttl or None)
+    await raw.aclose()
+
+
+def _contents(history):
+    return [msg.content for msg in history]
+
+
+def test_legacy_key_is_converted_on_read(url):
+    async def run():
+        await _seed(url, "history:1", _legacy(6), ttl=1000)
+        backend = RedisBackend(url, max_history=MAX_HISTORY)
+        assert _contents(await backend.get_history(1)) == ["old2", "old3", "old4", "old5"]
+
+        client = await backend._get_client()
+        assert await client.type("history:1") == "list"
+        assert 0 < await client.ttl("history:1") <= 1000  # remaining TTL kept
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_legacy_key_is_converted_on_append(url):
+    async def run():
+        await _seed(url, "history:1", _legacy(2))
+        backend = RedisBackend(url, max_history=MAX_HISTORY)
+        await backend.add_messages(1, [("user", "new0"), ("assistant", "new1")])
+        assert _contents(await backend.get_history(1)) == ["old0", "old1", "new0", "new1"]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_migrate_legacy_history_converts_every_string_key(url):
+    async def run():
+        for chat_id in (1, 2, 3):
+            await _seed(url, f"history:{chat_id}", _legacy(2))
+        backend = RedisBackend(url, max_history=MAX_HISTORY)
+        await backend.add_message(4, "user", "already a list")
+        assert await backend.migrate_legacy_history() == 3
+        assert await backend.migrate_legacy_history() == 0
+        assert _contents(await backend.get_history(2)) == ["old0", "old1"]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_trim_history_on_list_layout(url):
+    async def run():
+        backend = RedisBackend(url, max_history=MAX_HISTORY)
+        await backend.add_messages(1, [("user", "m0"), ("assistant", "m1")])
+        await backend.add_messages(1, [("user", "m2"), ("assistant", "m3")])
+        history = await backend.get_history(1)
+        await backend.trim_history(1, history[1])
+        assert _contents(await backend.get_history(1)) == ["m2", "m3"]
+
+        # A boundary already pruned away trims nothing
+        await backend.trim_history(1, Message("user", "gone", 1.0))
+        assert _contents(await backend.get_history(1)) == ["m2", "m3"]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_other_redis_errors_are_not_taken_for_legacy_layout(url, monkeypatch):
+    async def run():
+        backend = RedisBackend(url, max_history=MAX_HISTORY)
+        client = await backend._get_client()
+        migrations = []
+
+        async def fail(*args, **kwargs):
+            raise redis.ResponseError("OOM command not allowed when used memory > 'maxmemory'")
+
+        async def migrate(*args):
+            migrations.append(args)
+
+        monkeypatch.setattr(client, "lrange", fail)
+        monkeypatch.setattr(backend, "_migrate_key", migrate)
+        with pytest.raises(redis.ResponseError, match="OOM"):
+            await backend.get_history(1)
+        assert migrations == []
+        await backend.close()
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+"""
+InMemoryBackend snapshots
+
+State written to the snapshot file must come back in a new backend, parsed
+lazily, and must not be lost when a snapshot is cancelled or the backend
+closes while one is being written.
+"""
+
+import os
+import time
+import asyncio
+
+import pytest
+
+from memory import InMemoryBackend
+
+
+@pytest.fixture
+def slow_writes(monkeypatch):
+    """Make each snapshot write take a while, like a large state would."""
+    write = InMemoryBackend._write_snapshot
+
+    def slow(self, *args):
+        time.sleep(0.3)
+        return write(self, *args)
+
+    monkeypatch.setattr(InMemoryBackend, "_write_snapshot", slow)
+
+
+async def _contents(backend, chat_id: int):
+    return [msg.content for msg in await backend.get_history(chat_id)]
+
+
+async def _fields(backend, chat_id: int):
+    return [(msg.role, msg.content, msg.timestamp, msg.tokens)
+            for msg in await backend.get_history(chat_id)]
+
+
+def test_cancelled_snapshot_keeps_state_dirty(tmp_path, slow_writes):
+    path = str(tmp_path / "memory.snap")
+
+    async def run():
+        backend = InMemoryBackend(snapshot_path=path, snapshot_interval=3600)
+        await backend.add_message(1, "user", "hello")
+        task = asyncio.create_task(backend.snapshot())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert backend._dirty
+        assert not os.path.exists(f"{path}.tmp")
+        await backend.close()
+
+        restored = InMemoryBackend(snapshot_path=path)
+        assert await _contents(restored, 1) == ["hello"]
+        await restored.close()
+
+    asyncio.run(run())
+
+
+def test_close_during_periodic_snapshot_writes_the_latest_state(tmp_path, slow_writes):
+    path = str(tmp_path / "memory.snap")
+
+    async def run():
+        backend = InMemoryBackend(snapshot_path=path, snapshot_interval=0.01)
+        await backend.add_messages(1, [("user", "first"), ("assistant", "second")])
+        await asyncio.sleep(0.1)  # the snapshotter is now mid-write, nothing newer
+        await backend.close()
+        assert not os.path.exists(f"{path}.tmp")
+
+        restored = InMemoryBackend(snapshot_path=path)
+        assert await _contents(restored, 1) == ["first", "second"]
+        await restored.close()
+
+    asyncio.run(run())
+
+
+def test_snapshot_round_trip_restores_chats_lazily(tmp_path):
+    path = str(tmp_path / "memory.snap")
+
+    async def run():
+        backend = InMemoryBackend(max_history=4, snapshot_path=path, snapshot_interval=3600)
+        for chat_id in (1, 2, 3):
+            for index in range(6):  # more than max_history: only the ring is kept
+                await backend.add_message(chat_id, "user", f"chat{chat_id}-m{index}")
+        await backend.set_metadata(2, "agent_mode", True)
+        expected = {chat_id: await _fields(backend, chat_id) for chat_id in (1, 2, 3)}
+        await backend.snapshot()
+        await backend.close()
+
+        restored = InMemoryBackend(max_history=4, snapshot_path=path, snapshot_interval=3600)
+        # Only the index is read up front
+        assert restored.stats()["snapshot_pending"] == 3
+        assert restored.stats()["chats"] == 0
+        for chat_id in (1, 2):
+            assert await _fields(restored, chat_id) == expected[chat_id]
+        assert await restored.get_metadata(2, "agent_mode") is True
+        assert restored.stats()["snapshot_pending"] == 1
+
+        # Chat 3 is carried over unparsed by the next snapshot
+        await restored.add_message(1, "assistant", "after restart")
+        await restored.close()
+        again = InMemoryBackend(max_history=4, snapshot_path=path)
+        assert await _fields(again, 3) == expected[3]
+        assert (await again.get_history(1))[-1].content == "after restart"
+        await again.close()
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+"""
+SQLiteBackend shutdown
+
+close() waits for the writer and the reader pool without blocking the
+event loop, and closes every per-thread reader connection.
+"""
+
+import time
+import sqlite3
+import asyncio
+
+import pytest
+
+from memory import SQLiteBackend
+
+
+def test_close_waits_off_the_loop_and_closes_reader_connections(tmp_path):
+    async def run():
+        backend = SQLiteBackend(str(tmp_path / "memory.db"), readers=3)
+        await backend.add_messages(1, [("user", "hi"), ("assistant", "hello")])
+        await asyncio.gather(*(backend.get_history(1) for _ in range(10)))
+        connections = list(backend._reader_conns)
+        assert connections
+
+        # A slow read still running when close() starts
+        backend._readers.submit(time.sleep, 0.3)
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        await backend.close()
+        ticker.cancel()
+
+        assert ticks >= 10  # the loop kept running while close() waited
+        for conn in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                conn.execute("SELECT 1")
+
+    asyncio.run(run())
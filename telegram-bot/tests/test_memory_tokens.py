@@ -0,0 +1,37 @@
+"""
+Token counting when tiktoken cannot load
+
+Message() counts tokens on every write, so a tokenizer that fails to load
+(no network for the BPE download, broken install) must fall back to the
+length estimate once, not raise or retry on every message.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import memory
+
+
+@pytest.fixture
+def broken_tiktoken(monkeypatch):
+    loads = []
+
+    def fail(name):
+        loads.append(name)
+        raise OSError("cannot download BPE file")
+
+    fake = SimpleNamespace(encoding_for_model=fail, get_encoding=fail)
+    monkeypatch.setattr(memory, "tiktoken", fake, raising=False)
+    monkeypatch.setattr(memory, "HAS_TIKTOKEN", True)
+    memory._get_encoding.cache_clear()
+    yield loads
+    memory._get_encoding.cache_clear()
+
+
+def test_failed_load_falls_back_to_estimate_once(broken_tiktoken):
+    memory.load_tokenizer()
+    assert memory.count_tokens("x" * 40) == 11
+    memory.Message("user", "hello there")
+    memory.Message("assistant", "hi")
+    assert len(broken_tiktoken) == 1
@@ -0,0 +1,145 @@
+"""
+Backend round trips per conversation turn
+
+A turn (``MemoryManager.start_turn`` → ``build_messages`` → ``commit``)
+must read the history once and write the user and assistant messages in
+one batched call, whatever the backend.
+"""
+
+import asyncio
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pytest
+
+from memory import (
+    SUMMARY_KEY, InMemoryBackend, MemoryBackend, MemoryManager, Message, SQLiteBackend,
+)
+
+READS = {"get_history", "get_metadata", "get_all_metadata", "get_metadata_many"}
+WRITES = {"add_message", "add_messages", "clear_history", "trim_history", "set_metadata"}
+
+
+class CountingBackend(MemoryBackend):
+    """Delegates to a real backend and counts every call made to it."""
+
+    def __init__(self, inner: MemoryBackend):
+        self.inner = inner
+        self.calls: Counter = Counter()
+
+    @property
+    def reads(self) -> int:
+        return sum(self.calls[name] for name in READS)
+
+    @property
+    def writes(self) -> int:
+        return sum(self.calls[name] for name in WRITES)
+
+    def reset(self) -> None:
+        self.calls.clear()
+
+    async def get_history(self, chat_id: int) -> List[Message]:
+        self.calls["get_history"] += 1
+        return await self.inner.get_history(chat_id)
+
+    async def add_message(self, chat_id: int, role: str, content: str) -> None:
+        self.calls["add_message"] += 1
+        await self.inner.add_message(chat_id, role, content)
+
+    async def add_messages(self, chat_id: int, messages: Sequence[Tuple[str, str]]) -> None:
+        self.calls["add_messages"] += 1
+        await self.inner.add_messages(chat_id, messages)
+
+    async def clear_history(self, chat_id: int) -> None:
+        self.calls["clear_history"] += 1
+        await self.inner.clear_history(chat_id)
+
+    async def trim_history(self, chat_id: int, through: Message) -> None:
+        self.calls["trim_history"] += 1
+        await self.inner.trim_history(chat_id, through)
+
+    async def get_metadata(self, chat_id: int, key: str) -> Optional[Any]:
+        self.calls["get_metadata"] += 1
+        return await self.inner.get_metadata(chat_id, key)
+
+    async def set_metadata(self, chat_id: int, key: str, value: Any) -> None:
+        self.calls["set_metadata"] += 1
+        await self.inner.set_metadata(chat_id, key, value)
+
+    async def get_all_metadata(self, chat_id: int) -> Dict[str, Any]:
+        self.calls["get_all_metadata"] += 1
+        return await self.inner.get_all_metadata(chat_id)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_backend(request, tmp_path):
+    def make() -> CountingBackend:
+        if request.param == "sqlite":
+            return CountingBackend(SQLiteBackend(str(tmp_path / "memory.db"), max_history=20))
+        return CountingBackend(InMemoryBackend(max_history=20))
+    return make
+
+
+async def _summarize(summary: Optional[str], messages: List[Message]) -> str:
+    return "summary"
+
+
+def test_turn_reads_once_and_writes_once(make_backend):
+    async def run():
+        backend = make_backend()
+        manager = MemoryManager(backend)
+        await backend.add_messages(1, [("user", "hi"), ("assistant", "hello")])
+        backend.reset()
+
+        turn = await manager.start_turn(1, "how are you?")
+        messages = turn.build_messages()
+        await turn.commit("fine, thanks")
+
+        assert backend.calls == Counter({"get_history": 1, "add_messages": 1})
+        assert [m["content"] for m in messages[1:]] == ["hi", "hello", "how are you?"]
+        history = await backend.inner.get_history(1)
+        assert [(m.role, m.content) for m in history[-2:]] == [
+            ("user", "how are you?"), ("assistant", "fine, thanks"),
+        ]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_turn_with_summary_reads_history_and_summary_once(make_backend):
+    async def run():
+        backend = make_backend()
+        manager = MemoryManager(backend, summarizer=_summarize)
+        await backend.set_metadata(1, SUMMARY_KEY, "earlier: the user likes tea")
+        backend.reset()
+
+        turn = await manager.start_turn(1, "what do I like?")
+        messages = turn.build_messages()
+        await turn.commit("tea")
+
+        assert backend.reads == 2
+        assert backend.calls["get_history"] == 1 and backend.calls["get_metadata"] == 1
+        assert backend.writes == 1 and backend.calls["add_messages"] == 1
+        assert "likes tea" in messages[1]["content"]
+        await backend.close()
+
+    asyncio.run(run())
+
+
+def test_building_the_prompt_does_not_touch_the_backend(make_backend):
+    async def run():
+        backend = make_backend()
+        manager = MemoryManager(backend, token_budget=200)
+        turn = await manager.start_turn(1, "hello")
+        backend.reset()
+
+        turn.build_messages()
+        turn.build_messages()
+
+        assert backend.reads == 0 and backend.writes == 0
+        await backend.close()
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+"""
+Per-user rate limiting
+
+The sliding window is estimated from the previous and current fixed
+windows, in-process or in Redis, and rejected hits do not count. The gate
+runs in handler group -1 and stops an over-limit update before any other
+handler sees it, telling the user once per window.
+"""
+
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, ApplicationHandlerStop, MessageHandler, filters
+
+import ratelimit
+from ratelimit import InMemoryRateLimiter, RateLimitGate, RedisRateLimiter
+from resp_server import RespServer
+
+WINDOW = 60
+START = 1_000_020.0 - 1_000_020.0 % WINDOW  # start of a window
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [START]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=["memory", "redis"])
+def limiter(request):
+    if request.param == "redis":
+        port = RespServer().start_in_thread()
+        return RedisRateLimiter(f"redis://127.0.0.1:{port}", limit=5, window=WINDOW)
+    return InMemoryRateLimiter(limit=5, window=WINDOW)
+
+
+async def _hits(limiter, count: int, key: str = "1", weight: int = 1):
+    return [(await limiter.hit(key, weight))[0] for _ in range(count)]
+
+
+def test_limit_within_one_window(limiter, clock):
+    async def run():
+        assert await _hits(limiter, 6) == [True] * 5 + [False]
+        clock[0] += 30
+        allowed, retry_after = await limiter.hit("1")
+        assert not allowed and retry_after == pytest.approx(30)
+        # Other users have their own budget
+        assert await _hits(limiter, 1, key="2") == [True]
+        await limiter.close()
+
+    asyncio.run(run())
+
+
+def test_previous_window_counts_by_overlap(limiter, clock):
+    async def run():
+        assert await _hits(limiter, 5) == [True] * 5
+        clock[0] += WINDOW + WINDOW / 2  # half of the previous window still overlaps
+        # 5 * 0.5 + current: two more fit, the third would make 5.5
+        assert await _hits(limiter, 3) == [True, True, False]
+        clock[0] += WINDOW  # previous window now holds only the two allowed hits
+        assert await _hits(limiter, 5) == [True] * 4 + [False]
+        await limiter.close()
+
+    asyncio.run(run())
+
+
+def test_weight_and_rejected_hits(limiter, clock):
+    async def run():
+        assert (await limiter.hit("1", weight=4))[0]
+        assert not (await limiter.hit("1", weight=4))[0]  # rejected: not counted
+        assert (await limiter.hit("1", weight=1))[0]
+        assert not (await limiter.hit("1", weight=1))[0]
+        await limiter.close()
+
+    asyncio.run(run())
+
+
+class FailingLimiter(InMemoryRateLimiter):
+    async def hit(self, key, weight=1):
+        raise ConnectionError("redis down")
+
+
+def _update(update_id: int, user_id: int = 7, text: str = "hello") -> Update:
+    user = User(user_id, "user", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE),
+                      from_user=user, text=text)
+    return Update(update_id, message=message)
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    sent = []
+
+    async def reply_text(self, text, *args, **kwargs):
+        sent.append((self.chat_id, text))
+
+    monkeypatch.setattr(Message, "reply_text", reply_text)
+    return sent
+
+
+def test_gate_in_group_minus_one_stops_later_handlers(replies, clock, monkeypatch):
+    async def get_me(self, *args, **kwargs):
+        return User(123456, "bot", True, username="test_bot")
+
+    async def run():
+        app = Application.builder().token("123456:test").build()
+        monkeypatch.setattr(type(app.bot), "get_me", get_me)  # initialize() stays offline
+        await app.initialize()
+        gate = RateLimitGate(InMemoryRateLimiter(limit=2, window=WINDOW))
+        handled = []
+
+        async def reply(update, context):
+            handled.append(update.update_id)
+
+        app.add_handler(gate.handler(), group=-1)
+        app.add_handler(MessageHandler(filters.TEXT, reply))
+        for update_id in range(1, 6):
+            await app.process_update(_update(update_id))
+
+        assert handled == [1, 2]
+        assert len(replies) == 1 and "too quickly" in replies[0][1]  # told once
+        assert gate.stats == {"checked": 5, "throttled": 3}
+        await app.shutdown()
+
+    asyncio.run(run())
+
+
+def test_gate_lets_exempt_free_and_limiter_failures_through(replies, clock):
+    async def run():
+        exempt = RateLimitGate(InMemoryRateLimiter(limit=0), exempt=[7])
+        await exempt(_update(1), None)
+
+        gate = RateLimitGate(InMemoryRateLimiter(limit=0))
+        await gate(_update(2, text="/start"), None)  # commands other than dashboard are free
+        with pytest.raises(ApplicationHandlerStop):
+            await gate(_update(3), None)
+
+        await RateLimitGate(FailingLimiter(limit=0))(_update(4), None)
+        assert len(replies) == 1
+
+    asyncio.run(run())
@@ -0,0 +1,126 @@
+"""
+Response cache hits, expiry and bounds
+
+Exact hits need the very same prompt; similarity hits need the same
+context (model, system prompt, history) and a close enough last message.
+Entries expire after ``ttl`` and the stores keep at most ``max_entries``.
+"""
+
+import math
+import asyncio
+
+import pytest
+
+import response_cache
+from response_cache import InMemoryCacheStore, RedisCacheStore, ResponseCache
+from resp_server import RespServer
+
+SYSTEM = {"role": "system", "content": "You are helpful."}
+
+# Deterministic stand-in for the embeddings endpoint
+VECTORS = {
+    "how much is premium": [1.0, 0.1, 0.0],
+    "how much does premium cost": [1.0, 0.15, 0.0],
+    "what is the weather": [0.0, 0.0, 1.0],
+}
+
+
+async def embed(text: str):
+    vector = VECTORS[text]
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+
+def _prompt(text: str, *history):
+    return [SYSTEM, *history, {"role": "user", "content": text}]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    return now
+
+
+async def _ask(cache: ResponseCache, messages, reply: str, model: str = "m"):
+    """Look up, and store ``reply`` on a miss; returns the probe."""
+    probe = await cache.lookup(messages, model)
+    if probe.reply is None:
+        await cache.store(probe, reply, latency=1.5)
+    return probe
+
+
+def test_exact_hit_ignores_case_whitespace_and_trailing_punctuation():
+    async def run():
+        cache = ResponseCache(InMemoryCacheStore())
+        await _ask(cache, _prompt("Hi there!"), "Hello!")
+        probe = await cache.lookup(_prompt("  hi   THERE "), "m")
+        assert (probe.reply, probe.match) == ("Hello!", "exact")
+        assert cache.stats["saved_latency_s"] == 1.5
+
+        # Same text under another model or history is a different prompt
+        assert (await cache.lookup(_prompt("hi there"), "other")).reply is None
+        history = {"role": "assistant", "content": "Welcome back"}
+        assert (await cache.lookup(_prompt("hi there", history), "m")).reply is None
+
+    asyncio.run(run())
+
+
+def test_similar_hit_needs_the_same_context():
+    async def run():
+        cache = ResponseCache(InMemoryCacheStore(), embedder=embed, similarity=0.95)
+        await _ask(cache, _prompt("How much is premium?"), "$5 a month.")
+
+        probe = await cache.lookup(_prompt("How much does premium cost?"), "m")
+        assert (probe.reply, probe.match) == ("$5 a month.", "similar")
+
+        # Not similar enough
+        assert (await cache.lookup(_prompt("What is the weather?"), "m")).reply is None
+        # Same question, different history: no vector index to search
+        history = {"role": "assistant", "content": "Prices changed today."}
+        assert (await cache.lookup(_prompt("How much does premium cost?", history), "m")).reply is None
+        assert cache.stats["similar_hits"] == 1 and cache.stats["misses"] == 3  # first ask too
+
+    asyncio.run(run())
+
+
+def test_entries_expire_after_ttl(clock):
+    async def run():
+        cache = ResponseCache(InMemoryCacheStore(), ttl=60)
+        await _ask(cache, _prompt("hi"), "Hello!")
+        clock[0] += 59
+        assert (await cache.lookup(_prompt("hi"), "m")).reply == "Hello!"
+        clock[0] += 2
+        assert (await cache.lookup(_prompt("hi"), "m")).reply is None
+
+    asyncio.run(run())
+
+
+def test_in_memory_store_keeps_max_entries():
+    async def run():
+        cache = ResponseCache(InMemoryCacheStore(max_entries=2))
+        for text in ("one", "two", "three"):
+            await _ask(cache, _prompt(text), text.upper())
+        assert (await cache.lookup(_prompt("one"), "m")).reply is None
+        assert (await cache.lookup(_prompt("three"), "m")).reply == "THREE"
+
+    asyncio.run(run())
+
+
+def test_redis_store_trims_oldest_entries_past_max_entries():
+    async def run():
+        port = RespServer().start_in_thread()
+        store = RedisCacheStore(f"redis://127.0.0.1:{port}", max_entries=2)
+        cache = ResponseCache(store)
+        for text in ("one", "two", "three"):
+            await _ask(cache, _prompt(text), text.upper())
+            await asyncio.sleep(0.01)  # distinct insertion times
+
+        client = await store._get_client()
+        assert await client.zcard(store._index_key) == 2
+        assert (await cache.lookup(_prompt("one"), "m")).reply is None
+        assert (await cache.lookup(_prompt("two"), "m")).reply == "TWO"
+        assert (await cache.lookup(_prompt("three"), "m")).reply == "THREE"
+        await cache.close()
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+"""
+Short-message budget of the model router
+
+The small completion budget for short messages only makes sense together
+with a separate, faster model; with one model it just truncates replies.
+"""
+
+import pytest
+
+import router
+from config import config
+from prompts import CHAT
+
+
+@pytest.fixture
+def fresh_router(monkeypatch):
+    monkeypatch.setattr(router, "_router", None)
+    monkeypatch.setattr(config, "router_enabled", True)
+    monkeypatch.setattr(config, "model", "main-model")
+    yield
+    router._router = None
+
+
+def test_short_message_gets_full_budget_without_fast_model(fresh_router, monkeypatch):
+    monkeypatch.setattr(config, "router_fast_model", "")
+    route = router.get_model_router().route(CHAT, "thanks!")
+    assert route.model == "main-model"
+    assert route.max_tokens == config.max_tokens
+
+
+def test_short_message_gets_short_budget_with_fast_model(fresh_router, monkeypatch):
+    monkeypatch.setattr(config, "router_fast_model", "fast-model")
+    route = router.get_model_router().route(CHAT, "thanks!")
+    assert route.model == "fast-model"
+    assert route.max_tokens == config.router_short_max_tokens
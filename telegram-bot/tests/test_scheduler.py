@@ -0,0 +1,142 @@
+"""
+LLMScheduler admission
+
+Waiting calls are admitted by priority class, then arrival; token buckets
+refill over time and tickets reconcile estimates with actual usage; a
+call cancelled or timed out while queued must not leak a slot.
+"""
+
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import LLMScheduler, Priority, SchedulerBusy, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic clock the buckets see; only for tests without an event loop."""
+    now = [1000.0]
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_waiters_are_admitted_by_priority_then_arrival():
+    async def run():
+        llm = LLMScheduler(max_concurrency=1)
+        admitted = []
+
+        async def call(name, priority):
+            async with llm.slot(priority):
+                admitted.append(name)
+
+        async with llm.slot(Priority.INTERACTIVE):
+            tasks = [asyncio.create_task(call(name, priority)) for name, priority in (
+                ("summary", Priority.BACKGROUND),
+                ("weather", Priority.DASHBOARD),
+                ("reply1", Priority.INTERACTIVE),
+                ("reply2", Priority.INTERACTIVE),
+            )]
+            await asyncio.sleep(0.01)
+            assert llm.queue_depth == 4
+        await asyncio.gather(*tasks)
+        assert admitted == ["reply1", "reply2", "weather", "summary"]
+        assert llm.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=20)
+    bucket.take(20)
+    assert bucket.delay(5) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.delay(5) == 0.0
+    clock[0] += 60
+    bucket.delay(1)
+    assert bucket.level == 20
+    # More than capacity can never be had: wait for a full bucket instead
+    bucket.take(20)
+    assert bucket.delay(100) == pytest.approx(2.0)
+
+
+def test_ticket_charge_reconciles_the_estimate(clock):
+    async def run():
+        llm = LLMScheduler(tokens_per_minute=600)
+        async with llm.slot(tokens=100) as ticket:
+            assert llm.tokens.level == 500
+            ticket.charge(300)  # used more than estimated
+            assert llm.tokens.level == 300
+            ticket.charge(50)  # corrected again: refund
+            assert llm.tokens.level == 550
+
+    # Frozen clock: no refill between steps (nothing here waits on loop timers)
+    asyncio.run(run())
+
+
+def test_rate_limited_waiter_is_admitted_after_refill():
+    async def run():
+        llm = LLMScheduler(requests_per_minute=600)  # 10 per second
+        llm.requests.take(llm.requests.level)  # budget spent
+        started = asyncio.get_running_loop().time()
+        async with llm.slot():
+            waited = asyncio.get_running_loop().time() - started
+        assert 0.05 <= waited < 0.5
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_no_trace():
+    async def run():
+        llm = LLMScheduler(max_concurrency=1)
+        async with llm.slot():
+            waiter = asyncio.create_task(llm._acquire(Priority.INTERACTIVE, 0))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            assert llm.queue_depth == 0
+        assert llm.in_flight == 0
+        async with llm.slot():
+            assert llm.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_waiter_cancelled_right_after_admission_returns_its_slot():
+    async def run():
+        llm = LLMScheduler(max_concurrency=1)
+        async def call():
+            async with llm.slot():
+                pass
+
+        holder = llm.slot()
+        await holder.__aenter__()
+        waiter = asyncio.create_task(call())
+        await asyncio.sleep(0.01)
+        await holder.__aexit__(None, None, None)  # admits the waiter...
+        waiter.cancel()  # ...which is cancelled before it resumes
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        # Either way (wait_for may still deliver the admission) no slot leaks
+        assert llm.in_flight == 0
+        async with llm.slot():
+            assert llm.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_full_queue_and_queue_timeout_raise_busy():
+    async def run():
+        llm = LLMScheduler(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        async with llm.slot():
+            queued = asyncio.create_task(llm._acquire(Priority.INTERACTIVE, 0))
+            await asyncio.sleep(0.01)
+            with pytest.raises(SchedulerBusy, match="full"):
+                await llm._acquire(Priority.INTERACTIVE, 0)
+            with pytest.raises(SchedulerBusy, match="exceeded"):
+                await queued
+        assert llm.stats["rejected_full"] == 1 and llm.stats["timed_out"] == 1
+        assert llm.in_flight == 0
+
+    asyncio.run(run())
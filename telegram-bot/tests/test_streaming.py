@@ -0,0 +1,102 @@
+"""
+Streamed replies
+
+Edits of the visible reply are throttled to ``edit_interval``, a 429 pushes
+the next edit back, and a reply longer than Telegram's 4096-character
+limit continues in new messages without losing or repeating text.
+"""
+
+import time
+import asyncio
+from typing import List
+
+from telegram.error import RetryAfter
+
+from streaming import MAX_MESSAGE_LENGTH, stream_reply
+
+
+class FakeSent:
+    """A sent message; records every version of its text."""
+
+    def __init__(self, text: str, throttle_once: bool = False):
+        self.versions = [(time.monotonic(), text)]
+        self.throttle_once = throttle_once
+
+    @property
+    def text(self) -> str:
+        return self.versions[-1][1]
+
+    async def edit_text(self, text: str) -> "FakeSent":
+        if self.throttle_once:
+            self.throttle_once = False
+            raise RetryAfter(0.05)
+        self.versions.append((time.monotonic(), text))
+        return self
+
+
+class FakeIncoming:
+    """The user's message being answered."""
+
+    chat_id = 1
+
+    def __init__(self, throttle_first_edit: bool = False):
+        self.sent: List[FakeSent] = []
+        self.throttle_first_edit = throttle_first_edit
+
+    async def reply_text(self, text: str) -> FakeSent:
+        message = FakeSent(text, throttle_once=self.throttle_first_edit and not self.sent)
+        self.sent.append(message)
+        return message
+
+
+async def _pieces(pieces, delay: float = 0.0):
+    for piece in pieces:
+        if delay:
+            await asyncio.sleep(delay)
+        yield piece
+
+
+def test_edits_are_throttled():
+    async def run():
+        incoming = FakeIncoming()
+        pieces = [f"word{index} " for index in range(50)]
+        text = await stream_reply(incoming, _pieces(pieces, delay=0.01), edit_interval=0.2)
+
+        assert text == "".join(pieces)
+        (reply,) = incoming.sent
+        assert reply.text == text
+        times = [at for at, _ in reply.versions]
+        # ~0.5s of streaming at one edit per 0.2s, plus the final edit
+        assert len(times) <= 5
+        gaps = [later - earlier for earlier, later in zip(times, times[1:-1])]
+        assert all(gap >= 0.19 for gap in gaps)
+
+    asyncio.run(run())
+
+
+def test_long_reply_is_split_across_messages():
+    async def run():
+        incoming = FakeIncoming()
+        pieces = [f"token{index:05d} " for index in range(1500)]  # ~18k characters
+        text = await stream_reply(incoming, _pieces(pieces), edit_interval=0)
+
+        assert len(text) > 4 * MAX_MESSAGE_LENGTH
+        assert len(incoming.sent) == 5
+        assert all(len(message.text) <= MAX_MESSAGE_LENGTH for message in incoming.sent)
+        # Split at word breaks, nothing lost or repeated
+        assert "".join(message.text for message in incoming.sent) == text
+        assert all(message.text.endswith(" ") for message in incoming.sent)
+
+    asyncio.run(run())
+
+
+def test_rate_limited_edit_is_retried_on_the_final_flush():
+    async def run():
+        incoming = FakeIncoming(throttle_first_edit=True)
+        pieces = ["The quick brown fox ", "jumps over ", "the lazy dog."]
+        text = await stream_reply(incoming, _pieces(pieces), edit_interval=0)
+
+        (reply,) = incoming.sent
+        assert reply.text == text == "".join(pieces)
+
+    asyncio.run(run())
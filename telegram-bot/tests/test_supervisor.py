@@ -0,0 +1,121 @@
+"""
+Supervisor replay of unacknowledged updates
+
+Worker processes are replaced by in-process fakes on a real pipe. When a
+worker dies, the updates it had not acknowledged must reach its
+replacement, or the remaining workers once the slot is retired, in their
+original order.
+"""
+
+import time
+import asyncio
+import multiprocessing
+
+from supervisor import READY, HashRing, Supervisor
+
+
+class FakeWorker:
+    """Stands in for a worker process: the test reads, acks and crashes it."""
+
+    def __init__(self, slot: int, conn):
+        self.slot = slot
+        self.conn = conn
+        self.pid = 0
+        self.exitcode = None
+        conn.send(READY)
+
+    def join(self, timeout=None) -> None:
+        pass
+
+    def crash(self) -> None:
+        self.exitcode = 1
+        self.conn.close()
+
+    async def receive(self, count: int):
+        loop = asyncio.get_running_loop()
+        return [(await loop.run_in_executor(None, self.conn.recv))["update_id"]
+                for _ in range(count)]
+
+
+class FakeSupervisor(Supervisor):
+    def __init__(self, workers: int, **kwargs):
+        super().__init__(workers, **kwargs)
+        self.spawned = []
+
+    def _spawn(self, slot) -> None:
+        parent, child = multiprocessing.Pipe()
+        worker = FakeWorker(slot.index, child)
+        slot.process, slot.conn, slot.ready = worker, parent, False
+        slot.reader = asyncio.create_task(self._read_acks(slot))
+        self.spawned.append(worker)
+
+    def worker(self, slot: int) -> FakeWorker:
+        """Latest worker started in ``slot``."""
+        return [worker for worker in self.spawned if worker.slot == slot][-1]
+
+    async def start(self) -> None:
+        for slot in self.slots.values():
+            self._spawn(slot)
+        await _until(lambda: all(slot.ready for slot in self.slots.values()))
+
+    async def stop(self) -> None:
+        self._closing = True
+        for worker in self.spawned:
+            if not worker.conn.closed:
+                worker.crash()
+        await asyncio.gather(*(slot.reader for slot in self.slots.values()), return_exceptions=True)
+        self._io.shutdown()
+
+
+async def _until(condition, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def _key_on(ring: HashRing, slot: int) -> int:
+    """A route key (chat id) that the ring places on ``slot``."""
+    return next(key for key in range(1, 10_000) if ring.lookup(key) == slot)
+
+
+def test_unacknowledged_updates_are_replayed_to_the_restarted_worker():
+    async def run():
+        supervisor = FakeSupervisor(2)
+        await supervisor.start()
+        key = _key_on(supervisor.ring, 0)
+        for update_id in (1, 2, 3):
+            supervisor._route(update_id, {"update_id": update_id}, key)
+
+        first = supervisor.worker(0)
+        assert await first.receive(3) == [1, 2, 3]
+        first.conn.send(1)  # only update 1 is answered before the crash
+        await _until(lambda: 1 not in supervisor.slots[0].inflight)
+        first.crash()
+
+        await _until(lambda: supervisor.worker(0) is not first)
+        assert await supervisor.worker(0).receive(2) == [2, 3]
+        assert supervisor.worker(1) is supervisor.spawned[1]  # other slot untouched
+        await supervisor.stop()
+
+    asyncio.run(run())
+
+
+def test_retired_slot_moves_its_updates_to_the_other_workers():
+    async def run():
+        supervisor = FakeSupervisor(2, max_restarts=0)
+        await supervisor.start()
+        key = _key_on(supervisor.ring, 0)
+        for update_id in (1, 2):
+            supervisor._route(update_id, {"update_id": update_id}, key)
+
+        first = supervisor.worker(0)
+        assert await first.receive(2) == [1, 2]
+        first.crash()
+
+        await _until(lambda: 0 not in supervisor.slots)
+        assert supervisor.ring.lookup(key) == 1
+        assert await supervisor.worker(1).receive(2) == [1, 2]
+        await supervisor.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,124 @@
+"""
+ffmpeg transcoding limits
+
+asyncio.create_subprocess_exec is replaced by a fake process, so the
+concurrency cap, the kill on timeout and error reporting are checked
+without ffmpeg installed.
+"""
+
+import io
+import wave
+import asyncio
+
+import pytest
+
+from voice import AudioConversionError, AudioProcessor
+
+
+class FakeProcess:
+    """An ffmpeg run taking ``seconds`` and printing ``stdout``."""
+
+    running = 0
+    peak = 0
+
+    def __init__(self, seconds: float, stdout: bytes, returncode: int, stderr: bytes):
+        self.seconds = seconds
+        self.stdout = stdout
+        self.final_code = returncode
+        self.stderr = stderr
+        self.returncode = None
+        self.killed = False
+
+    async def communicate(self, data: bytes):
+        FakeProcess.running += 1
+        FakeProcess.peak = max(FakeProcess.peak, FakeProcess.running)
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            FakeProcess.running -= 1
+        self.returncode = self.final_code
+        return self.stdout, self.stderr
+
+    def kill(self) -> None:
+        self.killed = True
+        self.returncode = -9
+
+    async def wait(self) -> int:
+        return self.returncode
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch, tmp_path):
+    """Scripts the next fake ffmpeg runs; records the processes started."""
+    monkeypatch.chdir(tmp_path)  # AudioProcessor creates ./audio_temp
+    FakeProcess.running = FakeProcess.peak = 0
+    script = {"seconds": 0.0, "stdout": b"\x01\x00" * 8, "returncode": 0, "stderr": b""}
+    started = []
+
+    async def create_subprocess_exec(*cmd, **kwargs):
+        if script.get("missing"):
+            raise FileNotFoundError(cmd[0])
+        process = FakeProcess(script["seconds"], script["stdout"], script["returncode"], script["stderr"])
+        started.append(process)
+        return process
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", create_subprocess_exec)
+    script["started"] = started
+    return script
+
+
+def test_concurrent_transcodes_are_capped(ffmpeg):
+    async def run():
+        ffmpeg["seconds"] = 0.05
+        processor = AudioProcessor(max_concurrent=2, timeout=5)
+        jobs = [asyncio.create_task(processor.transcode(b"ogg", [])) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        assert processor.stats["running"] == 2 and processor.stats["waiting"] == 3
+        results = await asyncio.gather(*jobs)
+
+        assert results == [ffmpeg["stdout"]] * 5
+        assert FakeProcess.peak == 2
+        assert processor.stats["jobs"] == 5 and processor.stats["running"] == 0
+
+    asyncio.run(run())
+
+
+def test_slow_ffmpeg_is_killed_and_frees_its_slot(ffmpeg):
+    async def run():
+        processor = AudioProcessor(max_concurrent=1, timeout=0.1)
+        ffmpeg["seconds"] = 60
+        with pytest.raises(AudioConversionError, match="longer than"):
+            await processor.transcode(b"ogg", [])
+        assert ffmpeg["started"][0].killed
+        assert processor.stats["timeouts"] == 1 and processor.stats["failures"] == 1
+
+        ffmpeg["seconds"] = 0
+        assert await processor.transcode(b"ogg", []) == ffmpeg["stdout"]
+
+    asyncio.run(run())
+
+
+def test_ffmpeg_errors_are_reported(ffmpeg):
+    async def run():
+        processor = AudioProcessor(max_concurrent=1, timeout=5)
+        ffmpeg.update(returncode=1, stdout=b"", stderr=b"warning\npipe:0: Invalid data found")
+        with pytest.raises(AudioConversionError, match="exited with 1: pipe:0: Invalid data"):
+            await processor.transcode(b"not ogg", [])
+
+        ffmpeg["missing"] = True
+        with pytest.raises(AudioConversionError, match="not found"):
+            await processor.transcode(b"ogg", [])
+        assert processor.stats["failures"] == 2
+
+    asyncio.run(run())
+
+
+def test_ogg_to_wav_wraps_pcm_for_speech_recognition(ffmpeg):
+    async def run():
+        processor = AudioProcessor(max_concurrent=1, timeout=5)
+        wav = await processor.ogg_to_wav(b"ogg")
+        with wave.open(io.BytesIO(wav)) as audio:
+            assert (audio.getnchannels(), audio.getframerate(), audio.getsampwidth()) == (1, 16000, 2)
+            assert audio.readframes(audio.getnframes()) == ffmpeg["stdout"]
+
+    asyncio.run(run())
@@ -2,14 +2,23 @@
 Voice processing utilities for STT and TTS
 """
 
+import io
 import os
+import wave
+import asyncio
 import logging
-from typing import Optional
+from typing import Optional, Union
 from pathlib import Path
 from abc import ABC, abstractmethod
 
+from config import config
+
 logger = logging.getLogger(__name__)
 
+# What speech recognizers want: 16 kHz, mono, 16-bit PCM
+STT_SAMPLE_RATE = 16000
+STT_SAMPLE_WIDTH = 2
+
 # Optional imports - will be checked when actually used
 try:
     import speech_recognition as sr  # type: ignore
@@ -28,8 +37,8 @@ class STTBackend(ABC):
     """Abstract Speech-To-Text backend."""
     
     @abstractmethod
-    async def transcribe(self, audio_path: str) -> str:
-        """Transcribe audio file to text."""
+    async def transcribe(self, audio: Union[str, bytes]) -> str:
+        """Transcribe a WAV file path, or WAV bytes, to text."""
         pass
 
 
@@ -52,16 +61,19 @@ class GoogleSTT(STTBackend):
         self.recognizer = sr.Recognizer()
         logger.info("GoogleSTT initialized")
     
-    async def transcribe(self, audio_path: str) -> str:
+    async def transcribe(self, audio: Union[str, bytes]) -> str:
         """Transcribe using Google Speech Recognition."""
+        # The recognizer makes a blocking HTTP call; keep it off the event loop
+        return await asyncio.to_thread(self._transcribe, audio)
+    
+    def _transcribe(self, audio: Union[str, bytes]) -> str:
+        source_file = io.BytesIO(audio) if isinstance(audio, bytes) else audio
         try:
-            import speech_recognition as sr  # type: ignore
-            
-            with sr.AudioFile(audio_path) as source:
-                audio = self.recognizer.record(source)
-                text = self.recognizer.recognize_google(audio)
-                logger.info(f"Transcribed: {text[:50]}...")
-                return text
+            with sr.AudioFile(source_file) as source:
+                recorded = self.recognizer.record(source)
+            text = self.recognizer.recognize_google(recorded)
+            logger.info(f"Transcribed: {text[:50]}...")
+            return text
         
         except sr.UnknownValueError:
             raise ValueError("Could not understand audio")
@@ -83,7 +95,7 @@ class GoogleTTS(TTSBackend):
         """Synthesize text to MP3."""
         try:
             tts = self.gTTS(text, lang=language, slow=False)
-            tts.save(output_path)
+            await asyncio.to_thread(tts.save, output_path)
             logger.info(f"Synthesized {len(text)} chars to {output_path}")
             return True
         except Exception as e:
@@ -91,29 +103,106 @@ class GoogleTTS(TTSBackend):
             raise
 
 
+class AudioConversionError(RuntimeError):
+    """ffmpeg is missing, failed, or took too long."""
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int = STT_SAMPLE_RATE,
+               channels: int = 1, sample_width: int = STT_SAMPLE_WIDTH) -> bytes:
+    """Wrap raw little-endian PCM in a WAV header."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
 class AudioProcessor:
-    """Unified audio processing."""
+    """Unified audio processing.
     
-    def __init__(self):
+    Transcoding runs ffmpeg as an asyncio subprocess and pipes the audio
+    through stdin/stdout, so nothing touches the disk and the event loop
+    keeps serving other chats meanwhile. At most ``max_concurrent`` ffmpeg
+    processes run at once (the rest wait their turn) and each one is
+    killed after ``timeout`` seconds.
+    """
+    
+    def __init__(self, max_concurrent: Optional[int] = None, timeout: Optional[float] = None,
+                 ffmpeg: str = "ffmpeg"):
         self.temp_dir = "./audio_temp"
         Path(self.temp_dir).mkdir(exist_ok=True)
+        self.max_concurrent = max(1, max_concurrent or config.ffmpeg_max_concurrent)
+        self.timeout = timeout or config.ffmpeg_timeout
+        self.ffmpeg = ffmpeg
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self.stats = {"jobs": 0, "failures": 0, "timeouts": 0, "waiting": 0, "running": 0}
+    
+    async def transcode(self, data: bytes, output_args: list) -> bytes:
+        """Pipe ``data`` through ffmpeg with ``output_args``; returns stdout."""
+        self.stats["waiting"] += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.stats["waiting"] -= 1
+        self.stats["running"] += 1
+        self.stats["jobs"] += 1
+        try:
+            return await self._run(data, output_args)
+        except AudioConversionError:
+            self.stats["failures"] += 1
+            raise
+        finally:
+            self.stats["running"] -= 1
+            self._slots.release()
+    
+    async def _run(self, data: bytes, output_args: list) -> bytes:
+        cmd = [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-i", "pipe:0", *output_args, "pipe:1"]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise AudioConversionError(f"{self.ffmpeg} not found; install FFmpeg")
+        
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(data), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise AudioConversionError(f"ffmpeg took longer than {self.timeout}s")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        
+        if process.returncode != 0 or not stdout:
+            message = stderr.decode(errors="replace").strip().splitlines()
+            raise AudioConversionError(
+                f"ffmpeg exited with {process.returncode}: {message[-1] if message else 'no output'}"
+            )
+        return stdout
+    
+    async def ogg_to_wav(self, ogg: bytes) -> bytes:
+        """Decode a voice note to 16 kHz mono 16-bit WAV, in memory."""
+        pcm = await self.transcode(ogg, [
+            "-vn", "-ac", "1", "-ar", str(STT_SAMPLE_RATE), "-f", "s16le", "-acodec", "pcm_s16le",
+        ])
+        logger.debug(f"Transcoded {len(ogg)} bytes of OGG to {len(pcm)} bytes of PCM")
+        return pcm_to_wav(pcm)
     
     async def convert_ogg_to_wav(self, ogg_path: str, wav_path: str) -> bool:
-        """Convert OGG to WAV using ffmpeg."""
+        """Convert an OGG file to a 16 kHz mono WAV file."""
         try:
-            import subprocess
-            
-            # Windows-safe command
-            cmd = f'ffmpeg -y -i "{ogg_path}" "{wav_path}" 2>nul'
-            result = os.system(cmd)
-            
-            if result == 0 and os.path.exists(wav_path):
-                logger.info(f"Converted {ogg_path} to {wav_path}")
-                return True
-            else:
-                logger.error(f"FFmpeg conversion failed: {result}")
-                return False
-        except Exception as e:
+            ogg = await asyncio.to_thread(Path(ogg_path).read_bytes)
+            wav = await self.ogg_to_wav(ogg)
+            await asyncio.to_thread(Path(wav_path).write_bytes, wav)
+            logger.info(f"Converted {ogg_path} to {wav_path}")
+            return True
+        except (OSError, AudioConversionError) as e:
             logger.error(f"Audio conversion error: {e}")
             return False
     
@@ -137,31 +226,22 @@ class VoiceManager:
     
     def __init__(self, stt_backend: Optional[STTBackend] = None, 
                  tts_backend: Optional[TTSBackend] = None):
-        self.stt = stt_backend or GoogleSTT()
+        self.stt = stt_backend or get_stt()
         self.tts = tts_backend or GoogleTTS()
-        self.audio_processor = AudioProcessor()
+        self.audio_processor = get_audio_processor()
     
-    async def voice_to_text(self, voice_file_path: str) -> str:
+    async def voice_to_text(self, voice: Union[str, bytes]) -> str:
         """
-        Convert voice file to text.
-        Handles OGG → WAV → STT.
+        Convert a voice note (OGG bytes, or the path of an OGG file) to text.
+        Handles OGG → 16 kHz WAV → STT, in memory.
         """
-        chat_id = int(voice_file_path.split("_")[1]) if "_" in voice_file_path else 0
+        if isinstance(voice, str):
+            voice_file_path = voice
+            voice = await asyncio.to_thread(Path(voice_file_path).read_bytes)
+            self.audio_processor.cleanup_temp_files(voice_file_path)
         
-        wav_path = voice_file_path.replace(".ogg", ".wav")
-        
-        # Convert OGG to WAV
-        success = await self.audio_processor.convert_ogg_to_wav(voice_file_path, wav_path)
-        if not success:
-            raise RuntimeError("Failed to convert OGG to WAV")
-        
-        # Transcribe
-        text = await self.stt.transcribe(wav_path)
-        
-        # Cleanup
-        self.audio_processor.cleanup_temp_files(voice_file_path, wav_path)
-        
-        return text
+        wav = await self.audio_processor.ogg_to_wav(voice)
+        return await self.stt.transcribe(wav)
     
     async def text_to_voice(self, text: str, output_path: str, language: str = "en") -> bool:
         """Convert text to voice file."""
@@ -188,10 +268,33 @@ class VoiceManager:
             raise
 
 
-# Global instance
+# Global instances
+_audio_processor: Optional[AudioProcessor] = None
+_stt: Optional[STTBackend] = None
 _voice_manager: Optional[VoiceManager] = None
 
 
+def get_audio_processor() -> AudioProcessor:
+    """Get or create the process-wide audio processor (shares the ffmpeg cap)."""
+    global _audio_processor
+    if _audio_processor is None:
+        _audio_processor = AudioProcessor()
+        logger.info(
+            f"ffmpeg: up to {_audio_processor.max_concurrent} at once, "
+            f"{_audio_processor.timeout}s timeout"
+        )
+    return _audio_processor
+
+
+def get_stt() -> STTBackend:
+    """Get or create the process-wide speech recognizer (raises ImportError
+    when SpeechRecognition is not installed)."""
+    global _stt
+    if _stt is None:
+        _stt = GoogleSTT()
+    return _stt
+
+
 def get_voice_manager() -> VoiceManager:
     """Get or create voice manager."""
     global _voice_manager